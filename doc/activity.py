@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from typing import List
+from django.db import close_old_connections, transaction
+from doc_server import settings
+from doc.models import Activity
+from doc.utils import now
+from doc import tasks
+
+logger = logging.getLogger(__name__)
+
+
+class Buffer:
+    '''
+    每个进程在内存中缓存审计记录, 攒够 ACTIVITY_BATCH 条、距上次写入超过 ACTIVITY_FLUSH_INTERVAL 秒
+    或进程退出时用一条 bulk_create 写入, 写操作本身不等待插入
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows: List[Activity] = []
+        self.pid = None
+        self.flushing = False
+
+    def start(self) -> None:
+        # 调用方持有锁; fork 出来的 worker 不继承父进程的定时线程, 父进程缓存的记录由父进程写入
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.rows = []
+        threading.Thread(target=self.run, args=(self.pid,), name="doc-activity", daemon=True).start()
+        atexit.register(self.flush)
+
+    def add(self, row: Activity) -> None:
+        with self.lock:
+            self.start()
+            self.rows.append(row)
+            full = len(self.rows) >= settings.ACTIVITY_BATCH and not self.flushing
+            if full:
+                self.flushing = True
+        if full:
+            tasks.submit(self.flush)
+
+    def flush(self) -> int:
+        with self.lock:
+            rows, self.rows = self.rows, []
+            self.flushing = False
+        if len(rows) == 0:
+            return 0
+        try:
+            Activity.objects.bulk_create(rows, batch_size=settings.ACTIVITY_BATCH)
+        except Exception:
+            logger.error("failed to write %d activity records", len(rows), exc_info=True)
+            with self.lock:
+                # 数据库暂时不可用时放回缓存等下次重试, 超过上限的部分丢弃
+                room = max(0, settings.ACTIVITY_BUFFER_MAX - len(self.rows))
+                if room < len(rows):
+                    logger.warning("activity buffer is full, dropped %d records", len(rows) - room)
+                self.rows[:0] = rows[len(rows) - room:]
+            return 0
+        return len(rows)
+
+    def run(self, pid: int) -> None:
+        while self.pid == pid:
+            time.sleep(settings.ACTIVITY_FLUSH_INTERVAL)
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+
+buffer = Buffer()
+flush = buffer.flush
+
+
+def record(kind: str, author_id: int, doc_id: int = None, target_id: int = None, **payload) -> None:
+    '''
+    记录一次操作; 在事务中调用时等到提交后才进入缓存, 回滚的操作不会留下记录
+    '''
+    if not settings.ACTIVITY_ENABLED:
+        return
+    row = Activity(author_id=author_id, doc_id=doc_id, target_id=target_id, kind=kind,
+        payload=json.dumps(payload, ensure_ascii=False), time=now())
+    transaction.on_commit(lambda: buffer.add(row))
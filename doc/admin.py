@@ -1,13 +1,195 @@
+from datetime import datetime, timedelta
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import Q
+from django.utils.functional import cached_property
 from doc.models import Author, Doc, Access, Token, DocTree, Chat, Message, ReadToken, CollaborateToken
 
-# Register your models here.
-admin.site.register(Author)
-admin.site.register(Doc)
-admin.site.register(Access)
-admin.site.register(Token)
-admin.site.register(DocTree)
-admin.site.register(Chat)
-admin.site.register(Message)
-admin.site.register(ReadToken)
-admin.site.register(CollaborateToken)
\ No newline at end of file
+# 超过这个行数的表在没有过滤条件时使用数据库统计的估计行数
+ESTIMATE_THRESHOLD = 100000
+
+
+def estimated_rows(table: str) -> int:
+    with connection.cursor() as cursor:
+        if connection.vendor == "mysql":
+            cursor.execute("SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", [table])
+        elif connection.vendor == "postgresql":
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    return int(row[0]) if row is not None and row[0] is not None else None
+
+
+class EstimatedCountPaginator(Paginator):
+    '''
+    没有过滤条件时用估计行数代替 COUNT(*), 估计值较小时仍然精确计数
+    '''
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, "query", None)
+        if query is not None and not query.where:
+            estimate = estimated_rows(self.object_list.model._meta.db_table)
+            if estimate is not None and estimate > ESTIMATE_THRESHOLD:
+                return estimate
+        return super().count
+
+
+def ms_date_filter(field: str, title: str):
+    '''
+    BigInteger 毫秒时间戳上的按日期筛选, 转换为范围查询, 有索引的字段可以直接使用索引
+    '''
+    class MillisDateFilter(admin.SimpleListFilter):
+        parameter_name = field + "__since"
+
+        def lookups(self, request, model_admin):
+            return [("1", "Today"), ("7", "Past 7 days"), ("30", "Past 30 days"), ("365", "Past year")]
+
+        def queryset(self, request, queryset):
+            if self.value() is None:
+                return queryset
+            try:
+                days = int(self.value())
+            except ValueError:
+                # 手工改过的参数不筛选
+                return queryset
+            today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            since = today - timedelta(days=days - 1)
+            return queryset.filter(**{field + "__gte": int(since.timestamp() * 1000)})
+
+    MillisDateFilter.title = title
+    return MillisDateFilter
+
+
+def related(path: str, description: str):
+    '''
+    显示关联对象的字段, 配合 list_select_related 不会为每一行单独查询
+    '''
+    def display(obj):
+        for name in path.split("__"):
+            obj = getattr(obj, name, None) if obj is not None else None
+        return obj
+    display.short_description = description
+    display.admin_order_field = path
+    return display
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    '''
+    search_fields 只使用有索引的精确匹配, 输入数字时按 id_search_fields 中的主键或外键查找
+    '''
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    list_per_page = 50
+    id_search_fields = ["pk"]
+    deferred_fields = []
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return queryset.defer(*self.deferred_fields) if self.deferred_fields else queryset
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if term.isdigit():
+            condition = Q()
+            for field in self.id_search_fields:
+                condition |= Q(**{field: int(term)})
+            return queryset.filter(condition), False
+        return super().get_search_results(request, queryset, search_term)
+
+
+@admin.register(Author)
+class AuthorAdmin(LargeTableAdmin):
+    list_display = ["id", "email", "nickname", "active", "create_time"]
+    list_filter = ["active", ms_date_filter("create_time", "created")]
+    search_fields = ["=email"]
+    exclude = ["password"]
+
+
+@admin.register(Doc)
+class DocAdmin(LargeTableAdmin):
+    # 默认管理器已经延迟加载 full_text, 只有编辑页会读取
+    list_display = ["id", "label", "type", "recycled", "mod_time"]
+    list_filter = ["recycled", ms_date_filter("mod_time", "modified")]
+    search_fields = ["=id"]
+
+    def get_search_results(self, request, queryset, search_term):
+        # label 和全文没有索引, 只支持按 id 查找
+        term = search_term.strip()
+        if term and not term.isdigit():
+            return queryset.none(), False
+        return super().get_search_results(request, queryset, search_term)
+
+
+@admin.register(Access)
+class AccessAdmin(LargeTableAdmin):
+    list_display = ["id", related("author__email", "author"), "doc_id", related("doc__label", "doc"), "role"]
+    list_select_related = ["author", "doc"]
+    list_filter = ["role"]
+    raw_id_fields = ["author", "doc"]
+    search_fields = ["=author__email"]
+    id_search_fields = ["pk", "doc_id", "author_id"]
+    deferred_fields = ["doc__full_text", "author__password"]
+
+
+@admin.register(Token)
+class TokenAdmin(LargeTableAdmin):
+    list_display = ["id", related("author__email", "author"), "timestamp"]
+    list_select_related = ["author"]
+    list_filter = [ms_date_filter("timestamp", "renewed")]
+    raw_id_fields = ["author"]
+    search_fields = ["=content", "=author__email"]
+    id_search_fields = ["pk", "author_id"]
+
+
+@admin.register(DocTree)
+class DocTreeAdmin(LargeTableAdmin):
+    list_display = ["id", related("author__email", "author"), "timestamp"]
+    list_select_related = ["author"]
+    raw_id_fields = ["author"]
+    search_fields = ["=author__email"]
+    id_search_fields = ["pk", "author_id"]
+    deferred_fields = ["content", "author__password"]
+
+
+@admin.register(Chat)
+class ChatAdmin(LargeTableAdmin):
+    list_display = ["id", related("initiator__email", "initiator"), related("recipient__email", "recipient"), "time"]
+    list_select_related = ["initiator", "recipient"]
+    list_filter = [ms_date_filter("time", "started")]
+    raw_id_fields = ["initiator", "recipient"]
+    search_fields = ["=initiator__email", "=recipient__email"]
+    id_search_fields = ["pk", "initiator_id", "recipient_id"]
+
+
+@admin.register(Message)
+class MessageAdmin(LargeTableAdmin):
+    list_display = ["id", "chat_id", related("sender__email", "sender"), related("receiver__email", "receiver"), "time"]
+    list_select_related = ["sender", "receiver"]
+    list_filter = [ms_date_filter("time", "sent")]
+    raw_id_fields = ["chat", "sender", "receiver"]
+    search_fields = ["=sender__email", "=receiver__email"]
+    id_search_fields = ["pk", "chat_id"]
+    deferred_fields = ["msg"]
+
+
+@admin.register(ReadToken)
+class ReadTokenAdmin(LargeTableAdmin):
+    list_display = ["id", "doc_id", related("doc__label", "doc"), "timestamp"]
+    list_select_related = ["doc"]
+    raw_id_fields = ["doc"]
+    search_fields = ["=content"]
+    id_search_fields = ["pk", "doc_id"]
+    deferred_fields = ["doc__full_text"]
+
+
+@admin.register(CollaborateToken)
+class CollaborateTokenAdmin(LargeTableAdmin):
+    list_display = ["id", "doc_id", related("doc__label", "doc"), "timestamp"]
+    list_select_related = ["doc"]
+    raw_id_fields = ["doc"]
+    search_fields = ["=content"]
+    id_search_fields = ["pk", "doc_id"]
+    deferred_fields = ["doc__full_text"]
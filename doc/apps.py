@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class DocConfig(AppConfig):
     name = 'doc'
+
+    def ready(self):
+        from doc import bus, signals, sqlstats
+        signals.connect()
+        sqlstats.install()
+        bus.install()
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from django.db import transaction
+from django.db.models import Q
+from doc_server import settings
+from doc.models import Author, Chat, Message, MessageArchive
+from doc.utils import now
+
+
+def archive_batch(deadline: int, batch_size: int) -> int:
+    '''
+    把一批早于 deadline 的消息按聊天写入归档段并删除, 尾部的段未满时合并进去
+    '''
+    with transaction.atomic():
+        messages = list(Message.objects.select_for_update().filter(time__lt=deadline).order_by("pk")[:batch_size])
+        if len(messages) == 0:
+            return 0
+        groups: Dict[int, List[Message]] = OrderedDict()
+        for message in messages:
+            groups.setdefault(message.chat_id, []).append(message)
+        for chat_id, group in groups.items():
+            tail = MessageArchive.objects.filter(chat_id=chat_id).order_by("-last_id").first()
+            while len(group):
+                if tail is not None and tail.count < settings.MESSAGE_ARCHIVE_SEGMENT:
+                    room = settings.MESSAGE_ARCHIVE_SEGMENT - tail.count
+                    tail.pack(tail.messages() + group[:room])
+                    tail.save()
+                    group = group[room:]
+                else:
+                    tail = MessageArchive(chat_id=chat_id)
+                    tail.pack(group[:settings.MESSAGE_ARCHIVE_SEGMENT])
+                    tail.save()
+                    group = group[settings.MESSAGE_ARCHIVE_SEGMENT:]
+        Message.objects.filter(pk__in=[message.pk for message in messages]).delete()
+    return len(messages)
+
+
+def archive_messages(age: int = settings.MESSAGE_ARCHIVE_AGE, batch_size: int = settings.MESSAGE_ARCHIVE_BATCH,
+        max_batches: int = 0) -> int:
+    '''
+    增量归档, 每批一个事务; max_batches 大于 0 时最多处理这么多批
+    '''
+    deadline = now() - age
+    archived = 0
+    batches = 0
+    while max_batches <= 0 or batches < max_batches:
+        count = archive_batch(deadline, batch_size)
+        if count == 0:
+            break
+        archived += count
+        batches += 1
+    return archived
+
+
+def page(chat: Chat, start: int, end: int) -> List[Message]:
+    '''
+    按 id 从新到旧取第 start 到 end 条消息, 先取热表, 不够时继续从归档段中取;
+    归档总是早于热表中的消息, 所以两部分可以直接拼接. 只有整页都落在热表之外时才需要统计热表的条数
+    '''
+    hot = Message.objects.filter(chat=chat)
+    result = list(hot.order_by("-pk")[start:end])
+    if len(result) == end - start:
+        return result
+    hot_count = start + len(result) if len(result) else hot.count()
+    start, end = max(0, start - hot_count), end - hot_count
+    skipped = 0
+    for segment in MessageArchive.objects.filter(chat=chat).order_by("-last_id").values("pk", "count"):
+        if skipped + segment["count"] <= start:
+            skipped += segment["count"]
+            continue
+        messages = MessageArchive.objects.get(pk=segment["pk"]).messages()
+        messages.reverse()
+        result.extend(messages[max(0, start - skipped):end - skipped])
+        skipped += segment["count"]
+        if skipped >= end:
+            break
+    return result
+
+
+def latest(chat: Chat) -> Message:
+    message = Message.objects.filter(chat=chat).order_by("-pk").first()
+    if message is not None:
+        return message
+    segment = MessageArchive.objects.filter(chat=chat).order_by("-last_id").first()
+    return segment.messages()[-1] if segment is not None else None
+
+
+def search(author: Author, keywords: str, before: int = None, max_segments: int = settings.MESSAGE_ARCHIVE_SEARCH_SEGMENTS,
+        window: int = settings.MESSAGE_ARCHIVE_SEARCH_WINDOW) -> Tuple[List[Message], Optional[int]]:
+    '''
+    在该用户聊天的归档段中从新到旧搜索 last_id 小于 before 的段: 只看最后一条消息在 window 毫秒之内的段,
+    一次最多解压 max_segments 段; 还有没扫描的段时返回作为下一次 before 的游标, 否则为 None. 结果按 id 升序
+    '''
+    keywords = keywords.lower()
+    chats = Chat.objects.filter(Q(initiator=author) | Q(recipient=author)).values_list("pk", flat=True)
+    segments = MessageArchive.objects.filter(chat_id__in=chats, last_time__gte=now() - window).order_by("-last_id")
+    if before is not None:
+        segments = segments.filter(last_id__lt=before)
+    matched = []
+    scanned = list(segments[:max_segments])
+    for segment in scanned:
+        matched.append([message for message in segment.messages()
+            if keywords in message.msg.lower() and author.pk in (message.sender_id, message.receiver_id)])
+    cursor = None
+    if len(scanned) == max_segments and segments.filter(last_id__lt=scanned[-1].last_id).exists():
+        cursor = scanned[-1].last_id
+    return sorted((message for group in matched for message in group), key=lambda message: message.pk), cursor
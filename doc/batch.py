@@ -0,0 +1,82 @@
+import io
+import json
+from typing import Dict, List
+from urllib.parse import urlencode
+from django.core.handlers.wsgi import WSGIRequest
+from django.http import HttpRequest
+from django.urls import Resolver404, resolve
+from doc_server import settings
+from doc.models import Access, Author
+from doc.exceptions import BizException
+from doc.responses import resp
+from doc import idempotency
+
+STRIPPED_HEADERS = (idempotency.HEADER, settings.PROFILE_HEADER)
+
+
+def error(name: str) -> Dict:
+    response = resp(name)
+    return {"status": response.status_code, "body": response.data}
+
+
+def build_request(parent: HttpRequest, token: str, author: Author, item: Dict) -> HttpRequest:
+    '''
+    以父请求为模板构造子请求, 使用同一令牌的子请求直接复用已认证的用户
+    '''
+    method = str(item.get("method", "GET")).upper()
+    query = dict(item.get("query", None) or {})
+    if token is not None:
+        query.setdefault("token", token)
+    payload = json.dumps(item.get("body", None) or {}).encode("utf-8")
+    environ = parent.META.copy()
+    # 幂等键和性能分析只作用于批量请求本身, 不传给子请求
+    for header in STRIPPED_HEADERS:
+        environ.pop(header, None)
+    environ.update({
+        "REQUEST_METHOD": method,
+        "PATH_INFO": item["path"],
+        "QUERY_STRING": urlencode(query, doseq=True),
+        "CONTENT_TYPE": "application/json",
+        "CONTENT_LENGTH": str(len(payload)),
+        "wsgi.input": io.BytesIO(payload),
+    })
+    request = WSGIRequest(environ)
+    if query.get("token", None) == token:
+        request.doc_author = author
+    return request
+
+
+def nested(parent: HttpRequest, func) -> bool:
+    '''
+    按解析出的视图判断是否为批量接口本身, 路径写法不同 (末尾斜杠、查询参数) 也能识别
+    '''
+    batch_func = parent.resolver_match.func
+    view_class = getattr(batch_func, "view_class", None)
+    return func is batch_func or (view_class is not None and getattr(func, "view_class", None) is view_class)
+
+
+def execute(parent: HttpRequest, token: str, author: Author, item: Dict) -> Dict:
+    if not isinstance(item, dict) or not isinstance(item.get("path", None), str):
+        return error("common.bad_request")
+    try:
+        match = resolve(item["path"])
+    except Resolver404:
+        return error("common.not_found")
+    if nested(parent, match.func):
+        return error("common.bad_request")
+    request = build_request(parent, token, author, item)
+    response = match.func(request, *match.args, **match.kwargs)
+    if getattr(response, "streaming", False) or not hasattr(response, "data"):
+        return error("common.bad_request")
+    return {"status": response.status_code, "body": response.data}
+
+
+def dispatch(parent: HttpRequest, token: str, author: Author, items: List[Dict]) -> List[Dict]:
+    '''
+    在进程内依次调用现有视图, 所有子请求共享同一个用户、权限缓存和当前请求的数据库连接;
+    每个子请求按各自视图的 cost 限流, 批量请求本身不再计费
+    '''
+    if not isinstance(items, list) or len(items) > settings.BATCH_MAX_REQUESTS:
+        raise BizException("common.bad_request")
+    with Access.cached():
+        return [execute(parent, token, author, item) for item in items]
@@ -1,22 +1,31 @@
 import json
-import threading
+import time
+import logging
 import requests
-from django.db.models import Q
+from hashlib import md5
+from smtplib import SMTPException
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, IntegerField, OuterRef, Q, Max, Subquery
+from django.db.models.functions import Coalesce
 from typing import Dict, Iterable, List, Set, Tuple
 from doc_server import settings
 from django.db.models.query import QuerySet
-from doc.models import Author, Chat, CollaborateToken, Message, ReadToken, Token, Doc, Access, DocTree
+from doc.models import (Activity, Author, AuthorStats, Chat, CollaborateToken, GroupChat, GroupMember, GroupMessage, IdempotencyRecord, Message,
+    ReadToken, Token, Doc, Access, DocTree, DocVersion)
 from doc.serializers import AuthorSerializer, ChatSerializer, DocAccessSerializer, DocSerializer
 from doc.exceptions import BizException
+from doc import activity, archive, doctree, feed, reprcache, stats, tasks, tokens, workspace
 from django.core.mail import send_mail
 from doc.utils import (
     gen_token, now,
     parse_email,
     gen_valid_code,
     val_valid_code,
-    trim_doc_tree,
-    extract_doc_from_root,
-    digest)
+    digest,
+    keyset_page,
+    Page,
+    compress_text,
+    make_delta)
 from doc_server import settings
 
 import pymongo
@@ -24,6 +33,41 @@ import pymongo
 mongo_cli = pymongo.MongoClient(settings.MONGO_URL)
 db = mongo_cli[settings.MONGO_DB]
 
+logger = logging.getLogger(__name__)
+
+def post_mid(path: str, data: Dict) -> bool:
+    '''
+    在后台线程中调用, 失败时按 MID_NOTIFY_RETRIES 次数退避重试, 最终失败记录错误日志
+    '''
+    for attempt in range(settings.MID_NOTIFY_RETRIES + 1):
+        try:
+            requests.post("{}/{}".format(settings.MID_HOST, path), data={"data": json.dumps(data)},
+                timeout=settings.MID_NOTIFY_TIMEOUT).raise_for_status()
+            return True
+        except requests.RequestException as e:
+            error = e
+        if attempt < settings.MID_NOTIFY_RETRIES:
+            time.sleep(settings.MID_NOTIFY_BACKOFF * 2 ** attempt)
+    logger.error("collaboration server notification %s failed after %d attempts: %s",
+        path, settings.MID_NOTIFY_RETRIES + 1, error)
+    return False
+
+def notify_mid(path: str, data: Dict) -> None:
+    '''
+    通知协同编辑中间层, 不等待结果
+    '''
+    tasks.submit(post_mid, path, data)
+
+def send_register_mail(author: Author, token: str) -> None:
+    '''
+    同步发送验证邮件; 发送失败时账号保持未激活, 用户重新注册会重新发送
+    '''
+    try:
+        send_mail("DocPlus-欢迎来到DocPlus", parse_email(gen_valid_code(token), author.nickname), settings.DEFAULT_FROM_EMAIL, [author.email,])
+    except (SMTPException, OSError):
+        logger.error("failed to send the verification mail to %s", author.email, exc_info=True)
+        raise BizException("register.mail_failed")
+
 def get_authors(keyword: str) -> QuerySet:
     '''
     用户列表
@@ -59,7 +103,7 @@ def author_register(data: Dict) -> str:
             author.set_password(pwd)
             author.save()
             token = Token.objects.create(author=author).content
-            send_mail("DocPlus-欢迎来到DocPlus", parse_email(gen_valid_code(token), author.nickname), settings.DEFAULT_FROM_EMAIL, [author.email,])
+            send_register_mail(author, token)
             return token
         raise BizException("common.bad_request", srlzr.errors)
     elif not authors[0].active:
@@ -76,7 +120,7 @@ def author_register(data: Dict) -> str:
             tk.save()
         else:
             tk = Token.objects.create(author=author, content=token)
-        send_mail("DocPlus-欢迎来到DocPlus", parse_email(gen_valid_code(token), author.nickname), settings.DEFAULT_FROM_EMAIL, [author.email,])
+        send_register_mail(author, token)
         return token
     else:
         raise BizException("register.duplicated")
@@ -100,10 +144,10 @@ def get_author(author_id: int) -> Author:
     return authors[0]
 
 def get_author_by_token(token: str) -> Author:
-    try:
-        return Token.objects.get(content=token).author
-    except:
+    author = tokens.author_of(token)
+    if author is None:
         raise BizException("login.invalid")
+    return author
 
 def edit_author_profile(author_id: int, data: Dict, request_author: Author) -> Author:
     '''
@@ -130,17 +174,52 @@ def login(email: str, password: str) -> str:
     author = authors[0]
     if author.active:
         if author.check_password(password):
+            if settings.SIGNED_TOKENS:
+                warm_up_after_login(author)
+                return tokens.sign(author)
             previous_tokens: Iterable[Token] = Token.objects.filter(author=author)
             if len(previous_tokens) == 0:
                 token = Token.objects.create(author=author).content
             else:
                 prev_token: Token = previous_tokens[0]
+                if prev_token.expired(settings.TOKEN_TTL):
+                    # 过期的令牌不再续用, 轮换为新令牌
+                    prev_token.content = gen_token()
                 prev_token.timestamp = now()
+                prev_token.save()
                 token = prev_token.content
+            warm_up_after_login(author)
             return token
         raise BizException("login.wrong")
     raise BizException("login.inactive")
 
+def warm_up_after_login(author: Author) -> None:
+    if not settings.LOGIN_WARMUP:
+        return
+    # 短时间内重复登录只预热一次
+    if reprcache.cache().add("warmup:{}".format(author.pk), True, settings.LOGIN_WARMUP_INTERVAL):
+        tasks.submit(warm_up_workspace, author.pk)
+
+def warm_up_workspace(author_id: int) -> None:
+    '''
+    登录后在后台补全文档树, 并把权限表和文档列表中文档的表示写入缓存
+    '''
+    author = Author.objects.filter(pk=author_id).first()
+    if author is None:
+        return
+    get_doc_tree_of(author_id, author)
+    roles = Access.roles_of(author_id)
+    if settings.REPR_CACHE_ENABLED and len(roles):
+        DocSerializer.represent(Doc.objects.filter(pk__in=list(roles.keys()), recycled=False), True, {})
+
+def logout(request_author: Author) -> None:
+    '''
+    注销, 该用户的所有令牌失效
+    '''
+    if request_author is None:
+        raise BizException("common.forbidden")
+    tokens.revoke(request_author)
+
 def get_doc_by_author_with_role(author_id: int, role: str, request_author: Author) -> QuerySet:
     '''
     获取用户以特定角色加入的文档的列表
@@ -153,7 +232,7 @@ def get_doc_by_author_with_role(author_id: int, role: str, request_author: Autho
         raise BizException("common.forbidden")
     accesses = Access.objects.filter(role=role, author=author)
     doc_ids = accesses.values_list("doc_id")
-    docs = Doc.objects.filter(pk__in=doc_ids)
+    docs = Doc.objects.filter(pk__in=doc_ids, recycled=False)
     return docs
 
 def create_doc(doc_data: Dict, author_id: int, request_author: Author) -> Doc:
@@ -171,24 +250,27 @@ def create_doc(doc_data: Dict, author_id: int, request_author: Author) -> Doc:
         doc = srlzr.save()
         access = Access.objects.create(author=author, doc=doc, role=2)
         access.save()
+        activity.record("doc.create", author.pk, doc.pk, label=doc.label)
         return doc
     raise BizException("common.bad_request", srlzr.errors)
 
-def get_doc(doc_id: int, request_author: Author, token: str = None) -> Doc:
+def get_doc(doc_id: int, request_author: Author, token: str = None, with_text: bool = False) -> Doc:
     '''
-    获取文档信息
+    获取文档信息, with_text 时同时加载默认延迟的 full_text
     '''
-    docs: Iterable[Doc] = Doc.objects.filter(pk=doc_id)
+    docs: Iterable[Doc] = (Doc.objects.defer(None) if with_text else Doc.objects).filter(pk=doc_id, recycled=False)
     if len(docs) == 0:
         raise BizException("common.not_found")
     doc = docs[0]
     if token is not None:
-        reads = ReadToken.objects.filter(content=token)
-        if len(reads):
+        reads = ReadToken.objects.filter(content=token, doc=doc)
+        if len(reads) and not reads[0].expired(settings.INVITE_TOKEN_TTL):
             grant_doc_to_author(doc.id, request_author.pk, 0, doc.get_creator())
-        colls = CollaborateToken.objects.filter(content=token)
-        if len(colls):
+            activity.record("invite.redeem", request_author.pk, doc.pk, role=0)
+        colls = CollaborateToken.objects.filter(content=token, doc=doc)
+        if len(colls) and not colls[0].expired(settings.INVITE_TOKEN_TTL):
             grant_doc_to_author(doc.id, request_author.pk, 1, doc.get_creator())
+            activity.record("invite.redeem", request_author.pk, doc.pk, role=1)
     if Access.can_read(request_author, doc):
         return doc
     raise BizException("doc.not_r")
@@ -210,7 +292,7 @@ def get_doc_batch(doc_ids: List[int], from_tos: List[str], request_author: Autho
             valid_doc_ids.append(doc_id)
         except:
             pass
-    return Doc.objects.filter(pk__in=valid_doc_ids)
+    return Doc.objects.filter(pk__in=valid_doc_ids, recycled=False)
 
 def edit_doc_info(doc_id: int, data: Dict, request_author: Author) -> Doc:
     '''
@@ -231,12 +313,16 @@ def delete_doc(doc_id: int, request_author: Author) -> Doc:
     '''
     doc = get_doc(doc_id, request_author)
     if Access.can_dominate(request_author, doc):
-        doc.delete()
-        print(doc_id)
-        db["document"].delete_one({"_id": str(doc_id)})
+        # 只做回收标记, 真正的删除由 purge_recycled_docs 完成
+        doc.recycled = True
+        doc.recycle_time = now()
+        if Doc.objects.filter(pk=doc.pk, recycled=False).update(recycled=True, recycle_time=doc.recycle_time):
+            stats.docs_recycled([doc.pk], -1)
+            activity.record("doc.delete", request_author.pk, doc.pk)
         return doc
     elif Access.can_collaborate(request_author, doc) or Access.can_read(request_author, doc):
-        Access.objects.filter(author=request_author, doc=doc).delete()
+        delete_accesses(Access.objects.filter(author=request_author, doc=doc), doc)
+        activity.record("doc.unlink", request_author.pk, doc.pk)
         return doc
     else:
         raise BizException("doc.not_d")
@@ -263,11 +349,195 @@ def del_doc_batch(doc_ids: List[int], from_tos: List[str], request_author: Autho
                 to_unlink.append(doc_id)
         except BizException:
             denied.append(doc_id)
-    Doc.objects.filter(pk__in=to_del).delete()
-    db.document.delete_one({"_id": {"$in": [str(pk) for pk in to_del]}})
-    Access.objects.filter(author=request_author, doc_id__in=to_unlink).delete()
+    with transaction.atomic():
+        # 只调整这次真正被回收的文档的统计
+        recycled = list(Doc.objects.select_for_update().filter(pk__in=to_del, recycled=False).values_list("pk", flat=True))
+        Doc.objects.filter(pk__in=recycled).update(recycled=True, recycle_time=now())
+        stats.docs_recycled(recycled, -1)
+    delete_accesses(Access.objects.filter(author=request_author, doc_id__in=to_unlink).select_related("doc"))
+    for doc_id in recycled:
+        activity.record("doc.delete", request_author.pk, doc_id)
+    for doc_id in to_unlink:
+        activity.record("doc.unlink", request_author.pk, doc_id)
     return { "deleted": to_del, "unlinked": to_unlink, "denied": denied }
 
+def get_recycled_docs(author_id: int, request_author: Author) -> QuerySet:
+    '''
+    获取用户回收站中的文档
+    '''
+    if request_author is None or request_author.pk != author_id:
+        raise BizException("common.forbidden")
+    doc_ids = Access.objects.filter(author_id=author_id, role=Access.DOMINATOR).values_list("doc_id")
+    # recycle_time 为 0 的文档已经在等待清除
+    return Doc.objects.filter(pk__in=doc_ids, recycled=True, recycle_time__gt=0)
+
+def restore_doc(doc_id: int, request_author: Author) -> Doc:
+    '''
+    从回收站恢复文档
+    '''
+    docs: Iterable[Doc] = Doc.objects.filter(pk=doc_id, recycled=True, recycle_time__gt=0)
+    if len(docs) == 0:
+        raise BizException("common.not_found")
+    doc = docs[0]
+    if not Access.can_dominate(request_author, doc):
+        raise BizException("doc.not_d")
+    doc.recycled = False
+    doc.recycle_time = 0
+    if Doc.objects.filter(pk=doc.pk, recycled=True).update(recycled=False, recycle_time=0):
+        stats.docs_recycled([doc.pk], 1)
+    return doc
+
+def empty_recycle_bin(author_id: int, request_author: Author) -> List[int]:
+    '''
+    清空回收站: 文档先标记为待清除 (recycle_time 为 0, 不再出现在回收站中), 再交给后台线程删除;
+    进程在删除完成前退出时, 剩下的文档由 purge_recycled 命令的下一次运行清除
+    '''
+    docs = get_recycled_docs(author_id, request_author)
+    doc_ids = list(docs.values_list("pk", flat=True))
+    # 先标记为待清除, 再在后台分批删除, 不占用请求
+    Doc.objects.filter(pk__in=doc_ids).update(recycle_time=0)
+    tasks.submit(purge_docs, doc_ids)
+    return doc_ids
+
+def purge_docs(doc_ids: List[int], chunk_size: int = settings.RECYCLE_PURGE_CHUNK) -> int:
+    '''
+    分批彻底删除回收站中的文档及其权限和内容
+    '''
+    purged = 0
+    for i in range(0, len(doc_ids), chunk_size):
+        with transaction.atomic():
+            chunk = list(Doc.objects.select_for_update().filter(pk__in=doc_ids[i:i + chunk_size], recycled=True)
+                .values_list("pk", flat=True))
+            if len(chunk) == 0:
+                continue
+            # 权限不逐行触发信号: 回收时已经从统计中减掉, 群聊成员随文档级联删除, 缓存按块失效一次
+            author_ids = set(Access.objects.filter(doc_id__in=chunk).values_list("author_id", flat=True))
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM {} WHERE {} IN ({})".format(connection.ops.quote_name(Access._meta.db_table),
+                    connection.ops.quote_name(Access._meta.get_field("doc").column), ", ".join(["%s"] * len(chunk))), chunk)
+            reprcache.invalidate("author", author_ids)
+            reprcache.invalidate("roles", author_ids)
+            Doc.objects.filter(pk__in=chunk).delete()
+        db["document"].delete_many({"_id": {"$in": [str(pk) for pk in chunk]}})
+        purged += len(chunk)
+    return purged
+
+def purge_recycled_docs(expire: int = settings.RECYCLE_EXPIRE, chunk_size: int = settings.RECYCLE_PURGE_CHUNK) -> int:
+    '''
+    清除回收时间超过 expire 毫秒的文档
+    '''
+    deadline = now() - expire
+    purged = 0
+    while True:
+        doc_ids = list(Doc.objects.filter(recycled=True, recycle_time__lt=deadline)
+            .order_by("recycle_time").values_list("pk", flat=True)[:chunk_size])
+        if len(doc_ids) == 0:
+            return purged
+        purged += purge_docs(doc_ids, chunk_size)
+
+def snapshot_doc(doc: Doc) -> DocVersion:
+    '''
+    为文档当前内容生成快照, 内容未变化时返回 None
+    '''
+    text = doc.full_text
+    checksum = md5(text.encode("utf-8")).hexdigest()
+    versions: Iterable[DocVersion] = DocVersion.objects.filter(doc=doc).order_by("-pk")[:1]
+    if len(versions) == 0:
+        return DocVersion.objects.create(doc=doc, keyframe=True, content=compress_text(text), checksum=checksum, size=len(text))
+    prev = versions[0]
+    if prev.checksum == checksum:
+        return None
+    # 每隔 VERSION_KEYFRAME_INTERVAL 个版本保存一次完整内容, 限制还原时需要应用的差量数
+    since_keyframe = DocVersion.objects.filter(doc=doc, keyframe=True).aggregate(Max("pk"))["pk__max"] or 0
+    chain = DocVersion.objects.filter(doc=doc, pk__gt=since_keyframe).count()
+    if chain + 1 >= settings.VERSION_KEYFRAME_INTERVAL:
+        return DocVersion.objects.create(doc=doc, keyframe=True, content=compress_text(text), checksum=checksum, size=len(text))
+    delta = make_delta(prev.load(), text)
+    return DocVersion.objects.create(doc=doc, content=delta, checksum=checksum, size=len(text))
+
+def snapshot_docs(since: int, chunk_size: int = settings.VERSION_SNAPSHOT_CHUNK) -> int:
+    '''
+    为 since 之后修改过的文档批量生成快照
+    '''
+    created = 0
+    last_pk = 0
+    while True:
+        docs = list(Doc.objects.defer(None).filter(pk__gt=last_pk, recycled=False, mod_time__gte=since).order_by("pk")[:chunk_size])
+        if len(docs) == 0:
+            return created
+        for doc in docs:
+            if snapshot_doc(doc) is not None:
+                created += 1
+        last_pk = docs[-1].pk
+
+def get_doc_versions(doc_id: int, request_author: Author) -> QuerySet:
+    '''
+    获取文档的历史版本列表
+    '''
+    doc = get_doc(doc_id, request_author)
+    return DocVersion.objects.filter(doc=doc).defer("content").order_by("-pk")
+
+def get_doc_version(doc_id: int, version_id: int, request_author: Author) -> Dict:
+    '''
+    获取文档某个历史版本的内容
+    '''
+    doc = get_doc(doc_id, request_author)
+    versions: Iterable[DocVersion] = DocVersion.objects.filter(doc=doc, pk=version_id)
+    if len(versions) == 0:
+        raise BizException("common.not_found")
+    version = versions[0]
+    return { "id": version.pk, "doc_id": doc.pk, "time": version.time, "content": version.load() }
+
+def restore_doc_version(doc_id: int, version_id: int, request_author: Author) -> Doc:
+    '''
+    将文档恢复到某个历史版本
+    '''
+    # 恢复前后都要读全文生成快照
+    doc = get_doc(doc_id, request_author, with_text=True)
+    if not Access.can_collaborate(request_author, doc):
+        raise BizException("doc.not_c")
+    versions: Iterable[DocVersion] = DocVersion.objects.filter(doc=doc, pk=version_id)
+    if len(versions) == 0:
+        raise BizException("common.not_found")
+    # 恢复前先保存当前内容, 恢复操作本身也可以撤销
+    snapshot_doc(doc)
+    doc.full_text = versions[0].load()
+    doc.mod_time = now()
+    doc.save(update_fields=["full_text", "mod_time"])
+    snapshot_doc(doc)
+    return doc
+
+def export_workspace(author_id: int, fmt: str, request_author: Author) -> Iterable[bytes]:
+    '''
+    流式导出用户的工作区
+    '''
+    if request_author is None or request_author.pk != author_id:
+        raise BizException("common.forbidden")
+    if fmt == "zip":
+        return workspace.export_zip(request_author)
+    if fmt == "ndjson":
+        return workspace.export_ndjson(request_author)
+    raise BizException("common.bad_request")
+
+def import_workspace(author_id: int, stream, request_author: Author) -> Dict:
+    '''
+    导入工作区
+    '''
+    if request_author is None or request_author.pk != author_id:
+        raise BizException("common.forbidden")
+    if stream is None:
+        raise BizException("common.bad_request")
+    return workspace.import_records(workspace.read_lines(stream), request_author)
+
+def delete_accesses(accesses: Iterable[Access], doc: Doc = None) -> None:
+    '''
+    逐条删除权限, 删除前放入已经取得的文档, 统计信号据此判断文档是否在回收站, 不再逐条查询
+    '''
+    for access in accesses:
+        if doc is not None:
+            access.doc = doc
+        access.delete()
+
 def grant_doc_to_author(doc_id: int, author_id: int, role: int, request_author: Author) -> Doc:
     '''
     授予某用户对某文档的权限
@@ -284,26 +554,30 @@ def grant_doc_to_author(doc_id: int, author_id: int, role: int, request_author:
     author = get_author(author_id)
     if Access.can_dominate(author, doc):
         raise BizException("doc.cannot_edit_d")
-    existence = Access.objects.filter(doc=doc, author=author)
-    if len(existence) == 0:
-        access = Access.objects.create(doc=doc, author=author, role=role)
-        access.save()
-    else:
-        access = existence[0]
-        access.role = role
+    # (author, doc) 唯一, 并发邀请同一用户时不会产生重复的权限; 放入已经取得的文档, 统计信号不再查询
+    try:
+        with transaction.atomic():
+            access = Access.objects.select_for_update().filter(doc=doc, author=author).first()
+            if access is None:
+                access = Access.objects.create(doc=doc, author=author, role=role)
+            else:
+                access.doc, access.role = doc, role
+                access.save()
+    except IntegrityError:
+        # 没有行可以锁住时并发的邀请可能先插入了同一条权限, 改为更新它
+        access = Access.objects.get(doc=doc, author=author)
+        access.doc, access.role = doc, role
         access.save()
+    activity.record("access.grant", request_author.pk, doc.pk, author.pk, role=role)
     data = {
         "type": "invite",
         "doc": DocSerializer(doc).data,
         "author": AuthorSerializer(author).data
     }
-    threading.Thread(target=requests.post,
-        args=("{}/invite_or_kick".format(settings.MID_HOST),),
-        kwargs={"data": {"data": json.dumps(data)}}).start()
+    notify_mid("invite_or_kick", data)
     data = DocAccessSerializer(access).data
-    threading.Thread(target=requests.post,
-        args=("{}/access_change".format(settings.MID_HOST),),
-        kwargs={"data": {"data": json.dumps(data)}}).start()
+    notify_mid("access_change", data)
+    feed.publish([author.pk], "access", { "doc_id": doc.pk, "role": access.role })
     return doc
 
 def cancel_access_to_doc(doc_id: int, author_id: int, request_author: Author) -> Doc:
@@ -323,32 +597,34 @@ def cancel_access_to_doc(doc_id: int, author_id: int, request_author: Author) ->
         # 不能取消创建者的权限
         if author_id == request_author.pk:
             raise BizException("doc.cannot_edit_d")
-        Access.objects.filter(doc_id=doc_id, author_id=author_id).delete()
-        threading.Thread(target=requests.post,
-            args=("{}/invite_or_kick".format(settings.MID_HOST),),
-            kwargs={"data": {"data": json.dumps(data)}}).start()
+        delete_accesses(Access.objects.filter(doc_id=doc_id, author_id=author_id), doc)
+        activity.record("access.kick", request_author.pk, doc.pk, author.pk)
+        notify_mid("invite_or_kick", data)
+        feed.publish([author.pk], "access", { "doc_id": doc.pk, "role": -1 })
         return doc
     # 非创建者只能取消自己的权限
     if author_id != request_author.pk:
         raise BizException("doc.forbidden_cancel")
-    Access.objects.filter(doc_id=doc_id, author_id=author_id).delete()
-    threading.Thread(target=requests.post,
-        args=("{}/invite_or_kick".format(settings.MID_HOST),),
-        kwargs={"data": {"data": json.dumps(data)}}).start()
+    delete_accesses(Access.objects.filter(doc_id=doc_id, author_id=author_id), doc)
+    activity.record("access.kick", request_author.pk, doc.pk, author.pk)
+    notify_mid("invite_or_kick", data)
     return doc
 
 def complete_doc_tree(tree: DocTree, author: Author) -> None:
-    root = json.loads(tree.content)
-    docs_in_tree = extract_doc_from_root(root)
-    all_docs = set([item["doc_id"] for item in Access.objects.filter(author=author).values("doc_id")])
+    try:
+        docs_in_tree = doctree.doc_ids(tree.content)
+    except doctree.DocTreeError:
+        # 无法解析的旧数据原样返回, 由用户重新保存时修正
+        return
+    all_docs = set(Access.roles_of(author.pk).keys())
     sup_docs = all_docs.difference(docs_in_tree)
     if len(sup_docs) == 0:
         return
-    sup_docs: Iterable[Doc] = Doc.objects.filter(pk__in=sup_docs)
-    for sup_doc in sup_docs:
-        key = digest(sup_doc.label + "-" + str(sup_doc.pk), iter=1)
-        root["children"][key] = {"id": sup_doc.pk}
-    tree.content = json.dumps(root, ensure_ascii=False)
+    sup_docs: Iterable[Doc] = Doc.objects.filter(pk__in=sup_docs, recycled=False)
+    extra = {digest(sup_doc.label + "-" + str(sup_doc.pk), iter=1): {"id": sup_doc.pk} for sup_doc in sup_docs}
+    if len(extra) == 0:
+        return
+    tree.content = doctree.process(tree.content, trim=False, extra=extra).content
     tree.save()
 
 def get_doc_tree_of(author_id: int, request_author: Author) -> DocTree:
@@ -357,13 +633,10 @@ def get_doc_tree_of(author_id: int, request_author: Author) -> DocTree:
     '''
     if request_author is None or request_author.pk != author_id:
         raise BizException("common.forbidden")
-    trees = DocTree.objects.filter(author_id=author_id)
-    if len(trees) == 0:
-        tree = DocTree.objects.create(author_id=author_id)
-        complete_doc_tree(tree, request_author)
-        return tree
-    complete_doc_tree(trees[0], request_author)
-    return trees[0]
+    # 登录预热可能同时在创建文档树
+    tree, _ = DocTree.objects.get_or_create(author_id=author_id)
+    complete_doc_tree(tree, request_author)
+    return tree
 
 def save_doc_tree(author_id: int, content: str, request_author: Author) -> DocTree:
     '''
@@ -373,12 +646,74 @@ def save_doc_tree(author_id: int, content: str, request_author: Author) -> DocTr
         raise BizException("common.bad_request")
     if request_author.pk != author_id:
         raise BizException("common.forbidden")
-    content = trim_doc_tree(content)
+    try:
+        content = doctree.trim(content)
+    except doctree.DocTreeError:
+        raise BizException("common.bad_request")
     tree = get_doc_tree_of(author_id, request_author)
     tree.content = content
     tree.save()
     return tree
 
+def page_args(role: str, after: str, limit: str) -> Tuple[int, int, int]:
+    try:
+        role = None if role is None else int(role)
+        after = None if after is None else int(after)
+        limit = settings.ACCESS_PAGE_SIZE if limit is None else int(limit)
+    except ValueError:
+        raise BizException("common.bad_request")
+    if role is not None and role not in Access.VALID_ROLES:
+        raise BizException("doc.invalid_role")
+    return role, after, min(max(limit, 1), settings.ACCESS_PAGE_MAX)
+
+def get_doc_collaborators(doc_id: int, role: str, after: str, limit: str, request_author: Author) -> Page:
+    '''
+    分页获取文档的协作者, 可以按权限筛选
+    '''
+    role, after, limit = page_args(role, after, limit)
+    doc = get_doc(doc_id, request_author)
+    accesses = Access.objects.filter(doc=doc)
+    if role is not None:
+        accesses = accesses.filter(role=role)
+    return keyset_page(accesses, after, limit)
+
+def get_author_accesses(author_id: int, role: str, after: str, limit: str, request_author: Author) -> Page:
+    '''
+    分页获取用户的权限, 只能查看自己的
+    '''
+    role, after, limit = page_args(role, after, limit)
+    if request_author is None or request_author.pk != author_id:
+        raise BizException("common.forbidden")
+    accesses = Access.objects.filter(author_id=author_id)
+    if role is not None:
+        accesses = accesses.filter(role=role)
+    return keyset_page(accesses, after, limit)
+
+def activity_args(after: str, limit: str) -> Tuple[int, int]:
+    try:
+        after = None if after is None else int(after)
+        limit = settings.ACTIVITY_PAGE_SIZE if limit is None else int(limit)
+    except ValueError:
+        raise BizException("common.bad_request")
+    return after, min(max(limit, 1), settings.ACTIVITY_PAGE_MAX)
+
+def get_doc_activities(doc_id: int, after: str, limit: str, request_author: Author) -> Page:
+    '''
+    分页获取文档的操作记录, 从新到旧; 缓存中尚未写入的记录稍后才能查到
+    '''
+    after, limit = activity_args(after, limit)
+    doc = get_doc(doc_id, request_author)
+    return keyset_page(Activity.objects.filter(doc=doc), after, limit, descending=True)
+
+def get_author_activities(author_id: int, after: str, limit: str, request_author: Author) -> Page:
+    '''
+    分页获取用户自己的操作记录, 从新到旧
+    '''
+    after, limit = activity_args(after, limit)
+    if request_author is None or request_author.pk != author_id:
+        raise BizException("common.forbidden")
+    return keyset_page(Activity.objects.filter(author_id=author_id), after, limit, descending=True)
+
 def query_access(author_id: int, doc_id: int, request_author: Author) -> Access:
     '''
     查询权限
@@ -404,14 +739,22 @@ def search_doc(keywords: str, request_author: Author) -> QuerySet:
         result.extend(res)
     return result
 
-def search_message(keywords: str, request_author: Author) -> QuerySet:
+def search_message(keywords: str, before: str, request_author: Author) -> Tuple[List[Message], int]:
     '''
-    搜索聊天记录
+    搜索聊天记录, 归档段分批扫描, 范围见 archive.search; 第一批同时搜索热表,
+    返回的游标不为 None 时作为 before 继续搜索更早的归档段
     '''
+    try:
+        before = None if before is None else int(before)
+    except ValueError:
+        raise BizException("common.bad_request")
     if keywords.strip() == "":
-        return []
+        return [], None
+    archived, cursor = archive.search(request_author, keywords, before)
+    if before is not None:
+        return archived, cursor
     messages = Message.objects.filter(Q(sender=request_author)|Q(receiver=request_author))
-    return messages.filter(msg__icontains=keywords)
+    return archived + list(messages.filter(msg__icontains=keywords)), cursor
 
 def get_chat_by_id(chat_id: int, request_author: Author) -> Chat:
     '''
@@ -449,23 +792,36 @@ def send_message(sender_id: int, receiver_id: int, msg: str, request_author: Aut
     '''
     chat = get_or_create_chat(sender_id, receiver_id, request_author)[0]
     message = Message.objects.create(chat=chat, sender_id=sender_id, receiver_id=receiver_id, msg=msg)
+    stats.message_sent(message)
+    feed.publish([message.sender_id, message.receiver_id], "message", {
+        "id": message.pk, "chat_id": chat.pk, "sender_id": message.sender_id,
+        "receiver_id": message.receiver_id, "msg": message.msg, "time": message.time })
     return message
 
 def get_records(chat_id: int, page: int, page_size: int, request_author: Author) -> Message:
     '''
-    根据id列表分页地获取消息
+    根据id列表分页地获取消息, 热表中的消息不够一页时继续从归档中取
     '''
     chats = Chat.objects.filter(pk=chat_id)
     if len(chats) == 0:
         raise BizException("common.not_found")
     chat: Chat = chats[0]
-    rows = Message.objects.filter(chat=chat).values_list("id")
-    ids = [row[0] for row in rows]
-    ids.reverse()
-    ids = ids[page_size*page:page_size*(page+1)]
-    messages = Message.objects.filter(pk__in=ids).filter(Q(sender=request_author)|Q(receiver=request_author))
+    if page == 0 and request_author.pk in (chat.initiator_id, chat.recipient_id):
+        # 取到最新一页即视为已读
+        stats.chat_read(chat, request_author)
+    messages = archive.page(chat, page_size*page, page_size*(page+1))
+    messages = [message for message in messages if request_author.pk in (message.sender_id, message.receiver_id)]
+    messages.reverse()
     return messages
 
+def get_author_stats(author_id: int, request_author: Author) -> AuthorStats:
+    '''
+    获取用户工作区的统计, 只能查看自己的
+    '''
+    if request_author is None or request_author.pk != author_id:
+        raise BizException("common.forbidden")
+    return stats.get(author_id)
+
 def get_invite_link(doc_id: int, auth: str, request_author: Author) -> str:
     '''
     获取邀请链接
@@ -483,6 +839,168 @@ def get_invite_link(doc_id: int, auth: str, request_author: Author) -> str:
             token = tokens[0]
         else:
             token = CollaborateToken.objects.create(doc=doc)
+    if token.expired(settings.INVITE_TOKEN_TTL):
+        token.content = gen_token()
+        token.timestamp = now()
+        token.save()
     link = settings.FRONT_HOST + "/#/invite/{}/{}"
     link = link.format(doc_id, token.content)
     return link
+
+
+def groups_of(request_author: Author, group_ids: List[int] = None) -> List[GroupChat]:
+    '''
+    用户加入的群聊, 带上已读游标和未读数, 未读数按 (group, id) 索引统计
+    '''
+    unread = GroupMessage.objects.filter(group=OuterRef("group"), pk__gt=OuterRef("read_cursor")).order_by() \
+        .values("group").annotate(n=Count("*")).values("n")
+    memberships = GroupMember.objects.filter(author=request_author).select_related("group") \
+        .annotate(unread=Coalesce(Subquery(unread, output_field=IntegerField()), 0))
+    if group_ids is not None:
+        memberships = memberships.filter(group_id__in=group_ids)
+    groups = []
+    for membership in memberships.order_by("-group__time"):
+        group = membership.group
+        group.read_cursor = membership.read_cursor
+        group.unread = membership.unread
+        groups.append(group)
+    return groups
+
+def get_groups(request_author: Author) -> List[GroupChat]:
+    '''
+    获取用户的群聊列表
+    '''
+    if request_author is None:
+        raise BizException("common.forbidden")
+    return groups_of(request_author)
+
+def get_group(group_id: int, request_author: Author) -> GroupChat:
+    '''
+    获取群聊, 只有成员可以访问
+    '''
+    group = GroupChat.objects.filter(pk=group_id).first()
+    if group is None:
+        raise BizException("common.not_found")
+    if request_author is None or not GroupMember.objects.filter(group=group, author=request_author).exists():
+        raise BizException("chat.not_member")
+    return group
+
+def create_group(name: str, member_ids: List[int], request_author: Author) -> GroupChat:
+    '''
+    创建群聊, 创建者自动成为成员
+    '''
+    if request_author is None:
+        raise BizException("common.forbidden")
+    try:
+        member_ids = set(int(pk) for pk in member_ids or [])
+    except (TypeError, ValueError):
+        raise BizException("common.bad_request")
+    member_ids = set(Author.objects.filter(pk__in=member_ids).values_list("pk", flat=True)) | {request_author.pk}
+    with transaction.atomic():
+        group = GroupChat.objects.create(name=name or "", creator=request_author)
+        GroupMember.objects.bulk_create([GroupMember(group=group, author_id=pk) for pk in member_ids])
+    return groups_of(request_author, [group.pk])[0]
+
+def sync_group_members(group: GroupChat) -> Tuple[int, int]:
+    '''
+    按文档的权限批量同步群成员, 返回 (加入人数, 移除人数); 新成员从当前最后一条消息之后开始计算未读
+    '''
+    removed_count = 0
+    for attempt in range(settings.GROUP_SYNC_RETRIES):
+        wanted = set(Access.objects.filter(doc_id=group.doc_id).values_list("author_id", flat=True))
+        current = set(GroupMember.objects.filter(group=group).values_list("author_id", flat=True))
+        added, removed = wanted - current, current - wanted
+        if len(removed):
+            GroupMember.objects.filter(group=group, author_id__in=removed).delete()
+            removed_count += len(removed)
+        if len(added) == 0:
+            break
+        try:
+            with transaction.atomic():
+                GroupMember.objects.bulk_create([GroupMember(group=group, author_id=pk, read_cursor=group.last_message_id)
+                    for pk in added], batch_size=settings.GROUP_SYNC_BATCH)
+            return len(added), removed_count
+        except IntegrityError:
+            # 并发的同步或权限变化已经加入了其中一部分成员, 重新计算差集
+            logger.info("group %s member sync conflict, attempt %s", group.pk, attempt + 1)
+    else:
+        raise BizException("common.busy")
+    return 0, removed_count
+
+def get_doc_group(doc_id: int, request_author: Author) -> GroupChat:
+    '''
+    获取文档的群聊, 没有则创建并从文档的权限同步成员
+    '''
+    doc = get_doc(doc_id, request_author)
+    group, created = GroupChat.objects.get_or_create(doc=doc, defaults={"name": doc.label, "creator": doc.get_creator()})
+    if created:
+        sync_group_members(group)
+    groups = groups_of(request_author, [group.pk])
+    if len(groups) == 0:
+        # 能读文档但没有权限记录, 例如公开的文档
+        raise BizException("chat.not_member")
+    return groups[0]
+
+def send_group_message(group_id: int, msg: str, request_author: Author) -> GroupMessage:
+    '''
+    发送群消息, 消息只写入一次, 与成员人数无关
+    '''
+    if msg is None:
+        raise BizException("common.bad_request")
+    group = get_group(group_id, request_author)
+    message = GroupMessage.objects.create(group=group, sender=request_author, msg=msg)
+    GroupChat.objects.filter(pk=group.pk, last_message_id__lt=message.pk).update(last_message_id=message.pk, time=message.time)
+    GroupMember.objects.filter(group=group, author=request_author, read_cursor__lt=message.pk).update(read_cursor=message.pk)
+    return message
+
+def get_group_messages(group_id: int, before: str, after: str, limit: str, request_author: Author) -> List[GroupMessage]:
+    '''
+    按 id 分页获取群消息: after 取之后的新消息, 否则取 before 之前 (默认最新) 的一页, 均按 id 升序返回
+    '''
+    try:
+        before = None if before is None else int(before)
+        after = None if after is None else int(after)
+        limit = settings.GROUP_PAGE_SIZE if limit is None else int(limit)
+    except ValueError:
+        raise BizException("common.bad_request")
+    limit = min(max(limit, 1), settings.GROUP_PAGE_MAX)
+    group = get_group(group_id, request_author)
+    messages = GroupMessage.objects.filter(group=group)
+    if after is not None:
+        return list(messages.filter(pk__gt=after).order_by("pk")[:limit])
+    if before is not None:
+        messages = messages.filter(pk__lt=before)
+    messages = list(messages.order_by("-pk")[:limit])
+    messages.reverse()
+    return messages
+
+def mark_group_read(group_id: int, message_id: int, request_author: Author) -> GroupChat:
+    '''
+    已读游标只前进不后退, 不超过群里最后一条消息
+    '''
+    try:
+        message_id = int(message_id)
+    except (TypeError, ValueError):
+        raise BizException("common.bad_request")
+    group = get_group(group_id, request_author)
+    cursor = min(message_id, group.last_message_id)
+    GroupMember.objects.filter(group=group, author=request_author, read_cursor__lt=cursor).update(read_cursor=cursor)
+    return groups_of(request_author, [group.pk])[0]
+
+def sweep_expired_tokens(chunk_size: int = settings.TOKEN_SWEEP_CHUNK) -> Dict:
+    '''
+    分批删除过期的登录令牌、邀请令牌和幂等记录, 每批只锁定少量行
+    '''
+    swept = {}
+    for model, ttl in ((Token, settings.TOKEN_TTL), (ReadToken, settings.INVITE_TOKEN_TTL), (CollaborateToken, settings.INVITE_TOKEN_TTL),
+            (IdempotencyRecord, settings.IDEMPOTENCY_TTL)):
+        deadline = now() - ttl
+        count = 0
+        while True:
+            pks = list(model.objects.filter(timestamp__lt=deadline).values_list("pk", flat=True)[:chunk_size])
+            if len(pks) == 0:
+                break
+            model.objects.filter(pk__in=pks).delete()
+            count += len(pks)
+        swept[model.__name__] = count
+    return swept
\ No newline at end of file
@@ -0,0 +1,301 @@
+import os
+import json
+import uuid
+import atexit
+import socket
+import logging
+import threading
+from time import time
+from typing import Callable, Dict, List, Optional
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_started
+from doc_server import settings
+
+logger = logging.getLogger(__name__)
+
+# 每个数据报最多携带的事件数, 保证消息大小远小于 UNIX 数据报的上限
+BATCH = 256
+
+
+class SocketTransport:
+    '''
+    本机广播: 每个进程在 BUS_DIR 中绑定一个 UNIX 数据报套接字, 发送时逐个写入其他进程的套接字;
+    不依赖外部服务, 只能覆盖同一台机器上的 worker
+    '''
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, "{}.sock".format(os.getpid()))
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.sock.bind(self.path)
+        self.sock.settimeout(settings.BUS_STATS_INTERVAL)
+        # 发送不阻塞, 对方缓冲区满时算作丢弃, 由接收方通过序号发现
+        self.out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.out.setblocking(False)
+
+    def send(self, data: bytes) -> int:
+        failed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".sock") or path == self.path:
+                continue
+            try:
+                self.out.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # 进程已经退出, 清理留下的套接字文件
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            except OSError:
+                failed += 1
+        return failed
+
+    def receive(self) -> Optional[bytes]:
+        try:
+            return self.sock.recv(1 << 20)
+        except socket.timeout:
+            return None
+
+    def close(self) -> None:
+        self.sock.close()
+        self.out.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class RedisTransport:
+    '''
+    通过 Redis 发布订阅广播, 可以覆盖多台机器; 需要安装 redis 包
+    '''
+
+    def __init__(self, url: str, channel: str):
+        try:
+            import redis
+        except ImportError:
+            raise ImproperlyConfigured("BUS_TRANSPORT = 'redis' requires the redis package")
+        self.channel = channel
+        self.client = redis.Redis.from_url(url)
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(channel)
+
+    def send(self, data: bytes) -> int:
+        try:
+            self.client.publish(self.channel, data)
+            return 0
+        except Exception:
+            logger.warning("failed to publish invalidation", exc_info=True)
+            return 1
+
+    def receive(self) -> Optional[bytes]:
+        try:
+            message = self.pubsub.get_message(timeout=settings.BUS_STATS_INTERVAL)
+        except Exception:
+            logger.warning("invalidation subscription failed", exc_info=True)
+            # 断线期间的消息已经丢失, 重新订阅后由序号检查触发清空
+            self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(self.channel)
+            return None
+        return None if message is None else message["data"]
+
+    def close(self) -> None:
+        self.pubsub.close()
+
+
+class Bus:
+    '''
+    写操作提交后发布 (model, pk, version) 事件, 每个进程的监听线程收到后淘汰本进程缓存中的对应项;
+    每个发送方的消息带递增序号, 接收方发现序号跳跃说明有消息丢失, 此时清空本地缓存
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handlers = {}
+        self.resets = []
+        self.pid = None
+        self.transport = None
+        self.sender = None
+        self.seq = 0
+        self.last_seq = {}
+        self.counters = {}
+
+    def subscribe(self, model: str, handler: Callable[[Dict], None]) -> None:
+        self.handlers.setdefault(model, []).append(handler)
+
+    def on_reset(self, handler: Callable[[], None]) -> None:
+        self.resets.append(handler)
+
+    def start(self) -> bool:
+        if settings.BUS_TRANSPORT is None:
+            return False
+        with self.lock:
+            if self.pid == os.getpid():
+                return True
+            # fork 出来的 worker 不继承父进程的监听线程, 需要重新建立
+            if settings.BUS_TRANSPORT == "socket":
+                self.transport = SocketTransport(settings.BUS_DIR)
+            elif settings.BUS_TRANSPORT == "redis":
+                self.transport = RedisTransport(settings.BUS_REDIS_URL, settings.BUS_CHANNEL)
+            else:
+                raise ImproperlyConfigured("unknown BUS_TRANSPORT {!r}".format(settings.BUS_TRANSPORT))
+            self.pid = os.getpid()
+            self.sender = "{}-{}-{}".format(socket.gethostname(), self.pid, uuid.uuid4().hex[:8])
+            self.seq = 0
+            self.last_seq = {}
+            self.counters = {
+                "published": 0,
+                "messages": 0,
+                "send_failures": 0,
+                "received": 0,
+                "dropped": 0,
+                "resets": 0,
+                "lag_count": 0,
+                "lag_total": 0.0,
+                "lag_max": 0.0,
+            }
+            threading.Thread(target=self.listen, args=(self.transport,), name="doc-bus", daemon=True).start()
+            atexit.register(self.stop)
+            return True
+
+    def stop(self) -> None:
+        with self.lock:
+            if self.pid != os.getpid():
+                return
+            self.transport.close()
+            self.pid = None
+        try:
+            os.unlink(self.stats_path())
+        except FileNotFoundError:
+            pass
+
+    def publish(self, model: str, versions: Dict) -> None:
+        '''
+        versions 是 {pk: version}, 本进程的缓存由调用方自己更新, 不会收到自己发出的事件
+        '''
+        if len(versions) == 0 or not self.start():
+            return
+        events = [[model, pk, version] for pk, version in versions.items()]
+        for i in range(0, len(events), BATCH):
+            with self.lock:
+                self.seq += 1
+                data = json.dumps({"s": self.sender, "n": self.seq, "t": time(), "e": events[i:i + BATCH]})
+            failed = self.transport.send(data.encode("utf-8"))
+            with self.lock:
+                self.counters["published"] += len(events[i:i + BATCH])
+                self.counters["messages"] += 1
+                self.counters["send_failures"] += failed
+
+    def listen(self, transport) -> None:
+        last_report = time()
+        while self.pid == os.getpid() and self.transport is transport:
+            try:
+                data = transport.receive()
+            except OSError:
+                return
+            if data is not None:
+                try:
+                    self.deliver(json.loads(data))
+                except Exception:
+                    logger.error("failed to apply invalidation", exc_info=True)
+            if time() - last_report >= settings.BUS_STATS_INTERVAL:
+                last_report = time()
+                self.report()
+
+    def deliver(self, message: Dict) -> None:
+        sender, seq = message["s"], message["n"]
+        if sender == self.sender:
+            return
+        lag = max(0.0, time() - message["t"])
+        with self.lock:
+            last = self.last_seq.get(sender)
+            if last is not None and seq <= last:
+                return
+            self.last_seq[sender] = seq
+            lost = 0 if last is None else seq - last - 1
+            self.counters["received"] += len(message["e"])
+            self.counters["dropped"] += lost
+            self.counters["lag_count"] += 1
+            self.counters["lag_total"] += lag
+            self.counters["lag_max"] = max(self.counters["lag_max"], lag)
+        if lost > 0:
+            # 不知道丢失的消息涉及哪些对象, 只能全部淘汰
+            logger.warning("lost %d invalidation messages from %s, resetting local caches", lost, sender)
+            self.reset()
+        grouped = {}
+        for model, pk, version in message["e"]:
+            grouped.setdefault(model, {})[pk] = version
+        for model, versions in grouped.items():
+            for handler in self.handlers.get(model, []):
+                handler(versions)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters["resets"] += 1
+        for handler in self.resets:
+            handler()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            result = dict(self.counters)
+        lag_count = result.pop("lag_count", 0)
+        lag_total = result.pop("lag_total", 0.0)
+        result["lag_avg_ms"] = lag_total * 1000 / lag_count if lag_count else 0.0
+        result["lag_max_ms"] = result.pop("lag_max", 0.0) * 1000
+        result["sender"] = self.sender
+        result["transport"] = settings.BUS_TRANSPORT
+        result["time"] = time()
+        return result
+
+    def stats_path(self) -> str:
+        return os.path.join(settings.BUS_DIR, "stats", "{}.json".format(self.sender))
+
+    def report(self) -> None:
+        '''
+        每个进程定期把自己的统计写到 BUS_DIR/stats 下, 由 bus_stats 命令汇总
+        '''
+        path = self.stats_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.stats(), f)
+        os.replace(path + ".tmp", path)
+
+
+bus = Bus()
+subscribe = bus.subscribe
+on_reset = bus.on_reset
+publish = bus.publish
+
+
+def read_stats() -> List[Dict]:
+    directory = os.path.join(settings.BUS_DIR, "stats")
+    if not os.path.isdir(directory):
+        return []
+    result = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                result.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return result
+
+
+def _request_started(sender, **kwargs):
+    bus.start()
+
+
+def install() -> None:
+    '''
+    每个 worker 处理第一个请求时开始监听, 在 fork 之前启动的线程不会被 worker 继承
+    '''
+    if settings.BUS_TRANSPORT is None:
+        return
+    request_started.connect(_request_started)
@@ -0,0 +1,269 @@
+import re
+import json
+from typing import Dict, List, NamedTuple, Set
+
+# 文档树的 JSON 按词法单元流式处理, 用显式的栈代替递归, 嵌套深度只受内存限制
+TOKEN = re.compile(r'[ \t\n\r]*(?:([{}\[\],:])|("[^"\\\x00-\x1f]*(?:\\.[^"\\\x00-\x1f]*)*")|'
+    r'(-?(?:0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?)|(true|false|null))')
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# 栈帧的类型: 树节点, 节点的 children, 节点中其他字段的普通对象和数组
+NODE, CHILDREN, OBJECT, ARRAY = range(4)
+
+# 下一个词法单元应该是: 值, 键或 }, 键, 冒号, 逗号或结束符号
+VALUE, KEY_OR_END, KEY, COLON, NEXT = range(5)
+
+
+class DocTreeError(ValueError):
+    pass
+
+
+class Tree(NamedTuple):
+    content: str
+    doc_ids: Set[int]
+    nodes: int
+    folders: int
+    depth: int
+
+
+class Frame:
+    __slots__ = ["kind", "start", "count", "key", "id", "original", "folder", "keys"]
+
+    def __init__(self, kind: int, start: int):
+        self.kind = kind
+        self.start = start
+        self.count = 0
+        self.key = None
+        self.id = None
+        self.original = None
+        self.folder = False
+        self.keys = None
+
+
+def _scalar(m) -> tuple:
+    '''
+    返回 (规范化后的 JSON 文本, Python 值), 与 json.dumps(ensure_ascii=False) 的输出一致
+    '''
+    s = m.group(2)
+    if s is not None:
+        if "\\" not in s:
+            return s, s[1:-1]
+        value = json.loads(s)
+        return json.dumps(value, ensure_ascii=False), value
+    n = m.group(3)
+    if n is not None:
+        if m.group(4) is None and m.group(5) is None:
+            return n, int(n)
+        value = float(n)
+        return json.dumps(value), value
+    word = m.group(6)
+    return word, {"true": True, "false": False, "null": None}[word]
+
+
+def _doc_id(value):
+    '''
+    文档 id 应该是整数, 早期保存的树中也有数字字符串形式的 id, 原样保留, 统计时按整数处理
+    '''
+    if type(value) is int:
+        return value
+    if type(value) is str and value.isascii() and value.isdigit():
+        return int(value)
+    return None
+
+
+def walk(root: Dict, trim: bool = True, extra: Dict[str, Dict] = None) -> Tree:
+    '''
+    已经解析好的树用显式的栈遍历, 结果与 stream 相同
+    '''
+    if type(root) is not dict or type(root.get("children", None)) is not dict:
+        raise DocTreeError("root must have children")
+    added = {key: node for key, node in (extra or {}).items() if key not in root["children"]}
+    doc_ids = set()
+    nodes = folders = depth = 0
+    stack = [(root, 1)]
+    while stack:
+        node, level = stack.pop()
+        nodes += 1
+        depth = max(depth, level)
+        if "children" in node:
+            children = node["children"]
+            if type(children) is not dict:
+                raise DocTreeError("tree nodes and children must be objects")
+            folders += 1
+            for child in children.values():
+                if type(child) is not dict:
+                    raise DocTreeError("tree nodes and children must be objects")
+                stack.append((child, level + 1))
+        else:
+            id = node.get("id", None)
+            if _doc_id(id) is None:
+                raise DocTreeError("doc node without integer id")
+            doc_ids.add(_doc_id(id))
+            if trim:
+                original = node.get("original", False)
+                node.clear()
+                node["id"] = id
+                node["original"] = original
+    # 追加的节点原样写入, 与 stream 一致
+    root["children"].update(added)
+    for node in added.values():
+        if "children" not in node:
+            doc_ids.add(node["id"])
+            nodes += 1
+    return Tree(json.dumps(root, ensure_ascii=False), doc_ids, nodes, folders, depth)
+
+
+def stream(content: str, trim: bool = True, extra: Dict[str, Dict] = None) -> Tree:
+    '''
+    按词法单元流式处理, 一次遍历完成校验、裁剪和统计: trim 时文档节点只保留 id 和 original;
+    extra 中的节点追加到根节点的 children 中, 已经存在的键不覆盖
+    '''
+    # 输出写入同一个列表, 裁剪文档节点时截掉它的部分, 不会逐层拼接字符串
+    out: List[str] = []
+    stack: List[Frame] = []
+    doc_ids = set()
+    nodes = folders = depth = node_depth = 0
+    expect = VALUE
+    done = False
+    pos = 0
+    match = TOKEN.match
+    while not done:
+        m = match(content, pos)
+        if m is None:
+            break
+        pos = m.end()
+        punct = m.group(1)
+        top = stack[-1] if stack else None
+        if expect == COLON:
+            if punct != ":":
+                raise DocTreeError("expected ':' at {}".format(pos))
+            expect = VALUE
+            continue
+        if expect == NEXT:
+            if punct == ",":
+                expect = VALUE if top.kind == ARRAY else KEY
+                continue
+            if punct != ("]" if top.kind == ARRAY else "}"):
+                raise DocTreeError("expected ',' or closing bracket at {}".format(pos))
+        elif expect != VALUE:
+            if punct == "}" and expect == KEY_OR_END:
+                pass
+            elif m.group(2) is None:
+                raise DocTreeError("expected a key at {}".format(pos))
+            else:
+                text, key = _scalar(m)
+                if top.count:
+                    out.append(", ")
+                top.count += 1
+                top.key = key
+                if top.keys is not None:
+                    top.keys.add(key)
+                out.append(text)
+                out.append(": ")
+                expect = COLON
+                continue
+        elif punct in ("}", ",", ":") or (punct == "]" and (top is None or top.kind != ARRAY or top.count)):
+            raise DocTreeError("unexpected '{}' at {}".format(punct, pos))
+
+        if punct is None or punct in ("{", "["):
+            if top is None or top.kind == CHILDREN:
+                kind = NODE
+            elif top.kind == NODE and top.key == "children":
+                kind = CHILDREN
+            else:
+                kind = OBJECT
+            if punct != "{" and kind != OBJECT:
+                raise DocTreeError("tree nodes and children must be objects, at {}".format(pos))
+            if top is not None and top.kind == ARRAY:
+                if top.count:
+                    out.append(", ")
+                top.count += 1
+
+        # 开始一个容器
+        if punct in ("{", "["):
+            frame = Frame(ARRAY if punct == "[" else kind, len(out))
+            if kind == NODE:
+                node_depth += 1
+                depth = max(depth, node_depth)
+            elif kind == CHILDREN and len(stack) == 1:
+                frame.keys = set()
+            stack.append(frame)
+            out.append(punct)
+            expect = VALUE if punct == "[" else KEY_OR_END
+            continue
+
+        if punct is None:
+            # 标量
+            text, value = _scalar(m)
+            if top.kind == NODE:
+                if top.key == "id":
+                    if _doc_id(value) is None:
+                        raise DocTreeError("doc id must be an integer, at {}".format(pos))
+                    top.id = value
+                elif top.key == "original":
+                    top.original = text
+            out.append(text)
+        else:
+            # 容器结束
+            frame = stack.pop()
+            if frame.kind == CHILDREN:
+                if frame.keys is not None and extra:
+                    for key, node in extra.items():
+                        if key in frame.keys:
+                            continue
+                        if frame.count:
+                            out.append(", ")
+                        frame.count += 1
+                        out.append("{}: {}".format(json.dumps(key, ensure_ascii=False), json.dumps(node, ensure_ascii=False)))
+                        if "children" not in node:
+                            doc_ids.add(node["id"])
+                            nodes += 1
+                stack[-1].folder = True
+            out.append(punct)
+            if stack and stack[-1].kind == NODE and stack[-1].key == "original":
+                stack[-1].original = "".join(out[frame.start:])
+            if frame.kind == NODE:
+                node_depth -= 1
+                nodes += 1
+                if frame.folder:
+                    folders += 1
+                elif not stack:
+                    raise DocTreeError("root must have children")
+                elif frame.id is None:
+                    raise DocTreeError("doc node without id, at {}".format(pos))
+                else:
+                    doc_ids.add(_doc_id(frame.id))
+                    if trim:
+                        del out[frame.start:]
+                        out.append('{{"id": {}, "original": {}}}'.format(json.dumps(frame.id), frame.original or "false"))
+        if not stack:
+            done = True
+        expect = NEXT
+
+    if not done or WHITESPACE.match(content, pos).end() != len(content):
+        raise DocTreeError("invalid doc tree at {}".format(pos))
+    return Tree("".join(out), doc_ids, nodes, folders, depth)
+
+
+def process(content: str, trim: bool = True, extra: Dict[str, Dict] = None) -> Tree:
+    '''
+    一般的树用 C 实现的 json 解析后遍历, 嵌套超过解释器递归深度的树改为流式处理
+    '''
+    try:
+        root = json.loads(content)
+    except RecursionError:
+        return stream(content, trim, extra)
+    except ValueError:
+        raise DocTreeError("invalid doc tree")
+    try:
+        return walk(root, trim, extra)
+    except RecursionError:
+        return stream(content, trim, extra)
+
+
+def trim(content: str) -> str:
+    return process(content).content
+
+
+def doc_ids(content: str) -> Set[int]:
+    return process(content, trim=False).doc_ids
@@ -0,0 +1,219 @@
+import json
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, Iterable, Iterator, List
+from django.db import close_old_connections, transaction
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import JSONRenderer
+from doc_server import settings
+from doc.models import FeedEvent
+from doc.responses import payload
+from doc.utils import now
+
+# 只执行异步等待中的短查询, 等待本身不占用任何线程
+fetcher = ThreadPoolExecutor(max_workers=settings.FEED_FETCH_THREADS, thread_name_prefix="doc-feed")
+
+
+def _wake(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(True)
+
+
+class Channel:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+        self.subscribers = 0
+        self.futures = set()
+
+    def bump(self) -> None:
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+            futures = list(self.futures)
+        for loop, future in futures:
+            loop.call_soon_threadsafe(_wake, future)
+
+    def wait(self, seen: int, timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: self.version != seen, timeout)
+
+    async def wait_async(self, seen: int, timeout: float) -> bool:
+        loop = asyncio.get_event_loop()
+        waiter = (loop, loop.create_future())
+        with self.condition:
+            if self.version != seen:
+                return True
+            self.futures.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1], timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.condition:
+                self.futures.discard(waiter)
+
+
+class Hub:
+    '''
+    进程内的订阅中心, 只负责唤醒等待中的连接, 事件本身以自增序号保存在 FeedEvent 中
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels: Dict[int, Channel] = {}
+
+    @contextmanager
+    def subscribe(self, author_id: int):
+        with self.lock:
+            channel = self.channels.setdefault(author_id, Channel())
+            channel.subscribers += 1
+        try:
+            yield channel
+        finally:
+            with self.lock:
+                channel.subscribers -= 1
+                if channel.subscribers == 0:
+                    del self.channels[author_id]
+
+    def notify(self, author_ids: Iterable[int]) -> None:
+        with self.lock:
+            channels = [self.channels[pk] for pk in author_ids if pk in self.channels]
+        for channel in channels:
+            channel.bump()
+
+
+hub = Hub()
+
+
+class FeedResponse(StreamingHttpResponse):
+    '''
+    WSGI 下由请求线程迭代 content 阻塞等待; ASGI 入口发现 async_content 时释放请求线程, 改在事件循环中等待
+    '''
+
+    def __init__(self, content: Iterator[bytes], async_content: AsyncIterator[bytes], **kwargs):
+        super().__init__(content, **kwargs)
+        self.async_content = async_content
+
+
+def publish(author_ids: Iterable[int], kind: str, data: Dict) -> None:
+    author_ids = [pk for pk in set(author_ids) if pk is not None]
+    content = json.dumps(data, ensure_ascii=False)
+    FeedEvent.objects.bulk_create([FeedEvent(author_id=pk, kind=kind, payload=content) for pk in author_ids])
+    # 提交之后才唤醒, 否则被唤醒的连接可能还读不到这些事件
+    transaction.on_commit(lambda: hub.notify(author_ids))
+
+
+def latest_cursor(author_id: int) -> int:
+    return FeedEvent.objects.filter(author_id=author_id).order_by("-pk").values_list("pk", flat=True).first() or 0
+
+
+def fetch(author_id: int, cursor: int, limit: int = settings.FEED_BATCH) -> List[FeedEvent]:
+    return list(FeedEvent.objects.filter(author_id=author_id, pk__gt=cursor).order_by("pk")[:limit])
+
+
+def poll(author_id: int, cursor: int, timeout: float) -> List[FeedEvent]:
+    '''
+    没有新事件时挂起等待, 同进程的发布会立即唤醒; 其他进程的发布在下次复查时取到
+    '''
+    deadline = time.time() + timeout
+    with hub.subscribe(author_id) as channel:
+        while True:
+            # 先记下版本再查询, 查询之后的发布一定能唤醒等待
+            seen = channel.version
+            events = fetch(author_id, cursor)
+            remaining = deadline - time.time()
+            if len(events) or remaining <= 0:
+                return events
+            channel.wait(seen, min(remaining, settings.FEED_RECHECK_INTERVAL))
+
+
+def _fetch(author_id: int, cursor: int) -> List[FeedEvent]:
+    close_old_connections()
+    try:
+        return fetch(author_id, cursor)
+    finally:
+        close_old_connections()
+
+
+async def poll_async(author_id: int, cursor: int, timeout: float) -> List[FeedEvent]:
+    '''
+    与 poll 相同, 但在事件循环中等待, 只有复查时的查询用到 fetcher 线程
+    '''
+    loop = asyncio.get_event_loop()
+    deadline = time.time() + timeout
+    with hub.subscribe(author_id) as channel:
+        while True:
+            seen = channel.version
+            events = await loop.run_in_executor(fetcher, _fetch, author_id, cursor)
+            remaining = deadline - time.time()
+            if len(events) or remaining <= 0:
+                return events
+            await channel.wait_async(seen, min(remaining, settings.FEED_RECHECK_INTERVAL))
+
+
+def to_dict(event: FeedEvent) -> Dict:
+    return {"id": event.pk, "kind": event.kind, "payload": json.loads(event.payload), "time": event.time}
+
+
+def page(cursor: int, events: List[FeedEvent]) -> bytes:
+    if len(events):
+        cursor = events[-1].pk
+    body, _ = payload("common.success", {"cursor": cursor, "events": [to_dict(event) for event in events]})
+    return JSONRenderer().render(body)
+
+
+def poll_body(author_id: int, cursor: int, timeout: float) -> Iterator[bytes]:
+    yield page(cursor, poll(author_id, cursor, timeout))
+
+
+async def poll_body_async(author_id: int, cursor: int, timeout: float) -> AsyncIterator[bytes]:
+    yield page(cursor, await poll_async(author_id, cursor, timeout))
+
+
+def frames(events: List[FeedEvent]) -> bytes:
+    return "".join("id: {}\nevent: {}\ndata: {}\n\n".format(event.pk, event.kind, json.dumps(to_dict(event), ensure_ascii=False))
+        for event in events).encode("utf-8")
+
+
+def stream(author_id: int, cursor: int) -> Iterator[bytes]:
+    '''
+    Server-Sent Events, 空闲时发送注释行作为心跳, 超过 FEED_STREAM_DURATION 后结束以便客户端重连
+    '''
+    deadline = time.time() + settings.FEED_STREAM_DURATION
+    yield "retry: 1000\n\n".encode("utf-8")
+    while time.time() < deadline:
+        events = poll(author_id, cursor, min(settings.FEED_LONG_POLL_TIMEOUT, deadline - time.time()))
+        if len(events) == 0:
+            yield ": ping\n\n".encode("utf-8")
+            continue
+        yield frames(events)
+        cursor = events[-1].pk
+
+
+async def stream_async(author_id: int, cursor: int) -> AsyncIterator[bytes]:
+    deadline = time.time() + settings.FEED_STREAM_DURATION
+    yield "retry: 1000\n\n".encode("utf-8")
+    while time.time() < deadline:
+        events = await poll_async(author_id, cursor, min(settings.FEED_LONG_POLL_TIMEOUT, deadline - time.time()))
+        if len(events) == 0:
+            yield ": ping\n\n".encode("utf-8")
+            continue
+        yield frames(events)
+        cursor = events[-1].pk
+
+
+def sweep(retention: int = settings.FEED_RETENTION, chunk_size: int = settings.TOKEN_SWEEP_CHUNK) -> int:
+    deadline = now() - retention
+    swept = 0
+    while True:
+        pks = list(FeedEvent.objects.filter(time__lt=deadline).values_list("pk", flat=True)[:chunk_size])
+        if len(pks) == 0:
+            return swept
+        FeedEvent.objects.filter(pk__in=pks).delete()
+        swept += len(pks)
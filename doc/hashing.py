@@ -0,0 +1,104 @@
+import os
+import logging
+import threading
+import multiprocessing
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Tuple
+from django.contrib.auth import hashers
+from doc_server import settings
+from doc.exceptions import BizException
+
+logger = logging.getLogger(__name__)
+
+
+def _make(raw_password: str) -> str:
+    return hashers.make_password(raw_password)
+
+
+def _check(raw_password: str, encoded: str) -> bool:
+    return hashers.check_password(raw_password, encoded)
+
+
+class HashPool:
+    '''
+    PBKDF2 等哈希是纯 CPU 计算, 放到独立进程中执行, 请求线程等待期间释放 GIL;
+    pending 是已提交未完成的任务数, 超过 HASH_QUEUE_MAX 时直接拒绝
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+        self.pending = 0
+        self.peak = 0
+        self.completed = 0
+        self.wait_time = 0.0
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.pid != os.getpid():
+                # 不能使用 fork, 多线程进程 fork 出的子进程可能继承被占用的锁
+                context = multiprocessing.get_context(settings.HASH_START_METHOD)
+                self.executor = ProcessPoolExecutor(max_workers=settings.HASH_PROCESSES, mp_context=context)
+                self.pid = os.getpid()
+            return self.executor
+
+    def run(self, func, *args):
+        if settings.HASH_PROCESSES <= 0:
+            return func(*args)
+        executor = self.get_executor()
+        with self.lock:
+            if self.pending >= settings.HASH_QUEUE_MAX:
+                raise BizException("common.busy")
+            self.pending += 1
+            self.peak = max(self.peak, self.pending)
+            depth = self.pending
+        if depth > settings.HASH_QUEUE_WARN:
+            logger.warning("password hash queue depth %d", depth)
+        started = perf_counter()
+        try:
+            return executor.submit(func, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+                self.completed += 1
+                self.wait_time += perf_counter() - started
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {
+                "pending": self.pending,
+                "peak": self.peak,
+                "completed": self.completed,
+                "avg_ms": self.wait_time * 1000 / self.completed if self.completed else 0.0,
+            }
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.peak = self.pending
+            self.completed = 0
+            self.wait_time = 0.0
+
+
+pool = HashPool()
+
+
+def make_password(raw_password: str) -> str:
+    return pool.run(_make, raw_password)
+
+
+def check_password(raw_password: str, encoded: str) -> Tuple[bool, bool]:
+    '''
+    返回 (密码是否正确, 是否需要用当前的哈希参数重新哈希)
+    '''
+    if raw_password is None or not encoded:
+        return False, False
+    if not pool.run(_check, raw_password, encoded):
+        return False, False
+    try:
+        hasher = hashers.identify_hasher(encoded)
+    except ValueError:
+        return True, False
+    preferred = hashers.get_hasher("default")
+    return True, hasher.algorithm != preferred.algorithm or preferred.must_update(encoded)
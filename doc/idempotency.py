@@ -0,0 +1,99 @@
+import json
+from hashlib import md5
+from typing import Optional, Tuple
+from django.db import IntegrityError, transaction
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from doc_server import settings
+from doc.exceptions import BizException
+from doc.models import Author, IdempotencyRecord
+from doc.responses import resp
+from doc.utils import now
+from doc import tokens
+
+HEADER = "HTTP_IDEMPOTENCY_KEY"
+REPLAYED = "Idempotent-Replayed"
+
+
+def fingerprint(endpoint: str, request) -> str:
+    # 令牌不参与比较, 重新登录后用同一个 key 重试仍然有效
+    params = {k: v for k, v in request.query_params.lists() if k != "token"}
+    payload = json.dumps([endpoint, params, request.data], sort_keys=True, cls=JSONEncoder)
+    return md5(payload.encode("utf-8")).hexdigest()
+
+
+def claim(author: Author, key: str, endpoint: str, digest: str) -> Tuple[Optional[IdempotencyRecord], Optional[int]]:
+    '''
+    插入一条处理中的记录, 返回 (None, 时间戳) 表示由当前请求执行, 之后只能修改仍是这个时间戳的记录;
+    已经有记录时返回 (该记录, None)
+    '''
+    while True:
+        try:
+            with transaction.atomic():
+                record = IdempotencyRecord.objects.create(author=author, key=key, endpoint=endpoint, fingerprint=digest)
+            return None, record.timestamp
+        except IntegrityError:
+            pass
+        record = IdempotencyRecord.objects.filter(author=author, key=key).first()
+        if record is None:
+            # 记录刚好被清理, 重新插入
+            continue
+        current = now()
+        expired = current - record.timestamp > settings.IDEMPOTENCY_TTL
+        abandoned = record.status is None and current - record.timestamp > settings.IDEMPOTENCY_LOCK_TIMEOUT
+        if not expired and not abandoned:
+            return record, None
+        # 过期或处理者已经崩溃的记录, 条件更新保证并发的重试中只有一个接管
+        taken = IdempotencyRecord.objects.filter(pk=record.pk, timestamp=record.timestamp).update(
+            endpoint=endpoint, fingerprint=digest, status=None, response="", timestamp=current)
+        if taken:
+            return None, current
+        raise BizException("idempotency.in_progress")
+
+
+def replay(record: IdempotencyRecord, endpoint: str, digest: str) -> Response:
+    if record.endpoint != endpoint or record.fingerprint != digest:
+        return resp("idempotency.mismatch")
+    if record.status is None:
+        return resp("idempotency.in_progress")
+    response = Response(json.loads(record.response), status=record.status)
+    response[REPLAYED] = "true"
+    return response
+
+
+def idempotent(func):
+    '''
+    带 Idempotency-Key 请求头的请求按 (用户, key) 只执行一次, 重试直接返回保存的响应, 不再执行业务逻辑和序列化;
+    失败的请求没有修改数据, 删除记录后允许重试
+    '''
+    def wrapper(view, request, *args, **kwargs):
+        key = request.META.get(HEADER, None)
+        if key is None:
+            return func(view, request, *args, **kwargs)
+        author = tokens.request_author(request)
+        if author is None:
+            return func(view, request, *args, **kwargs)
+        key = key.strip()
+        if len(key) == 0 or len(key) > IdempotencyRecord._meta.get_field("key").max_length:
+            return resp("idempotency.invalid_key")
+        endpoint = "{}.{}".format(type(view).__name__, request.method.lower())
+        digest = fingerprint(endpoint, request)
+        try:
+            record, claimed = claim(author, key, endpoint, digest)
+        except BizException as e:
+            return resp(*e.args)
+        if record is not None:
+            return replay(record, endpoint, digest)
+        # 处理太慢时记录可能已经被重试接管, 只修改自己持有的记录
+        released = IdempotencyRecord.objects.filter(author=author, key=key, status__isnull=True, timestamp=claimed)
+        try:
+            response = func(view, request, *args, **kwargs)
+        except BaseException:
+            released.delete()
+            raise
+        if response.status_code < 300 and response.data.get("error", None) == 0:
+            released.update(status=response.status_code, response=json.dumps(response.data, cls=JSONEncoder))
+        else:
+            released.delete()
+        return response
+    return wrapper
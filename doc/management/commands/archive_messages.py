@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+from doc_server import settings
+from doc import archive
+
+
+class Command(BaseCommand):
+    help = "Move chat messages older than the archive age into compressed per-chat segments"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--age", type=int, default=settings.MESSAGE_ARCHIVE_AGE,
+            help="archive messages older than AGE ms")
+        parser.add_argument("--batch-size", type=int, default=settings.MESSAGE_ARCHIVE_BATCH)
+        parser.add_argument("--max-batches", type=int, default=0,
+            help="stop after this many batches, 0 means until nothing is left")
+        parser.add_argument("--interval", type=int, default=0,
+            help="keep running and archive every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        while True:
+            archived = archive.archive_messages(options["age"], options["batch_size"], options["max_batches"])
+            self.stdout.write("archived {} messages".format(archived))
+            if options["interval"] <= 0:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,65 @@
+import json
+import random
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from doc import doctree
+
+
+def wide_tree(nodes: int, folder_ratio: float, seed: int) -> str:
+    r = random.Random(seed)
+    root = {"children": {}}
+    folders = [root]
+    for i in range(nodes):
+        parent = r.choice(folders)
+        if r.random() < folder_ratio:
+            node = {"children": {}}
+            folders.append(node)
+        else:
+            node = {"id": i + 1, "original": r.random() < 0.5, "label": "doc-{}".format(i)}
+        parent["children"]["{:032x}".format(r.getrandbits(128))] = node
+    return json.dumps(root, ensure_ascii=False)
+
+
+def deep_tree(depth: int) -> str:
+    return '{"children": {"a": ' * depth + '{"id": 1}' + '}}' * depth
+
+
+class Command(BaseCommand):
+    help = ("Benchmark doc tree trimming on a wide tree and on pathologically deep trees, "
+        "comparing process, the parsed walk and the streaming engine")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--nodes", type=int, default=100000)
+        parser.add_argument("--folder-ratio", type=float, default=0.2)
+        parser.add_argument("--depths", default="100,1000,10000,100000", help="comma separated nesting depths")
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        cases = [("wide {}".format(options["nodes"]), wide_tree(options["nodes"], options["folder_ratio"], options["seed"]))]
+        cases += [("depth {}".format(d), deep_tree(int(d))) for d in options["depths"].split(",")]
+        engines = [
+            ("process", doctree.process),
+            ("walk", lambda content: doctree.walk(json.loads(content))),
+            ("stream", doctree.stream),
+        ]
+        self.stdout.write("{:<16}{:>10}{:>10}{:>8}  ".format("tree", "nodes", "depth", "MB") +
+            "".join("{:>16}".format(name + " ms") for name, _ in engines))
+        for name, content in cases:
+            tree = doctree.stream(content)
+            row = "{:<16}{:>10}{:>10}{:>8.1f}  ".format(name, tree.nodes, tree.depth, len(content) / 1e6)
+            for _, engine in engines:
+                row += "{:>16}".format(self.measure(engine, content, options["repeat"]))
+            self.stdout.write(row)
+
+    def measure(self, engine, content: str, repeat: int) -> str:
+        best = None
+        for _ in range(repeat):
+            started = perf_counter()
+            try:
+                engine(content)
+            except RecursionError:
+                return "recursion"
+            elapsed = perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return "{:.1f}".format(best * 1000)
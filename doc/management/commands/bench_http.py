@@ -0,0 +1,119 @@
+import http.client
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+from django.core.management.base import BaseCommand, CommandError
+
+# 对比模式下启动的两种服务, {python} 和 {port} 会被替换
+WSGI_COMMAND = "{python} manage.py runserver --noreload 127.0.0.1:{port}"
+ASGI_COMMAND = "{python} -m uvicorn doc_server.routing:application --host 127.0.0.1 --port {port} --no-access-log"
+
+
+def measure(host: str, port: int, path: str, method: str, concurrency: int, duration: float) -> dict:
+    deadline = time.time() + duration
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        conn = http.client.HTTPConnection(host, port, timeout=30)
+        local = []
+        failed = 0
+        while time.time() < deadline:
+            started = time.perf_counter()
+            try:
+                conn.request(method, path)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 500:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=30)
+                continue
+            local.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    begin = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - begin
+    latencies.sort()
+
+    def percentile(p):
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    return {"requests": len(latencies), "errors": errors[0], "rps": len(latencies) / elapsed,
+        "p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99)}
+
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout: float) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise CommandError("server exited with code {}".format(process.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise CommandError("server did not start listening on port {}".format(port))
+
+
+class Command(BaseCommand):
+    help = ("Measure requests/sec and latency of an endpoint at a fixed concurrency. "
+        "With --compare, URL is a path: the command starts the WSGI server and the ASGI server in turn, "
+        "runs the same load against each and prints the results side by side.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("url")
+        parser.add_argument("--concurrency", type=int, default=32)
+        parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+        parser.add_argument("--method", default="GET")
+        parser.add_argument("--compare", action="store_true", help="start both servers and compare them")
+        parser.add_argument("--port", type=int, default=8765, help="port for the servers started by --compare")
+        parser.add_argument("--wsgi-command", default=WSGI_COMMAND)
+        parser.add_argument("--asgi-command", default=ASGI_COMMAND)
+        parser.add_argument("--startup-timeout", type=float, default=30.0, help="seconds")
+
+    def handle(self, *args, **options):
+        load = (options["method"], options["concurrency"], options["duration"])
+        if not options["compare"]:
+            url = urlsplit(options["url"])
+            path = url.path + ("?" + url.query if url.query else "")
+            self.write_result(measure(url.hostname, url.port or 80, path, *load))
+            return
+        results = []
+        for mode in ("wsgi", "asgi"):
+            command = options[mode + "_command"].format(python=shlex.quote(sys.executable), port=options["port"])
+            process = subprocess.Popen(shlex.split(command), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_for_port(options["port"], process, options["startup_timeout"])
+                results.append((mode, measure("127.0.0.1", options["port"], options["url"], *load)))
+            finally:
+                process.terminate()
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+        self.stdout.write("{:<6}{:>10}{:>10}{:>10}{:>10}{:>10}{:>8}".format("mode", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors"))
+        for mode, result in results:
+            self.stdout.write("{:<6}{requests:>10}{rps:>10.1f}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}{errors:>8}".format(mode, **result))
+
+    def write_result(self, result: dict) -> None:
+        self.stdout.write("requests: {requests}, errors: {errors}, req/s: {rps:.1f}".format(**result))
+        self.stdout.write("latency ms p50: {p50:.1f}, p95: {p95:.1f}, p99: {p99:.1f}".format(**result))
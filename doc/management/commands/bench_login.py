@@ -0,0 +1,87 @@
+import json
+import threading
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.test import Client
+from doc_server import settings
+from doc.models import Author, Token
+from doc import hashing
+
+
+class Command(BaseCommand):
+    help = ("Run a burst of concurrent logins next to cheap requests in this process and report login throughput "
+        "and the latency of the cheap requests, with hashing on the request threads and in the process pool")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--logins", type=int, default=8, help="concurrent login threads")
+        parser.add_argument("--readers", type=int, default=8, help="concurrent threads sending cheap requests")
+        parser.add_argument("--duration", type=float, default=10.0, help="seconds per mode")
+        parser.add_argument("--path", default=None, help="cheap request, defaults to the bench author's profile")
+        parser.add_argument("--mode", default="both", choices=["inline", "pool", "both"])
+
+    def handle(self, *args, **options):
+        email = "bench-login@localhost"
+        Author.objects.filter(email=email).delete()
+        author = Author(email=email, nickname="bench", active=True)
+        author.set_password("bench-password")
+        author.save()
+        token = Token.objects.create(author=author).content
+        path = options["path"] or "/author/{}".format(author.pk)
+        processes, throttled = settings.HASH_PROCESSES, settings.THROTTLE_ENABLED
+        settings.THROTTLE_ENABLED = False
+        modes = ["inline", "pool"] if options["mode"] == "both" else [options["mode"]]
+        try:
+            self.stdout.write("{:<8}{:>10}{:>12}{:>12}{:>12}{:>12}{:>8}".format(
+                "mode", "logins/s", "reads/s", "p50 ms", "p99 ms", "max ms", "peak q"))
+            for mode in modes:
+                settings.HASH_PROCESSES = 0 if mode == "inline" else max(processes, 1)
+                if mode == "pool":
+                    # 预热进程池, 避免把启动时间计入结果
+                    hashing.make_password("warmup")
+                hashing.pool.reset_stats()
+                logins, reads = self.run(email, token, path, options)
+                reads.sort()
+                duration = options["duration"]
+                p = lambda q: reads[min(len(reads) - 1, int(len(reads) * q))] * 1000 if reads else 0.0
+                self.stdout.write("{:<8}{:>10.1f}{:>12.1f}{:>12.2f}{:>12.2f}{:>12.2f}{:>8}".format(
+                    mode, logins / duration, len(reads) / duration, p(0.5), p(0.99), p(1), hashing.pool.stats()["peak"]))
+        finally:
+            settings.HASH_PROCESSES, settings.THROTTLE_ENABLED = processes, throttled
+            Author.objects.filter(email=email).delete()
+
+    def run(self, email, token, path, options):
+        deadline = time.time() + options["duration"]
+        lock = threading.Lock()
+        logins = [0]
+        reads = []
+        body = json.dumps({"email": email, "password": "bench-password"})
+
+        def login():
+            client = Client()
+            count = 0
+            while time.time() < deadline:
+                if client.post("/auth/", body, content_type="application/json").status_code == 200:
+                    count += 1
+            close_old_connections()
+            with lock:
+                logins[0] += count
+
+        def read():
+            client = Client()
+            local = []
+            while time.time() < deadline:
+                started = time.perf_counter()
+                client.get(path, {"token": token})
+                local.append(time.perf_counter() - started)
+            close_old_connections()
+            with lock:
+                reads.extend(local)
+
+        threads = [threading.Thread(target=login) for _ in range(options["logins"])]
+        threads += [threading.Thread(target=read) for _ in range(options["readers"])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return logins[0], reads
@@ -0,0 +1,35 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from doc_server import settings
+from doc import bus
+
+
+class Command(BaseCommand):
+    help = ("Report invalidation bus statistics written by each worker process: events published and received, "
+        "messages dropped, local cache resets and delivery lag")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ping", action="store_true", help="publish a no-op event so every worker measures its lag")
+        parser.add_argument("--prune", action="store_true", help="delete statistics of processes that stopped reporting")
+
+    def handle(self, *args, **options):
+        if settings.BUS_TRANSPORT is None:
+            raise CommandError("BUS_TRANSPORT is not configured")
+        if options["ping"]:
+            bus.publish("ping", {0: time.time()})
+            # 等待各进程收到并写出下一次统计
+            time.sleep(settings.BUS_STATS_INTERVAL + 1)
+        stale = 3 * settings.BUS_STATS_INTERVAL
+        self.stdout.write("{:<36}{:>11}{:>10}{:>9}{:>8}{:>8}{:>10}{:>10}".format(
+            "process", "published", "received", "dropped", "resets", "failed", "lag avg", "lag max"))
+        for stats in bus.read_stats():
+            if stats["sender"] == bus.bus.sender:
+                continue
+            age = time.time() - stats["time"]
+            if age > stale and options["prune"]:
+                os.unlink(os.path.join(settings.BUS_DIR, "stats", "{}.json".format(stats["sender"])))
+                continue
+            self.stdout.write("{:<36}{:>11}{:>10}{:>9}{:>8}{:>8}{:>10.2f}{:>10.2f}{}".format(
+                stats["sender"][:35], stats["published"], stats["received"], stats["dropped"], stats["resets"],
+                stats["send_failures"], stats["lag_avg_ms"], stats["lag_max_ms"], "  stale" if age > stale else ""))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from doc.models import Access
+from doc.utils import merge_duplicate_access
+
+
+class Command(BaseCommand):
+    help = "Merge duplicate (author, doc) access rows, keeping the highest role, before the unique constraint is applied"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true", help="only count the duplicated pairs")
+
+    def handle(self, *args, **options):
+        merged = merge_duplicate_access(Access, options["batch_size"], options["dry_run"])
+        if options["dry_run"]:
+            self.stdout.write("{} duplicated access pairs".format(merged))
+        else:
+            self.stdout.write("merged {} duplicated access pairs".format(merged))
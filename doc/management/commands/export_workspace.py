@@ -0,0 +1,26 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from doc.models import Author
+from doc import workspace
+
+
+class Command(BaseCommand):
+    help = "Stream an author's docs, doc tree, accesses and chats as NDJSON or a zip archive"
+
+    def add_arguments(self, parser):
+        parser.add_argument("email")
+        parser.add_argument("--format", choices=["ndjson", "zip"], default="ndjson")
+        parser.add_argument("--output", default="-", help="output file, defaults to stdout")
+
+    def handle(self, *args, **options):
+        author = Author.objects.filter(email=options["email"]).first()
+        if author is None:
+            raise CommandError("author {} does not exist".format(options["email"]))
+        chunks = workspace.export_zip(author) if options["format"] == "zip" else workspace.export_ndjson(author)
+        output = sys.stdout.buffer if options["output"] == "-" else open(options["output"], "wb")
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout.buffer:
+                output.close()
@@ -0,0 +1,29 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from doc_server import settings
+from doc.exceptions import BizException
+from doc.models import Author
+from doc import workspace
+
+
+class Command(BaseCommand):
+    help = "Import a workspace produced by export_workspace into an existing author"
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="NDJSON or zip file, - for stdin")
+        parser.add_argument("--as", dest="email", required=True, help="email of the author to import into")
+        parser.add_argument("--batch-size", type=int, default=settings.WORKSPACE_BATCH)
+
+    def handle(self, *args, **options):
+        author = Author.objects.filter(email=options["email"]).first()
+        if author is None:
+            raise CommandError("author {} does not exist".format(options["email"]))
+        stream = sys.stdin.buffer if options["input"] == "-" else open(options["input"], "rb")
+        try:
+            counts = workspace.import_records(workspace.read_lines(stream), author, options["batch_size"])
+        except BizException as e:
+            raise CommandError("import rejected: {}".format(e.args[0]))
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+        self.stdout.write(", ".join("{} {}".format(v, k) for k, v in counts.items()))
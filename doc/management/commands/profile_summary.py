@@ -0,0 +1,53 @@
+import io
+import os
+import json
+import pstats
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from doc_server import settings
+from doc import profiling
+
+
+class Command(BaseCommand):
+    help = "Summarize the hottest frames and per-endpoint timings across captured profiling traces"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sort", default="cumulative", choices=["cumulative", "tottime", "ncalls"])
+        parser.add_argument("--limit", type=int, default=30)
+        parser.add_argument("--name", default=None, help="only traces of this view, e.g. DocTreeView.get")
+        parser.add_argument("--sign", action="store_true",
+            help="print a value for the {} header that enables profiling of one request".format(settings.PROFILE_HEADER))
+
+    def handle(self, *args, **options):
+        if options["sign"]:
+            self.stdout.write(profiling.sign_header())
+            return
+        directory = settings.PROFILE_DIR
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".json")) if os.path.isdir(directory) else []
+        endpoints = defaultdict(lambda: {"count": 0, "total_ms": 0.0, "db_ms": 0.0, "serialize_ms": 0.0, "queries": 0})
+        profiles = []
+        for name in names:
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                meta = json.load(f)
+            if options["name"] is not None and meta["name"] != options["name"]:
+                continue
+            stat = endpoints[meta["name"]]
+            stat["count"] += 1
+            for key in ("total_ms", "db_ms", "serialize_ms"):
+                stat[key] += meta[key]
+            stat["queries"] += len(meta["queries"])
+            prof = os.path.join(directory, name[:-len(".json")] + ".prof")
+            if os.path.exists(prof):
+                profiles.append(prof)
+        if len(profiles) == 0:
+            self.stdout.write("no traces in {}".format(directory))
+            return
+        self.stdout.write("{:<32}{:>8}{:>12}{:>12}{:>14}{:>10}".format("view", "traces", "avg ms", "avg db ms", "avg serial ms", "avg sql"))
+        for name, stat in sorted(endpoints.items(), key=lambda item: -item[1]["total_ms"]):
+            count = stat["count"]
+            self.stdout.write("{:<32}{:>8}{:>12.1f}{:>12.1f}{:>14.1f}{:>10.1f}".format(
+                name, count, stat["total_ms"] / count, stat["db_ms"] / count, stat["serialize_ms"] / count, stat["queries"] / count))
+        buffer = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=buffer)
+        stats.strip_dirs().sort_stats(options["sort"]).print_stats(options["limit"])
+        self.stdout.write(buffer.getvalue())
@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from doc_server import settings
+from doc import biz
+
+
+class Command(BaseCommand):
+    help = "Purge recycled docs whose retention period has expired"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--expire", type=int, default=settings.RECYCLE_EXPIRE,
+            help="retention period of recycled docs in ms")
+        parser.add_argument("--chunk-size", type=int, default=settings.RECYCLE_PURGE_CHUNK)
+        parser.add_argument("--interval", type=int, default=0,
+            help="keep running and purge every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        while True:
+            purged = biz.purge_recycled_docs(options["expire"], options["chunk_size"])
+            self.stdout.write("purged {} docs".format(purged))
+            if options["interval"] <= 0:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,43 @@
+from django.db.models import F, FloatField, ExpressionWrapper
+from django.core.management.base import BaseCommand
+from doc.models import QueryStat
+from doc import sqlstats
+
+
+class Command(BaseCommand):
+    help = "Report query shapes recorded by the slow query log, with their origin and EXPLAIN output"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sort", default="total", choices=["total", "avg", "max", "count", "slow"])
+        parser.add_argument("--limit", type=int, default=20)
+        parser.add_argument("--biz", default=None, help="only queries issued from this biz function")
+        parser.add_argument("--explain", action="store_true", help="print the stored EXPLAIN output")
+        parser.add_argument("--reset", action="store_true", help="delete all recorded statistics")
+
+    def handle(self, *args, **options):
+        if options["reset"]:
+            QueryStat.objects.all().delete()
+            return
+        sqlstats.flush()
+        order = {
+            "total": "-total_ms",
+            "avg": "-avg_ms",
+            "max": "-max_ms",
+            "count": "-count",
+            "slow": "-slow_count",
+        }[options["sort"]]
+        stats = QueryStat.objects.annotate(avg_ms=ExpressionWrapper(F("total_ms") / F("count"), output_field=FloatField()))
+        if options["biz"] is not None:
+            stats = stats.filter(biz=options["biz"])
+        stats = list(stats.order_by(order)[:options["limit"]])
+        if len(stats) == 0:
+            self.stdout.write("no matching queries recorded, SLOW_QUERY_LOG must be enabled to collect them")
+            return
+        self.stdout.write("{:<10}{:>10}{:>8}{:>12}{:>10}{:>10}  {}".format("shape", "count", "slow", "total ms", "avg ms", "max ms", "origin"))
+        for stat in stats:
+            self.stdout.write("{:<10}{:>10}{:>8}{:>12.1f}{:>10.2f}{:>10.2f}  {}".format(
+                stat.fingerprint[:8], stat.count, stat.slow_count, stat.total_ms, stat.avg_ms, stat.max_ms, stat.biz or stat.site or "-"))
+            self.stdout.write("    " + stat.shape[:300])
+            if options["explain"] and stat.explain:
+                for line in stat.explain.splitlines():
+                    self.stdout.write("      " + line)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from doc import stats
+
+
+class Command(BaseCommand):
+    help = "Recompute per-author workspace statistics in batches and fix counters that drifted"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true", help="only count the drifted authors")
+
+    def handle(self, *args, **options):
+        result = stats.reconcile(options["batch_size"], options["dry_run"])
+        self.stdout.write("checked {authors} authors, {created} missing, {fixed} drifted".format(**result)
+            + (" (dry run)" if options["dry_run"] else ""))
@@ -0,0 +1,30 @@
+import time
+from django.core.management.base import BaseCommand
+from doc_server import settings
+from doc.utils import now
+from doc import biz
+
+
+class Command(BaseCommand):
+    help = "Snapshot the content of recently modified docs into their version history"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", type=int, default=None,
+            help="only snapshot docs modified after this timestamp in ms, defaults to one interval ago")
+        parser.add_argument("--chunk-size", type=int, default=settings.VERSION_SNAPSHOT_CHUNK)
+        parser.add_argument("--interval", type=int, default=0,
+            help="keep running and snapshot every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        interval = options["interval"]
+        since = options["since"]
+        if since is None:
+            since = now() - (interval or settings.VERSION_SNAPSHOT_INTERVAL) * 1000
+        while True:
+            started = now()
+            created = biz.snapshot_docs(since, options["chunk_size"])
+            self.stdout.write("created {} snapshots".format(created))
+            if interval <= 0:
+                return
+            since = started
+            time.sleep(interval)
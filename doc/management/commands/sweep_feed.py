@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from doc_server import settings
+from doc import feed
+
+
+class Command(BaseCommand):
+    help = "Delete change feed events older than the retention period in chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--retention", type=int, default=settings.FEED_RETENTION, help="in ms")
+        parser.add_argument("--chunk-size", type=int, default=settings.TOKEN_SWEEP_CHUNK)
+
+    def handle(self, *args, **options):
+        swept = feed.sweep(options["retention"], options["chunk_size"])
+        self.stdout.write("swept {} events".format(swept))
@@ -0,0 +1,21 @@
+import time
+from django.core.management.base import BaseCommand
+from doc_server import settings
+from doc import biz
+
+
+class Command(BaseCommand):
+    help = "Delete expired Token, ReadToken, CollaborateToken and IdempotencyRecord rows in chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=settings.TOKEN_SWEEP_CHUNK)
+        parser.add_argument("--interval", type=int, default=0,
+            help="keep running and sweep every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        while True:
+            swept = biz.sweep_expired_tokens(options["chunk_size"])
+            self.stdout.write(", ".join("{} {}".format(v, k) for k, v in swept.items()))
+            if options["interval"] <= 0:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,104 @@
+# Generated by Django 2.0.4 on 2026-10-19 17:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+import doc.utils
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Author',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('active', models.BooleanField(default=False)),
+                ('email', models.EmailField(max_length=254, unique=True)),
+                ('nickname', models.CharField(max_length=128)),
+                ('password', models.CharField(max_length=128)),
+                ('create_time', models.BigIntegerField(default=doc.utils.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Chat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('time', models.BigIntegerField(default=doc.utils.now)),
+                ('initiator', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='initiated_chats', to='doc.Author')),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='received_chats', to='doc.Author')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Doc',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label', models.CharField(blank=True, max_length=255, verbose_name='label')),
+                ('type', models.CharField(max_length=32)),
+                ('recycled', models.BooleanField(default=False)),
+                ('full_text', models.TextField(blank=True)),
+                ('create_time', models.BigIntegerField(default=doc.utils.now)),
+                ('mod_time', models.BigIntegerField(default=doc.utils.now)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Token',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.CharField(default=doc.utils.gen_token, max_length=255, unique=True)),
+                ('timestamp', models.BigIntegerField(default=doc.utils.now)),
+                ('author', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='author_token', to='doc.Author')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ReadToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.CharField(default=doc.utils.gen_token, max_length=255, unique=True)),
+                ('timestamp', models.BigIntegerField(default=doc.utils.now)),
+                ('doc', models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='doc_read_token', to='doc.Doc')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('msg', models.TextField(blank=True, default='')),
+                ('time', models.BigIntegerField(default=doc.utils.now)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='records', to='doc.Chat')),
+                ('receiver', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='receiver_of', to='doc.Author')),
+                ('sender', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sender_of', to='doc.Author')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DocTree',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField(default=doc.utils.default_doc_tree)),
+                ('timestamp', models.BigIntegerField(default=doc.utils.now)),
+                ('author', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='author_doc_tree', to='doc.Author')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CollaborateToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.CharField(default=doc.utils.gen_token, max_length=255, unique=True)),
+                ('timestamp', models.BigIntegerField(default=doc.utils.now)),
+                ('doc', models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='doc_coll_token', to='doc.Doc')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Access',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.IntegerField(choices=[(0, 0), (1, 1), (2, 2)])),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='author_accessible', to='doc.Author')),
+                ('doc', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='doc_accessible', to='doc.Doc')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.4 on 2026-10-19 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='doc',
+            name='recycle_time',
+            field=models.BigIntegerField(db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name='doc',
+            name='recycled',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
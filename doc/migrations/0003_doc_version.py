@@ -0,0 +1,27 @@
+# Generated by Django 2.0.4 on 2026-10-19 17:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+import doc.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0002_doc_recycle'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('keyframe', models.BooleanField(default=False)),
+                ('content', models.BinaryField()),
+                ('checksum', models.CharField(max_length=32)),
+                ('size', models.IntegerField(default=0)),
+                ('time', models.BigIntegerField(default=doc.utils.now)),
+                ('doc', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='doc_versions', to='doc.Doc')),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.4 on 2026-10-19 17:30
+
+from django.db import migrations, models
+import doc.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0003_doc_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='collaboratetoken',
+            name='timestamp',
+            field=models.BigIntegerField(db_index=True, default=doc.utils.now),
+        ),
+        migrations.AlterField(
+            model_name='readtoken',
+            name='timestamp',
+            field=models.BigIntegerField(db_index=True, default=doc.utils.now),
+        ),
+        migrations.AlterField(
+            model_name='token',
+            name='timestamp',
+            field=models.BigIntegerField(db_index=True, default=doc.utils.now),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.0.4 on 2026-10-19 17:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+import doc.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0004_token_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=32)),
+                ('payload', models.TextField(default='{}')),
+                ('time', models.BigIntegerField(db_index=True, default=doc.utils.now)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_events', to='doc.Author')),
+            ],
+        ),
+    ]
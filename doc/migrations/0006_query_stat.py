@@ -0,0 +1,31 @@
+# Generated by Django 2.0.4 on 2026-10-19 17:30
+
+from django.db import migrations, models
+import doc.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0005_feed_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueryStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(max_length=32, unique=True)),
+                ('shape', models.TextField()),
+                ('biz', models.CharField(default='', max_length=255)),
+                ('site', models.CharField(default='', max_length=255)),
+                ('explain', models.TextField(default='')),
+                ('count', models.BigIntegerField(default=0)),
+                ('slow_count', models.BigIntegerField(default=0)),
+                ('total_ms', models.FloatField(default=0)),
+                ('max_ms', models.FloatField(default=0)),
+                ('first_seen', models.BigIntegerField(default=doc.utils.now)),
+                ('last_seen', models.BigIntegerField(default=doc.utils.now)),
+            ],
+        ),
+    ]
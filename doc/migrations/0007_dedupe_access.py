@@ -0,0 +1,17 @@
+from django.db import migrations
+from doc.utils import merge_duplicate_access
+
+
+def dedupe(apps, schema_editor):
+    merge_duplicate_access(apps.get_model("doc", "Access"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0006_query_stat'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.0.4 on 2026-10-19 17:30
+
+from django.db import migrations, models
+import doc.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0007_dedupe_access'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='doc',
+            name='mod_time',
+            field=models.BigIntegerField(db_index=True, default=doc.utils.now),
+        ),
+        migrations.AlterUniqueTogether(
+            name='access',
+            unique_together={('author', 'doc')},
+        ),
+        migrations.AddIndex(
+            model_name='access',
+            index=models.Index(fields=['doc', 'role'], name='doc_access_doc_role'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'time'], name='doc_message_sender_time'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'time'], name='doc_message_receiver_time'),
+        ),
+    ]
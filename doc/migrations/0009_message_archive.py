@@ -0,0 +1,31 @@
+# Generated by Django 2.0.4 on 2026-10-19 18:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0008_access_unique_and_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_id', models.BigIntegerField()),
+                ('last_id', models.BigIntegerField()),
+                ('first_time', models.BigIntegerField()),
+                ('last_time', models.BigIntegerField()),
+                ('count', models.IntegerField()),
+                ('content', models.BinaryField()),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archives', to='doc.Chat')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='messagearchive',
+            index=models.Index(fields=['chat', 'last_id'], name='doc_archive_chat_last'),
+        ),
+    ]
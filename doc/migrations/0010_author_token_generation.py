@@ -0,0 +1,18 @@
+# Generated by Django 2.0.4 on 2026-10-19 18:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0009_message_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='token_generation',
+            field=models.IntegerField(default=0),
+        ),
+    ]
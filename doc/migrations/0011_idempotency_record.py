@@ -0,0 +1,31 @@
+# Generated by Django 2.0.4 on 2026-10-19 16:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import doc.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0010_author_token_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=128)),
+                ('endpoint', models.CharField(max_length=255)),
+                ('fingerprint', models.CharField(max_length=32)),
+                ('status', models.IntegerField(null=True)),
+                ('response', models.TextField(default='')),
+                ('timestamp', models.BigIntegerField(db_index=True, default=doc.utils.now)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='idempotency_records', to='doc.Author')),
+            ],
+            options={
+                'unique_together': {('author', 'key')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.0.4 on 2026-10-19 17:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0011_idempotency_record'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='access',
+            index=models.Index(fields=['author', 'role'], name='doc_access_author_role'),
+        ),
+    ]
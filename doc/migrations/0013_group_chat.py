@@ -0,0 +1,54 @@
+# Generated by Django 2.0.4 on 2026-10-19 17:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+import doc.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0012_access_author_role'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupChat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, default='', max_length=255)),
+                ('last_message_id', models.BigIntegerField(default=0)),
+                ('time', models.BigIntegerField(default=doc.utils.now)),
+                ('creator', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='created_groups', to='doc.Author')),
+                ('doc', models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='doc_group', to='doc.Doc')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GroupMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('msg', models.TextField(blank=True, default='')),
+                ('time', models.BigIntegerField(default=doc.utils.now)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='doc.GroupChat')),
+                ('sender', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='group_messages', to='doc.Author')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GroupMember',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('read_cursor', models.BigIntegerField(default=0)),
+                ('joined', models.BigIntegerField(default=doc.utils.now)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='group_memberships', to='doc.Author')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='members', to='doc.GroupChat')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['group', 'id'], name='doc_groupmessage_group_id'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='groupmember',
+            unique_together={('group', 'author')},
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.0.4 on 2026-10-19 18:25
+
+from django.db import migrations, models
+import django.db.models.deletion
+import doc.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0013_group_chat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='initiator_unread',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='recipient_unread',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='AuthorStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owned_docs', models.IntegerField(default=0)),
+                ('collaborating_docs', models.IntegerField(default=0)),
+                ('reading_docs', models.IntegerField(default=0)),
+                ('unread_chats', models.IntegerField(default=0)),
+                ('messages', models.IntegerField(default=0)),
+                ('timestamp', models.BigIntegerField(default=doc.utils.now)),
+                ('author', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='author_stats', to='doc.Author')),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.0.4 on 2026-10-19 19:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+import doc.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0014_author_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Activity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=32)),
+                ('payload', models.TextField(default='{}')),
+                ('time', models.BigIntegerField(default=doc.utils.now)),
+                ('author', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='author_activities', to='doc.Author')),
+                ('doc', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='doc_activities', to='doc.Doc')),
+                ('target', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='target_activities', to='doc.Author')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['author', 'id'], name='doc_activity_author_id'),
+        ),
+        migrations.AddIndex(
+            model_name='activity',
+            index=models.Index(fields=['doc', 'id'], name='doc_activity_doc_id'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.4 on 2026-10-19 19:40
+
+from django.db import migrations, models
+import doc.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('doc', '0015_activity'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='author',
+            name='create_time',
+            field=models.BigIntegerField(db_index=True, default=doc.utils.now),
+        ),
+        migrations.AlterField(
+            model_name='chat',
+            name='time',
+            field=models.BigIntegerField(db_index=True, default=doc.utils.now),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='time',
+            field=models.BigIntegerField(db_index=True, default=doc.utils.now),
+        ),
+    ]
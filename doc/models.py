@@ -1,8 +1,13 @@
+import json
 from time import time
-from typing import Iterable
-from django.db import models
-from django.contrib.auth.models import AbstractUser
-from doc.utils import gen_token, now, default_doc_tree
+from typing import Dict, Iterable
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.db import connection, models
+from django.db.models.signals import post_save, post_delete
+from doc_server import settings
+from doc import hashing, reprcache
+from doc.utils import gen_token, now, default_doc_tree, compress_text, decompress_text, apply_delta
 
 
 # Create your models here.
@@ -11,15 +16,23 @@ class Author(models.Model):
     email = models.EmailField(unique=True)
     nickname = models.CharField(max_length=128)
     password = models.CharField(max_length=128)
-    create_time = models.BigIntegerField(default=now)
+    create_time = models.BigIntegerField(default=now, db_index=True)
+    token_generation = models.IntegerField(default=0)
     REQUIRED_FIELDS = ["nickname"]
     USERNAME_FIELD = "email"
 
     def set_password(self, raw_password):
-        AbstractUser.set_password(self, raw_password)
+        self.password = hashing.make_password(raw_password)
+        # 修改密码后之前签发的签名令牌全部失效
+        self.token_generation += 1
     
     def check_password(self, raw_password) -> bool:
-        return AbstractUser.check_password(self, raw_password)
+        valid, must_update = hashing.check_password(raw_password, self.password)
+        if valid and must_update:
+            # 哈希参数变化后在登录时透明地重新哈希, 不影响已签发的令牌
+            self.password = hashing.make_password(raw_password)
+            Author.objects.filter(pk=self.pk).update(password=self.password)
+        return valid
     
     @property
     def is_anonymous(self):
@@ -30,33 +43,110 @@ class Author(models.Model):
         return False
 
 
+class DocManager(models.Manager):
+
+    def get_queryset(self):
+        # full_text 可能很大, 默认不随列表查询加载
+        return super().get_queryset().defer("full_text")
+
+
 class Doc(models.Model):
     label = models.CharField(max_length=255, verbose_name="label", blank=True)
     type = models.CharField(max_length=32)
-    recycled = models.BooleanField(default=False)
+    recycled = models.BooleanField(default=False, db_index=True)
+    recycle_time = models.BigIntegerField(default=0, db_index=True)
     full_text = models.TextField(blank=True)
     create_time = models.BigIntegerField(default=now)
-    mod_time = models.BigIntegerField(default=now)
+    mod_time = models.BigIntegerField(default=now, db_index=True)
+
+    objects = DocManager()
 
     def get_creator(self) -> Author:
         return Access.objects.filter(doc=self, role=2)[0].author
 
 
+class DocVersion(models.Model):
+    doc = models.ForeignKey(Doc, related_name="doc_versions", on_delete=models.CASCADE)
+    keyframe = models.BooleanField(default=False)
+    content = models.BinaryField()
+    checksum = models.CharField(max_length=32)
+    size = models.IntegerField(default=0)
+    time = models.BigIntegerField(default=now)
+
+    def load(self) -> str:
+        '''
+        从最近的关键帧开始依次应用差量, 还原该版本的全文
+        '''
+        if self.keyframe:
+            return decompress_text(self.content)
+        versions: Iterable[DocVersion] = DocVersion.objects.filter(
+            doc_id=self.doc_id, pk__lte=self.pk, keyframe=True).order_by("-pk")[:1]
+        if len(versions) == 0:
+            raise DocVersion.DoesNotExist()
+        keyframe = versions[0]
+        text = decompress_text(keyframe.content)
+        for version in DocVersion.objects.filter(doc_id=self.doc_id, pk__gt=keyframe.pk, pk__lte=self.pk).order_by("pk"):
+            text = apply_delta(text, version.content)
+        return text
+
+
 class Access(models.Model):
     author = models.ForeignKey(Author, related_name="author_accessible", on_delete=models.CASCADE)
     doc = models.ForeignKey(Doc, related_name="doc_accessible", on_delete=models.CASCADE)
     role = models.IntegerField(choices=[(0, 0), (1, 1), (2, 2)])
 
+    class Meta:
+        unique_together = [("author", "doc")]
+        indexes = [
+            models.Index(fields=["doc", "role"], name="doc_access_doc_role"),
+            models.Index(fields=["author", "role"], name="doc_access_author_role"),
+        ]
+
     DOMINATOR = 2
     VALID_ROLES = [0, 1, 2]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 记录读出时的角色, 保存时据此调整用户统计中的计数, 不需要再查一次
+        instance._loaded_role = instance.__dict__.get("role", None)
+        return instance
+
+    @staticmethod
+    @contextmanager
+    def cached():
+        '''
+        在作用域内缓存 get_mod 的结果, 权限变化时自动失效
+        '''
+        token = _mod_cache.set({})
+        try:
+            yield
+        finally:
+            _mod_cache.reset(token)
+
     @staticmethod
     def get_mod(author: Author, doc: Doc) -> int:
         if author is None or doc is None: return -1
-        accesses: Iterable[Access] = Access.objects.filter(author=author, doc=doc)
-        if len(accesses) == 0:
-            return -1
-        return accesses[0].role
+        cache = _mod_cache.get()
+        if cache is not None and (author.pk, doc.pk) in cache:
+            return cache[(author.pk, doc.pk)]
+        if settings.REPR_CACHE_ENABLED and not connection.in_atomic_block:
+            # 事务中可能有尚未提交的权限变化, 此时不使用跨请求的缓存
+            role = Access.roles_of(author.pk).get(doc.pk, None)
+        else:
+            role = Access.objects.filter(author=author, doc=doc).values_list("role", flat=True).first()
+        role = -1 if role is None else role
+        if cache is not None:
+            cache[(author.pk, doc.pk)] = role
+        return role
+
+    @staticmethod
+    def roles_of(author_id: int) -> Dict[int, int]:
+        '''
+        用户的权限表 {doc_id: role}, 保存在表示缓存中, 权限变化时失效
+        '''
+        load = lambda missing: {pk: dict(Access.objects.filter(author_id=pk).values_list("doc_id", "role")) for pk in missing}
+        return reprcache.fetch("roles", [author_id], load)[author_id]
 
     @staticmethod
     def can_read(author: Author, doc: Doc) -> bool:
@@ -70,20 +160,41 @@ class Access(models.Model):
     def can_dominate(author: Author, doc: Doc) -> bool:
         return Access.get_mod(author, doc) >= 2
 
+_mod_cache: ContextVar = ContextVar("doc_mod_cache", default=None)
+
+def _forget_mod(sender, instance: Access, **kwargs):
+    cache = _mod_cache.get()
+    if cache is not None:
+        cache.pop((instance.author_id, instance.doc_id), None)
+
+post_save.connect(_forget_mod, sender=Access)
+post_delete.connect(_forget_mod, sender=Access)
+
 class Token(models.Model):
     author = models.OneToOneField(Author, related_name="author_token", on_delete=models.CASCADE)
     content = models.CharField(max_length=255, unique=True, default=gen_token)
-    timestamp = models.BigIntegerField(default=now)
+    timestamp = models.BigIntegerField(default=now, db_index=True)
 
     def expired(self, duration) -> bool:
         return time() * 1000 - self.timestamp > duration
+
+    def renew(self) -> None:
+        # 滑动续期, 每个 TOKEN_RENEW_INTERVAL 内最多写一次
+        if time() * 1000 - self.timestamp > settings.TOKEN_RENEW_INTERVAL:
+            self.timestamp = now()
+            Token.objects.filter(pk=self.pk).update(timestamp=self.timestamp)
     
     @staticmethod
     def valid(s) -> Author:
-        tokens: Iterable[Token] = Token.objects.filter(content=s)
+        if s is None:
+            return None
+        tokens: Iterable[Token] = Token.objects.select_related("author").filter(content=s)
         if len(tokens) == 0:
             return None
         token = tokens[0]
+        if token.expired(settings.TOKEN_TTL):
+            return None
+        token.renew()
         return token.author
     
     @staticmethod
@@ -99,19 +210,95 @@ class DocTree(models.Model):
 class Chat(models.Model):
     initiator = models.ForeignKey(Author, related_name="initiated_chats", on_delete=models.CASCADE)
     recipient = models.ForeignKey(Author, related_name="received_chats", on_delete=models.CASCADE)
-    time = models.BigIntegerField(default=now)
+    time = models.BigIntegerField(default=now, db_index=True)
+    # 双方各自的未读消息数, 读取最新一页记录时清零
+    initiator_unread = models.IntegerField(default=0)
+    recipient_unread = models.IntegerField(default=0)
 
 class Message(models.Model):
     chat = models.ForeignKey(Chat, related_name="records", on_delete=models.CASCADE)
     sender = models.ForeignKey(Author, related_name="sender_of", on_delete=models.SET_NULL, null=True)
     receiver = models.ForeignKey(Author, related_name="receiver_of", on_delete=models.SET_NULL, null=True)
     msg = models.TextField(default="", blank=True)
+    time = models.BigIntegerField(default=now, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["sender", "time"], name="doc_message_sender_time"),
+            models.Index(fields=["receiver", "time"], name="doc_message_receiver_time"),
+        ]
+
+class GroupChat(models.Model):
+    '''
+    群聊, 关联文档时成员与文档的权限同步; last_message_id 是最后一条消息的 id, 用于计算未读
+    '''
+    name = models.CharField(max_length=255, default="", blank=True)
+    doc = models.OneToOneField(Doc, related_name="doc_group", null=True, on_delete=models.CASCADE)
+    creator = models.ForeignKey(Author, related_name="created_groups", null=True, on_delete=models.SET_NULL)
+    last_message_id = models.BigIntegerField(default=0)
+    time = models.BigIntegerField(default=now)
+
+class GroupMember(models.Model):
+    '''
+    群成员, read_cursor 是已读到的最后一条消息的 id, 消息本身只保存一份
+    '''
+    group = models.ForeignKey(GroupChat, related_name="members", on_delete=models.CASCADE)
+    author = models.ForeignKey(Author, related_name="group_memberships", on_delete=models.CASCADE)
+    read_cursor = models.BigIntegerField(default=0)
+    joined = models.BigIntegerField(default=now)
+
+    class Meta:
+        unique_together = [("group", "author")]
+
+class GroupMessage(models.Model):
+    group = models.ForeignKey(GroupChat, related_name="messages", on_delete=models.CASCADE)
+    sender = models.ForeignKey(Author, related_name="group_messages", null=True, on_delete=models.SET_NULL)
+    msg = models.TextField(default="", blank=True)
     time = models.BigIntegerField(default=now)
 
+    class Meta:
+        indexes = [models.Index(fields=["group", "id"], name="doc_groupmessage_group_id")]
+
+class MessageArchive(models.Model):
+    '''
+    归档后的冷消息, 同一聊天中一段连续的消息压缩为一条记录
+    '''
+    chat = models.ForeignKey(Chat, related_name="archives", on_delete=models.CASCADE)
+    first_id = models.BigIntegerField()
+    last_id = models.BigIntegerField()
+    first_time = models.BigIntegerField()
+    last_time = models.BigIntegerField()
+    count = models.IntegerField()
+    content = models.BinaryField()
+
+    class Meta:
+        indexes = [models.Index(fields=["chat", "last_id"], name="doc_archive_chat_last")]
+
+    def pack(self, messages: Iterable[Message]) -> None:
+        rows = [[m.pk, m.sender_id, m.receiver_id, m.msg, m.time] for m in messages]
+        self.first_id, self.last_id = rows[0][0], rows[-1][0]
+        self.first_time, self.last_time = rows[0][4], rows[-1][4]
+        self.count = len(rows)
+        self.content = compress_text(json.dumps(rows, ensure_ascii=False))
+
+    def messages(self) -> Iterable[Message]:
+        '''
+        还原为未保存的 Message 实例, 按 id 升序
+        '''
+        rows = json.loads(decompress_text(self.content))
+        return [Message(id=pk, chat_id=self.chat_id, sender_id=sender_id, receiver_id=receiver_id, msg=msg, time=at)
+            for pk, sender_id, receiver_id, msg, at in rows]
+
+class FeedEvent(models.Model):
+    author = models.ForeignKey(Author, related_name="feed_events", on_delete=models.CASCADE)
+    kind = models.CharField(max_length=32)
+    payload = models.TextField(default="{}")
+    time = models.BigIntegerField(default=now, db_index=True)
+
 class ReadToken(models.Model):
     doc = models.OneToOneField(Doc, related_name="doc_read_token", null=True, on_delete=models.CASCADE)
     content = models.CharField(max_length=255, unique=True, default=gen_token)
-    timestamp = models.BigIntegerField(default=now)
+    timestamp = models.BigIntegerField(default=now, db_index=True)
 
     def expired(self, duration) -> bool:
         return time() * 1000 - self.timestamp > duration
@@ -131,7 +318,7 @@ class ReadToken(models.Model):
 class CollaborateToken(models.Model):
     doc = models.OneToOneField(Doc, related_name="doc_coll_token", null=True, on_delete=models.CASCADE)
     content = models.CharField(max_length=255, unique=True, default=gen_token)
-    timestamp = models.BigIntegerField(default=now)
+    timestamp = models.BigIntegerField(default=now, db_index=True)
 
     def expired(self, duration) -> bool:
         return time() * 1000 - self.timestamp > duration
@@ -146,4 +333,63 @@ class CollaborateToken(models.Model):
     
     @staticmethod
     def generate() -> str:
-        return gen_token()
\ No newline at end of file
+        return gen_token()
+
+
+class QueryStat(models.Model):
+    fingerprint = models.CharField(max_length=32, unique=True)
+    shape = models.TextField()
+    biz = models.CharField(max_length=255, default="")
+    site = models.CharField(max_length=255, default="")
+    explain = models.TextField(default="")
+    count = models.BigIntegerField(default=0)
+    slow_count = models.BigIntegerField(default=0)
+    total_ms = models.FloatField(default=0)
+    max_ms = models.FloatField(default=0)
+    first_seen = models.BigIntegerField(default=now)
+    last_seen = models.BigIntegerField(default=now)
+
+class IdempotencyRecord(models.Model):
+    '''
+    带 Idempotency-Key 的写请求的结果, status 为空表示请求仍在处理中
+    '''
+    author = models.ForeignKey(Author, related_name="idempotency_records", on_delete=models.CASCADE)
+    key = models.CharField(max_length=128)
+    endpoint = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=32)
+    status = models.IntegerField(null=True)
+    response = models.TextField(default="")
+    timestamp = models.BigIntegerField(default=now, db_index=True)
+
+    class Meta:
+        unique_together = ("author", "key")
+
+class AuthorStats(models.Model):
+    '''
+    用户工作区的统计, 在写操作中增量维护, 由 reconcile_stats 命令定期校正
+    '''
+    author = models.OneToOneField(Author, related_name="author_stats", on_delete=models.CASCADE)
+    owned_docs = models.IntegerField(default=0)
+    collaborating_docs = models.IntegerField(default=0)
+    reading_docs = models.IntegerField(default=0)
+    unread_chats = models.IntegerField(default=0)
+    messages = models.IntegerField(default=0)
+    timestamp = models.BigIntegerField(default=now)
+
+class Activity(models.Model):
+    '''
+    文档操作的审计记录, 只追加; 外键不加约束, 文档和用户删除后记录仍然保留
+    '''
+    author = models.ForeignKey(Author, related_name="author_activities", null=True, db_constraint=False, on_delete=models.DO_NOTHING)
+    doc = models.ForeignKey(Doc, related_name="doc_activities", null=True, db_constraint=False, on_delete=models.DO_NOTHING)
+    target = models.ForeignKey(Author, related_name="target_activities", null=True, db_constraint=False, on_delete=models.DO_NOTHING)
+    kind = models.CharField(max_length=32)
+    payload = models.TextField(default="{}")
+    time = models.BigIntegerField(default=now)
+
+    class Meta:
+        # id 按写入顺序递增, 与时间顺序基本一致, 同时是分页用的唯一键
+        indexes = [
+            models.Index(fields=["author", "id"], name="doc_activity_author_id"),
+            models.Index(fields=["doc", "id"], name="doc_activity_doc_id"),
+        ]
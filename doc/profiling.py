@@ -0,0 +1,110 @@
+import os
+import json
+import random
+import cProfile
+from time import perf_counter, time
+from contextvars import ContextVar
+from typing import Dict, List
+from django.core import signing
+from django.db import connection
+from doc_server import settings
+
+SIGN_SALT = "doc.profiling"
+
+_current: ContextVar = ContextVar("doc_profile_trace", default=None)
+
+
+class Trace:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.queries: List[Dict] = []
+        self.serialize_time = 0.0
+
+    def record_query(self, execute, sql, params, many, context):
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({"sql": sql, "ms": (perf_counter() - started) * 1000})
+
+
+def current() -> Trace:
+    return _current.get()
+
+
+def sign_header() -> str:
+    '''
+    生成用于开启单次请求分析的请求头的值
+    '''
+    return signing.TimestampSigner(salt=SIGN_SALT).sign("profile")
+
+
+def requested(request) -> bool:
+    meta = getattr(request, "META", None)
+    value = meta.get(settings.PROFILE_HEADER, None) if meta is not None else None
+    if value is not None:
+        try:
+            signing.TimestampSigner(salt=SIGN_SALT).unsign(value, max_age=settings.PROFILE_HEADER_MAX_AGE)
+            return True
+        except signing.BadSignature:
+            return False
+    return settings.PROFILE_SAMPLE_RATE > 0 and random.random() < settings.PROFILE_SAMPLE_RATE
+
+
+def rotate(directory: str) -> None:
+    traces = sorted(name for name in os.listdir(directory) if name.endswith(".json"))
+    for name in traces[:max(0, len(traces) - settings.PROFILE_MAX_TRACES)]:
+        base = os.path.join(directory, name[:-len(".json")])
+        for path in (base + ".json", base + ".prof"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def save(trace: Trace, profile: cProfile.Profile, total: float, path: str) -> str:
+    directory = settings.PROFILE_DIR
+    os.makedirs(directory, exist_ok=True)
+    trace_id = "{}-{}-{}".format(int(time() * 1000), os.getpid(), trace.name)
+    base = os.path.join(directory, trace_id)
+    profile.dump_stats(base + ".prof")
+    db_time = sum(query["ms"] for query in trace.queries)
+    with open(base + ".json", "w", encoding="utf-8") as f:
+        json.dump({
+            "name": trace.name,
+            "path": path,
+            "total_ms": total * 1000,
+            "db_ms": db_time,
+            "serialize_ms": trace.serialize_time * 1000,
+            "queries": trace.queries,
+        }, f, ensure_ascii=False)
+    rotate(directory)
+    return trace_id
+
+
+def profiled(name: str):
+    '''
+    按签名请求头或采样率对视图进行分析, 记录 cProfile 结果、SQL 及其耗时和序列化耗时
+    '''
+    def foo(func):
+        def bar(*args, **kwargs):
+            request = args[1] if len(args) > 1 else None
+            if not requested(request):
+                return func(*args, **kwargs)
+            trace = Trace(name)
+            token = _current.set(trace)
+            profile = cProfile.Profile()
+            started = perf_counter()
+            try:
+                with connection.execute_wrapper(trace.record_query):
+                    profile.enable()
+                    try:
+                        response = func(*args, **kwargs)
+                    finally:
+                        profile.disable()
+            finally:
+                _current.reset(token)
+            trace_id = save(trace, profile, perf_counter() - started, getattr(request, "path", ""))
+            response["X-Doc-Profile-Trace"] = trace_id
+            return response
+        return bar
+    return foo
@@ -0,0 +1,77 @@
+import uuid
+from typing import Callable, Dict, Iterable, List
+from django.core.cache import caches
+from django.db import transaction
+from doc_server import settings
+from doc import bus
+
+
+def cache():
+    return caches[settings.REPR_CACHE]
+
+
+def applicable(context: Dict) -> bool:
+    '''
+    只缓存默认的完整表示, 带 fields= 或 expand= 的请求照常序列化
+    '''
+    return settings.REPR_CACHE_ENABLED and context.get("fields", None) is None and context.get("expand", None) is None
+
+
+def _version_key(kind: str, pk) -> str:
+    return "repr:v:{}:{}".format(kind, pk)
+
+
+def _key(kind: str, pk, version: str) -> str:
+    return "repr:{}:{}:{}".format(kind, pk, version)
+
+
+def versions(kind: str, pks: Iterable) -> Dict:
+    '''
+    读取版本戳, 没有版本戳的对象生成一个新的; 版本随机生成, 版本戳被淘汰后也不会读到旧的表示
+    '''
+    keys = {_version_key(kind, pk): pk for pk in pks}
+    found = cache().get_many(list(keys.keys()))
+    result = {keys[key]: version for key, version in found.items()}
+    for key, pk in keys.items():
+        if pk not in result:
+            cache().add(key, uuid.uuid4().hex, None)
+            result[pk] = cache().get(key)
+    return result
+
+
+def fetch(kind: str, pks: List, load: Callable[[List], Dict]) -> Dict:
+    '''
+    批量读取表示, 未命中的由 load 一次性构造并写回
+    '''
+    if len(pks) == 0:
+        return {}
+    stamps = versions(kind, pks)
+    keys = {_key(kind, pk, stamps[pk]): pk for pk in pks}
+    found = cache().get_many(list(keys.keys()))
+    result = {keys[key]: data for key, data in found.items()}
+    missing = [pk for pk in pks if pk not in result]
+    if len(missing):
+        loaded = load(missing)
+        cache().set_many({_key(kind, pk, stamps[pk]): data for pk, data in loaded.items()}, settings.REPR_CACHE_TTL)
+        result.update(loaded)
+    return result
+
+
+def apply(kind: str, stamps: Dict) -> None:
+    cache().set_many({_version_key(kind, pk): version for pk, version in stamps.items()}, None)
+
+
+def invalidate(kind: str, pks: Iterable) -> None:
+    '''
+    提交后更换版本戳, 避免事务提交前被其他请求用旧数据重新缓存; 新的版本戳同时广播给其他进程
+    '''
+    pks = [pk for pk in set(pks) if pk is not None]
+    if len(pks) == 0:
+        return
+
+    def commit():
+        stamps = {pk: uuid.uuid4().hex for pk in pks}
+        apply(kind, stamps)
+        bus.publish(kind, stamps)
+
+    transaction.on_commit(commit)
@@ -27,10 +27,14 @@ def r(data: Any, code=0, msg="") -> dict:
         "data": data
     }
 
-def resp(name: str, data=None):
+def payload(name: str, data=None) -> tuple:
     info = get_config()
     for path in name.split("."):
         info = info[path]
     code, msg, status = info
-    return Response(r(data, code, msg), status=status)
+    return r(data, code, msg), status
+
+def resp(name: str, data=None):
+    body, status = payload(name, data)
+    return Response(body, status=status)
 
@@ -1,76 +1,452 @@
-from typing import Iterable
-from doc.models import Author, Doc, Access, DocTree, Chat, Message
+import json
+from typing import Dict, Iterable, List
+from django.db.models import Count, IntegerField, OuterRef, Prefetch, Subquery, Value, prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.db.models.query import QuerySet
+from doc_server import settings
+from doc.models import Activity, Author, AuthorStats, Doc, Access, DocTree, Chat, Message, DocVersion, GroupChat, GroupMessage
+from doc import archive, reprcache
 from rest_framework import serializers
 
+def nested_path(context: Dict, name: str) -> str:
+    prefix = context.get("prefix", None)
+    return name if not prefix else prefix + "." + name
+
+def expanded(context: Dict, path: str) -> bool:
+    '''
+    没有 expand 参数时保持原来的完整展开, 否则只展开 expand 中列出的路径
+    '''
+    expand = context.get("expand", None)
+    return expand is None or path in expand
+
+def nested_context(context: Dict, path: str) -> Dict:
+    return {"expand": context.get("expand", None), "prefix": path}
+
+
+class SparseFieldsMixin:
+    '''
+    fields= 只保留顶层的指定字段, expand= 控制嵌套的用户是否展开,
+    prepare 根据同样的参数裁剪查询的列和预取
+    '''
+    COLUMNS: Dict[str, str] = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = self.context.get("fields", None)
+        if fields is not None and "prefix" not in self.context:
+            for name in list(self.fields.keys()):
+                if name not in fields:
+                    self.fields.pop(name)
+
+    @classmethod
+    def requested(cls, context: Dict, name: str) -> bool:
+        fields = context.get("fields", None)
+        return fields is None or "prefix" in context or name in fields
+
+    @classmethod
+    def columns(cls, context: Dict) -> List[str]:
+        fields = context.get("fields", None)
+        if fields is None or "prefix" in context:
+            return None
+        return ["id"] + [column for name, column in cls.COLUMNS.items() if name in fields]
+
+    @classmethod
+    def lookups(cls, context: Dict) -> List[str]:
+        return []
+
+    @classmethod
+    def annotations(cls, context: Dict) -> Dict:
+        return {}
+
+    @classmethod
+    def prepare(cls, data, many: bool, context: Dict):
+        lookups = inline_prefetches(cls.lookups(context))
+        if isinstance(data, QuerySet):
+            if data.query.combinator is None:
+                columns = cls.columns(context)
+                if columns is not None:
+                    data = data.only(*columns)
+                annotations = cls.annotations(context)
+                if annotations:
+                    data = data.annotate(**annotations)
+            return data.prefetch_related(*lookups) if lookups else data
+        if lookups:
+            prefetch_related_objects(list(data) if many else [data], *lookups)
+        return data
+
+    @classmethod
+    def represent(cls, data, many: bool, context: Dict):
+        data = cls.prepare(data, many, context)
+        return cls(data, many=many, context=context).data
+
+
+class CachedRepresentationMixin:
+    '''
+    默认表示按 CACHE_KIND 和 pk 缓存, 列表先取 pk 再用一次 get_many 拼装, 只为未命中的对象查询和序列化
+    '''
+    CACHE_KIND: str = None
+
+    @classmethod
+    def fragments(cls, instances) -> Dict:
+        instances = cls.prepare(instances, True, {})
+        return {item["id"]: item for item in cls(instances, many=True, context={}).data}
+
+    @classmethod
+    def assemble(cls, fragments: List[Dict]) -> List[Dict]:
+        return fragments
+
+    @classmethod
+    def represent(cls, data, many: bool, context: Dict):
+        if not reprcache.applicable(context):
+            return super().represent(data, many, context)
+        if isinstance(data, QuerySet) and data.query.combinator is None and data.query.can_filter():
+            pks = list(data.values_list("pk", flat=True))
+            source = lambda missing: data.filter(pk__in=missing)
+        else:
+            instances = list(data) if many else [data]
+            pks = [instance.pk for instance in instances]
+            by_pk = {instance.pk: instance for instance in instances}
+            source = lambda missing: [by_pk[pk] for pk in missing]
+        found = reprcache.fetch(cls.CACHE_KIND, pks, lambda missing: cls.fragments(source(missing)))
+        result = cls.assemble([found[pk] for pk in pks if pk in found])
+        if many:
+            return result
+        return result[0] if len(result) else None
+
+
+# 嵌入的权限列表对应的外键
+INLINE_ACCESS = {"doc_accessible": "doc", "author_accessible": "author"}
+
+
+def inline_accesses(field: str) -> QuerySet:
+    '''
+    每个文档或用户只取 id 最小的 ACCESS_INLINE_LIMIT 项: 保留 id 小于第 LIMIT + 1 项 id 的行, 不足时全部保留
+    '''
+    accesses = Access.objects.order_by("id")
+    if settings.ACCESS_INLINE_LIMIT is None:
+        return accesses
+    limit = settings.ACCESS_INLINE_LIMIT
+    boundary = Access.objects.filter(**{field: OuterRef(field)}).order_by("id").values("id")[limit:limit + 1]
+    return accesses.filter(id__lt=Coalesce(Subquery(boundary, output_field=IntegerField()), Value(2 ** 63 - 1)))
+
+
+def inline_prefetches(lookups: List[str]) -> List:
+    '''
+    把预取路径中的权限列表换成限制数量的 Prefetch, 其余部分保持原样
+    '''
+    result = []
+    seen = set()
+    for lookup in lookups:
+        parts = lookup.split("__")
+        for i in range(1, len(parts) + 1):
+            path = "__".join(parts[:i])
+            if path in seen:
+                continue
+            seen.add(path)
+            field = INLINE_ACCESS.get(parts[i - 1], None)
+            result.append(Prefetch(path, queryset=inline_accesses(field)) if field else path)
+    return result
+
+
+def author_lookups(context: Dict, path: str, lookup: str) -> List[str]:
+    if not expanded(context, path):
+        return []
+    if expanded(context, path + ".author_accessible"):
+        return [lookup + "__author_accessible"]
+    return [lookup]
+
+
 class AuthorRelatedExpandedField(serializers.RelatedField):
+    def use_pk_only_optimization(self):
+        # 不展开时直接使用外键的值, 不再查询用户
+        return not expanded(self.context, self.path())
+
+    def path(self) -> str:
+        return nested_path(self.context, self.field_name or self.parent.field_name)
+
     def to_representation(self, value):
-        return AuthorSerializer(value).data
+        if self.use_pk_only_optimization():
+            return value.pk
+        return AuthorSerializer(value, context=nested_context(self.context, self.path())).data
 
 
 class ChatRelatedExpandedField(serializers.RelatedField):
     def to_representation(self, value):
         return ChatSerializer(value).data
 
-class DocAccessSerializer(serializers.HyperlinkedModelSerializer):
+class DocAccessSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     author = AuthorRelatedExpandedField(read_only=True)
+    COLUMNS = {"author": "author", "role": "role", "doc_id": "doc"}
     class Meta:
         model = Access
         fields = ["author", "role", "doc_id"]
 
+    @classmethod
+    def lookups(cls, context):
+        if not cls.requested(context, "author"):
+            return []
+        return author_lookups(context, nested_path(context, "author"), "author")
+
 
-class DocAccessListField(serializers.RelatedField):
+def access_count(field: str, lookup: str) -> Dict:
+    '''
+    关联子查询统计权限数, 走 Access 上以 doc 或 author 开头的索引, 外层查询不需要 GROUP BY
+    '''
+    counts = Access.objects.filter(**{lookup: OuterRef("pk")}).order_by().values(lookup).annotate(n=Count("*")).values("n")
+    return {field + "_count": Coalesce(Subquery(counts, output_field=IntegerField()), 0)}
+
+
+def counted(instance, field: str) -> int:
+    total = getattr(instance, field + "_count", None)
+    if total is not None:
+        return total
+    prefetched = getattr(instance, "_prefetched_objects_cache", {})
+    # 预取的列表已经被截断, 只有不满 ACCESS_INLINE_LIMIT 项时才是总数
+    if field in prefetched and (settings.ACCESS_INLINE_LIMIT is None or len(prefetched[field]) < settings.ACCESS_INLINE_LIMIT):
+        return len(prefetched[field])
+    return Access.objects.filter(**{INLINE_ACCESS[field]: instance.pk}).count()
+
+
+class InlineAccessList(serializers.ManyRelatedField):
+    '''
+    嵌入的权限列表最多 ACCESS_INLINE_LIMIT 项, 总数见 *_count, 完整列表通过分页接口获取
+    '''
+    def to_representation(self, iterable):
+        if settings.ACCESS_INLINE_LIMIT is not None:
+            # 预取时查询已经排序和限制, 否则在这里用 LIMIT 查询
+            if isinstance(iterable, QuerySet) and not iterable.ordered:
+                iterable = iterable.order_by("id")
+            iterable = iterable[:settings.ACCESS_INLINE_LIMIT]
+        return super().to_representation(iterable)
+
+
+class InlineAccessMixin:
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        return InlineAccessList(child_relation=cls(*args, **kwargs), read_only=kwargs.get("read_only", False))
+
+
+class DocAccessListField(InlineAccessMixin, serializers.RelatedField):
     def to_representation(self, value: Access):
-        return DocAccessSerializer(value).data
+        return DocAccessSerializer(value, context=nested_context(self.context, self.parent.field_name)).data
 
 
-class AuthorAccessListField(serializers.RelatedField):
+class AuthorAccessListField(InlineAccessMixin, serializers.RelatedField):
     def to_representation(self, value):
         return {"doc_id": value.doc_id, "role": value.role}
 
 
-class AuthorSerializer(serializers.HyperlinkedModelSerializer):
+class AuthorSerializer(CachedRepresentationMixin, SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     author_accessible = AuthorAccessListField(read_only=True, many=True)
+    author_accessible_count = serializers.SerializerMethodField()
+    COLUMNS = {"email": "email", "nickname": "nickname", "active": "active"}
+    CACHE_KIND = "author"
     class Meta:
         model = Author
-        fields = ["id", "email", "nickname", "active", "author_accessible"]
+        fields = ["id", "email", "nickname", "active", "author_accessible", "author_accessible_count"]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 嵌套的用户只有在 expand 中列出时才带上权限列表和权限数
+        if "prefix" in self.context and not expanded(self.context, nested_path(self.context, "author_accessible")):
+            self.fields.pop("author_accessible", None)
+            self.fields.pop("author_accessible_count", None)
 
+    def get_author_accessible_count(self, instance) -> int:
+        return counted(instance, "author_accessible")
 
-class DocSerializer(serializers.HyperlinkedModelSerializer):
+    @classmethod
+    def lookups(cls, context):
+        if not cls.requested(context, "author_accessible"):
+            return []
+        return ["author_accessible"]
+
+    @classmethod
+    def annotations(cls, context):
+        if not cls.requested(context, "author_accessible_count"):
+            return {}
+        return access_count("author_accessible", "author")
+
+
+class DocSerializer(CachedRepresentationMixin, SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     doc_accessible = DocAccessListField(read_only=True, many=True)
+    doc_accessible_count = serializers.SerializerMethodField()
+    COLUMNS = {"label": "label", "type": "type"}
+    CACHE_KIND = "doc"
     class Meta:
         model = Doc
-        fields = ["id", "label", "type", "doc_accessible"]
+        fields = ["id", "label", "type", "doc_accessible", "doc_accessible_count"]
+
+    def get_doc_accessible_count(self, instance) -> int:
+        return counted(instance, "doc_accessible")
+
+    @classmethod
+    def fragments(cls, instances):
+        # 缓存的文档只保存权限中用户的 id, 用户的表示单独缓存, 拼装时再填入
+        context = {"expand": set()}
+        instances = cls.prepare(instances, True, context)
+        return {item["id"]: item for item in cls(instances, many=True, context=context).data}
+
+    @classmethod
+    def assemble(cls, fragments):
+        author_ids = list(set(access["author"] for item in fragments for access in item["doc_accessible"]))
+        authors = reprcache.fetch("author", author_ids,
+            lambda missing: AuthorSerializer.fragments(Author.objects.filter(pk__in=missing)))
+        return [dict(item, doc_accessible=[dict(access, author=authors.get(access["author"], None))
+            for access in item["doc_accessible"]]) for item in fragments]
+
+    @classmethod
+    def lookups(cls, context):
+        if not cls.requested(context, "doc_accessible"):
+            return []
+        return author_lookups(context, "doc_accessible.author", "doc_accessible__author") or ["doc_accessible"]
+
+    @classmethod
+    def annotations(cls, context):
+        if not cls.requested(context, "doc_accessible_count"):
+            return {}
+        return access_count("doc_accessible", "doc")
+
+
+class AccessPageSerializer(serializers.Serializer):
+    '''
+    一页权限, results 按 expand= 展开, 没有 expand 参数时只展开 DEFAULT_EXPAND 中的路径
+    '''
+    DEFAULT_EXPAND = set()
+    total = serializers.IntegerField()
+    next = serializers.IntegerField(allow_null=True)
+    results = serializers.SerializerMethodField()
 
+    def get_results(self, page) -> List[Dict]:
+        expand = self.context.get("expand", None)
+        context = {"expand": self.DEFAULT_EXPAND if expand is None else expand}
+        if self.context.get("fields", None) is not None:
+            context["fields"] = self.context["fields"]
+        return DocAccessSerializer.represent(page.results, True, context)
 
-class DocTreeSerializer(serializers.HyperlinkedModelSerializer):
+
+class CollaboratorPageSerializer(AccessPageSerializer):
+    DEFAULT_EXPAND = {"author"}
+
+
+class ActivitySerializer(serializers.HyperlinkedModelSerializer):
+    payload = serializers.SerializerMethodField()
+    class Meta:
+        model = Activity
+        fields = ["id", "author_id", "doc_id", "target_id", "kind", "payload", "time"]
+
+    def get_payload(self, instance) -> Dict:
+        return json.loads(instance.payload)
+
+
+class ActivityPageSerializer(serializers.Serializer):
+    total = serializers.IntegerField()
+    next = serializers.IntegerField(allow_null=True)
+    results = ActivitySerializer(many=True)
+
+
+class DocVersionSerializer(serializers.HyperlinkedModelSerializer):
+    class Meta:
+        model = DocVersion
+        fields = ["id", "doc_id", "keyframe", "size", "time"]
+
+
+class DocTreeSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     author = AuthorRelatedExpandedField(read_only=True)
+    COLUMNS = {"author": "author", "content": "content", "timestamp": "timestamp"}
     class Meta:
         model = DocTree
         fields = ["id", "author", "content", "timestamp"]
 
+    @classmethod
+    def lookups(cls, context):
+        if not cls.requested(context, "author"):
+            return []
+        return author_lookups(context, "author", "author")
+
 
-class MessageSerializer(serializers.HyperlinkedModelSerializer):
+class MessageSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     sender = AuthorRelatedExpandedField(read_only=True)
     receiver = AuthorRelatedExpandedField(read_only=True)
+    COLUMNS = {"chat_id": "chat", "sender": "sender", "receiver": "receiver", "msg": "msg", "time": "time"}
     class Meta:
         model = Message
         fields = ["id", "chat_id", "sender", "receiver", "msg", "time"]
 
+    @classmethod
+    def lookups(cls, context):
+        lookups = []
+        for name in ("sender", "receiver"):
+            if cls.requested(context, name):
+                lookups.extend(author_lookups(context, nested_path(context, name), name))
+        return lookups
+
+
+class AuthorStatsSerializer(serializers.HyperlinkedModelSerializer):
+    class Meta:
+        model = AuthorStats
+        fields = ["author_id", "owned_docs", "collaborating_docs", "reading_docs", "unread_chats", "messages", "timestamp"]
+
+
+class GroupChatSerializer(serializers.HyperlinkedModelSerializer):
+    read_cursor = serializers.SerializerMethodField()
+    unread = serializers.SerializerMethodField()
+    class Meta:
+        model = GroupChat
+        fields = ["id", "name", "doc_id", "creator_id", "last_message_id", "time", "read_cursor", "unread"]
+
+    def get_read_cursor(self, instance) -> int:
+        return getattr(instance, "read_cursor", None)
+
+    def get_unread(self, instance) -> int:
+        return getattr(instance, "unread", None)
+
+
+class GroupMessageSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
+    sender = AuthorRelatedExpandedField(read_only=True)
+    COLUMNS = {"group_id": "group", "sender": "sender", "msg": "msg", "time": "time"}
+    class Meta:
+        model = GroupMessage
+        fields = ["id", "group_id", "sender", "msg", "time"]
+
+    @classmethod
+    def lookups(cls, context):
+        if not cls.requested(context, "sender"):
+            return []
+        return author_lookups(context, nested_path(context, "sender"), "sender")
+
 
 class ChatRecordsField(serializers.RelatedField):
     def to_representation(self, value):
         return [val[0] for val in value.values_list("id")]
 
 
-class ChatSerializer(serializers.HyperlinkedModelSerializer):
+class ChatSerializer(SparseFieldsMixin, serializers.HyperlinkedModelSerializer):
     initiator = AuthorRelatedExpandedField(read_only=True)
     recipient = AuthorRelatedExpandedField(read_only=True)
     records = ChatRecordsField(read_only=True)
+    COLUMNS = {"initiator": "initiator", "recipient": "recipient", "time": "time",
+        "initiator_unread": "initiator_unread", "recipient_unread": "recipient_unread"}
     class Meta:
         model = Chat
-        fields = ["id", "initiator", "recipient", "time", "records"]
-    
+        fields = ["id", "initiator", "recipient", "time", "initiator_unread", "recipient_unread", "records"]
+
+    @classmethod
+    def lookups(cls, context):
+        lookups = []
+        for name in ("initiator", "recipient"):
+            if cls.requested(context, name):
+                lookups.extend(author_lookups(context, name, name))
+        return lookups
+
     def to_representation(self, instance):
         data = super().to_representation(instance)
-        data["preview"] = MessageSerializer(Message.objects.get(pk=data["records"][-1])).data
+        if self.requested(self.context, "preview"):
+            if len(data.get("records", None) or []):
+                last = Message.objects.get(pk=data["records"][-1])
+            else:
+                # 热表中没有消息时取归档中的最后一条
+                last = archive.latest(instance)
+            data["preview"] = MessageSerializer(last,
+                context=nested_context(self.context, "preview")).data if last is not None else None
         return data
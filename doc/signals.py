@@ -0,0 +1,73 @@
+from django.db.models.signals import post_save, post_delete
+from doc.models import Access, Author, Doc, GroupChat, GroupMember
+from doc import bus, reprcache, stats, tokens
+
+# 只影响全文和修改时间的保存不会改变文档的表示
+CONTENT_FIELDS = frozenset(["full_text", "mod_time"])
+
+
+def doc_changed(sender, instance: Doc, update_fields=None, **kwargs):
+    if update_fields is not None and frozenset(update_fields) <= CONTENT_FIELDS:
+        return
+    reprcache.invalidate("doc", [instance.pk])
+
+
+def author_changed(sender, instance: Author, **kwargs):
+    reprcache.invalidate("author", [instance.pk])
+    tokens.forget(instance.pk)
+
+
+def access_changed(sender, instance: Access, **kwargs):
+    # 文档的权限列表和用户的权限列表都包含这条权限
+    reprcache.invalidate("doc", [instance.doc_id])
+    reprcache.invalidate("author", [instance.author_id])
+    reprcache.invalidate("roles", [instance.author_id])
+
+
+def access_saved(sender, instance: Access, **kwargs):
+    # 文档群聊的成员跟随权限变化, 新成员只计算加入之后的未读
+    group = GroupChat.objects.filter(doc_id=instance.doc_id).values_list("pk", "last_message_id").first()
+    if group is not None:
+        GroupMember.objects.get_or_create(group_id=group[0], author_id=instance.author_id, defaults={"read_cursor": group[1]})
+
+
+def access_deleted(sender, instance: Access, **kwargs):
+    GroupMember.objects.filter(group__doc_id=instance.doc_id, author_id=instance.author_id).delete()
+
+
+def live(instance: Access) -> bool:
+    # 回收站中的文档不计入统计, 回收时已经减掉
+    if Access.doc.is_cached(instance):
+        return not instance.doc.recycled
+    return Doc.objects.filter(pk=instance.doc_id, recycled=False).exists()
+
+
+def access_counted(sender, instance: Access, created=False, **kwargs):
+    old = None if created else getattr(instance, "_loaded_role", instance.role)
+    if old != instance.role and live(instance):
+        stats.role_changed(instance.author_id, old, instance.role)
+    instance._loaded_role = instance.role
+
+
+def access_uncounted(sender, instance: Access, **kwargs):
+    if live(instance):
+        stats.role_changed(instance.author_id, instance.role, None)
+
+
+def connect():
+    post_save.connect(doc_changed, sender=Doc)
+    post_delete.connect(doc_changed, sender=Doc)
+    post_save.connect(author_changed, sender=Author)
+    post_delete.connect(author_changed, sender=Author)
+    post_save.connect(access_changed, sender=Access)
+    post_delete.connect(access_changed, sender=Access)
+    post_save.connect(access_saved, sender=Access)
+    post_delete.connect(access_deleted, sender=Access)
+    post_save.connect(access_counted, sender=Access)
+    post_delete.connect(access_uncounted, sender=Access)
+    # 其他进程发出的失效事件
+    for kind in ("doc", "author", "roles"):
+        bus.subscribe(kind, lambda stamps, kind=kind: reprcache.apply(kind, stamps))
+    bus.subscribe("token", tokens.evict)
+    bus.on_reset(lambda: reprcache.cache().clear())
+    bus.on_reset(lambda: tokens.cache().clear())
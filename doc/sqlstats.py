@@ -0,0 +1,161 @@
+import os
+import re
+import sys
+import atexit
+import logging
+import threading
+from hashlib import md5
+from time import perf_counter, time
+from typing import Dict, Tuple
+from django.db import DatabaseError, connection, connections
+from django.db.backends.signals import connection_created
+from django.db.models import F
+from doc_server import settings
+from doc.utils import now
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+BIZ_FILE = os.path.join(PACKAGE_DIR, "biz.py")
+
+_local = threading.local()
+_lock = threading.Lock()
+_pending: Dict[str, Dict] = {}
+_seen = set()
+_last_flush = [time()]
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN\s*\((?:\s*(?:%s|\?)\s*,?)+\)", re.IGNORECASE)
+_SPACE = re.compile(r"\s+")
+
+
+def normalize(sql: str) -> str:
+    '''
+    把字面量和参数替换为占位符, 折叠 IN 列表, 相同形状的查询得到相同的结果
+    '''
+    sql = _STRING.sub("?", sql)
+    sql = _NUMBER.sub("?", sql)
+    sql = sql.replace("%s", "?")
+    sql = _IN_LIST.sub("IN (...)", sql)
+    return _SPACE.sub(" ", sql).strip()
+
+
+def fingerprint(sql: str) -> Tuple[str, str]:
+    shape = normalize(sql)
+    return md5(shape.encode("utf-8")).hexdigest(), shape
+
+
+def origin() -> Tuple[str, str]:
+    '''
+    返回发起查询的 biz 函数以及项目内最近的调用位置
+    '''
+    biz, site = "", ""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(PACKAGE_DIR) and filename != __file__:
+            if not site:
+                site = "{}:{} {}".format(os.path.relpath(filename, PACKAGE_DIR), frame.f_lineno, frame.f_code.co_name)
+            if filename == BIZ_FILE:
+                biz = frame.f_code.co_name
+                break
+        frame = frame.f_back
+    return biz, site
+
+
+def explain(conn, sql: str, params) -> str:
+    '''
+    在发出查询的同一个数据库上取执行计划
+    '''
+    if not sql.lstrip().upper().startswith("SELECT"):
+        return ""
+    prefix = "EXPLAIN QUERY PLAN " if conn.vendor == "sqlite" else "EXPLAIN "
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            return "\n".join(" | ".join(str(col) for col in row) for row in cursor.fetchall())
+    except Exception as e:
+        return "explain failed: {}".format(e)
+
+
+def _save(pending: Dict[str, Dict]) -> None:
+    from doc.models import QueryStat
+    for key, stat in pending.items():
+        updated = QueryStat.objects.filter(fingerprint=key).update(
+            count=F("count") + stat["count"], slow_count=F("slow_count") + stat["slow_count"],
+            total_ms=F("total_ms") + stat["total_ms"], last_seen=stat["last_seen"])
+        if updated == 0:
+            QueryStat.objects.create(fingerprint=key, shape=stat["shape"], biz=stat["biz"], site=stat["site"],
+                explain=explain(connections[stat["alias"]], stat["sql"], stat["params"]),
+                count=stat["count"], slow_count=stat["slow_count"], total_ms=stat["total_ms"], max_ms=stat["max_ms"], first_seen=stat["last_seen"], last_seen=stat["last_seen"])
+        elif stat["max_ms"] > 0:
+            QueryStat.objects.filter(fingerprint=key, max_ms__lt=stat["max_ms"]).update(
+                max_ms=stat["max_ms"], biz=stat["biz"], site=stat["site"])
+
+
+def flush() -> None:
+    '''
+    把进程内累计的统计写入 QueryStat, 并为新出现的查询形状记录执行计划
+    '''
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time()
+    if not pending:
+        return
+    _local.active = True
+    try:
+        _save(pending)
+    except DatabaseError as e:
+        # 统计表还未建立 (例如正在 migrate) 时丢弃这一批, 不影响正常查询
+        logger.debug("query stats dropped: %s", e)
+    finally:
+        _local.active = False
+
+
+def record(execute, sql, params, many, context):
+    if getattr(_local, "active", False):
+        return execute(sql, params, many, context)
+    conn = context["connection"]
+    if conn.alias == "default" and not conn.in_atomic_block and time() - _last_flush[0] > settings.SLOW_QUERY_FLUSH_INTERVAL:
+        flush()
+    started = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = (perf_counter() - started) * 1000
+        key, shape = fingerprint(sql)
+        slow = elapsed >= settings.SLOW_QUERY_THRESHOLD
+        # 调用栈在锁外取得; 并发时可能多取一次, 但计数和最大值在同一个锁内更新, flush 不会夹在中间
+        biz, site = origin() if slow or key not in _seen else ("", "")
+        with _lock:
+            stat = _pending.get(key, None)
+            if stat is None:
+                stat = _pending[key] = {"shape": shape, "sql": sql, "params": None if many else params, "alias": conn.alias,
+                    "count": 0, "slow_count": 0, "total_ms": 0.0, "max_ms": 0.0, "biz": "", "site": "", "last_seen": 0}
+            stat["count"] += 1
+            stat["total_ms"] += elapsed
+            stat["last_seen"] = now()
+            if slow:
+                stat["slow_count"] += 1
+            if (slow or key not in _seen) and elapsed >= stat["max_ms"]:
+                stat["max_ms"] = elapsed
+                stat["biz"], stat["site"] = biz, site
+            _seen.add(key)
+        if slow:
+            logger.warning("slow query %.1fms in %s (%s): %s", elapsed, biz or "-", site or "-", shape)
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    if record not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record)
+
+
+def install() -> None:
+    if not settings.SLOW_QUERY_LOG:
+        return
+    connection_created.connect(_on_connection_created)
+    for conn in connections.all():
+        _on_connection_created(None, conn)
+    atexit.register(lambda: flush() if connection.connection is not None else None)
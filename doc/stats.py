@@ -0,0 +1,155 @@
+from typing import Dict, Iterable, List
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from doc.models import Access, Author, AuthorStats, Chat, Message, MessageArchive
+from doc.utils import now
+
+# 用户以各角色加入的未回收文档数
+ROLE_FIELDS = {0: "reading_docs", 1: "collaborating_docs", 2: "owned_docs"}
+FIELDS = ["owned_docs", "collaborating_docs", "reading_docs", "unread_chats", "messages"]
+
+
+def compute(author_ids: Iterable[int]) -> Dict[int, Dict[str, int]]:
+    '''
+    按当前数据重新统计, 每项一条分组查询, 与用户人数无关
+    '''
+    author_ids = list(author_ids)
+    result = {pk: dict.fromkeys(FIELDS, 0) for pk in author_ids}
+    roles = Access.objects.filter(author_id__in=author_ids, doc__recycled=False).order_by() \
+        .values_list("author_id", "role").annotate(n=Count("*"))
+    for pk, role, n in roles:
+        result[pk][ROLE_FIELDS[role]] += n
+    for side in ("initiator", "recipient"):
+        unread = Chat.objects.filter(**{side + "_id__in": author_ids, side + "_unread__gt": 0}).order_by() \
+            .values_list(side + "_id").annotate(n=Count("*"))
+        # 自己和自己的聊天只算一次
+        hot = Message.objects.filter(**{"chat__" + side + "_id__in": author_ids}).order_by() \
+            .values_list("chat__" + side + "_id").annotate(n=Count("*"))
+        archived = MessageArchive.objects.filter(**{"chat__" + side + "_id__in": author_ids}).order_by() \
+            .values_list("chat__" + side + "_id").annotate(n=Sum("count"))
+        if side == "recipient":
+            unread = unread.exclude(initiator_id=F("recipient_id"))
+            hot = hot.exclude(chat__initiator_id=F("chat__recipient_id"))
+            archived = archived.exclude(chat__initiator_id=F("chat__recipient_id"))
+        for pk, n in unread:
+            result[pk]["unread_chats"] += n
+        for pk, n in list(hot) + list(archived):
+            result[pk]["messages"] += n
+    return result
+
+
+def create(counts: Dict[int, Dict[str, int]]) -> None:
+    for pk, values in counts.items():
+        try:
+            with transaction.atomic():
+                AuthorStats.objects.create(author_id=pk, **values)
+        except IntegrityError:
+            # 并发的请求已经建好了这一行, 它的统计已经包含当前的变化
+            pass
+
+
+def bump(author_ids: Iterable[int], **deltas) -> None:
+    '''
+    在数据变化之后调用, 按 deltas 增减计数; 还没有统计的用户直接按当前数据建立
+    '''
+    author_ids = set(pk for pk in author_ids if pk is not None)
+    if len(author_ids) == 0:
+        return
+    values = {field: F(field) + delta for field, delta in deltas.items()}
+    updated = AuthorStats.objects.filter(author_id__in=author_ids).update(timestamp=now(), **values)
+    if updated < len(author_ids):
+        existing = set(AuthorStats.objects.filter(author_id__in=author_ids).values_list("author_id", flat=True))
+        create(compute(author_ids - existing))
+
+
+def role_changed(author_id: int, old: int, new: int) -> None:
+    deltas = {}
+    if old is not None:
+        deltas[ROLE_FIELDS[old]] = -1
+    if new is not None:
+        deltas[ROLE_FIELDS[new]] = deltas.get(ROLE_FIELDS[new], 0) + 1
+    deltas = {field: delta for field, delta in deltas.items() if delta != 0}
+    if len(deltas):
+        bump([author_id], **deltas)
+
+
+def docs_recycled(doc_ids: List[int], delta: int) -> None:
+    '''
+    文档回收 (delta 为 -1) 或恢复 (delta 为 1) 时, 所有有权限的用户的对应计数一起变化, 每个角色一条更新
+    '''
+    if len(doc_ids) == 0:
+        return
+    for role, field in ROLE_FIELDS.items():
+        accesses = Access.objects.filter(doc_id__in=doc_ids, role=role)
+        counts = accesses.filter(author_id=OuterRef("author_id")).order_by().values("author_id") \
+            .annotate(n=Count("*")).values("n")
+        AuthorStats.objects.filter(author_id__in=accesses.values("author_id")).update(timestamp=now(),
+            **{field: F(field) + delta * Coalesce(Subquery(counts, output_field=IntegerField()), 0)})
+
+
+def message_sent(message: Message) -> None:
+    '''
+    双方的消息数加一; 接收方的这个聊天由已读变为未读时, 未读聊天数加一
+    '''
+    chat = message.chat
+    bump([chat.initiator_id, chat.recipient_id], messages=1)
+    if message.sender_id == message.receiver_id or message.receiver_id is None:
+        return
+    side = "recipient_unread" if message.receiver_id == chat.recipient_id else "initiator_unread"
+    if Chat.objects.filter(pk=chat.pk, **{side: 0}).update(**{side: 1}):
+        bump([message.receiver_id], unread_chats=1)
+    else:
+        Chat.objects.filter(pk=chat.pk).update(**{side: F(side) + 1})
+
+
+def chat_read(chat: Chat, author: Author) -> None:
+    side = "initiator_unread" if author.pk == chat.initiator_id else "recipient_unread"
+    if Chat.objects.filter(pk=chat.pk, **{side + "__gt": 0}).update(**{side: 0}):
+        setattr(chat, side, 0)
+        bump([author.pk], unread_chats=-1)
+
+
+def refresh(author_ids: Iterable[int]) -> None:
+    '''
+    不经过模型信号的批量写入之后, 直接按当前数据重新统计这些用户
+    '''
+    counts = compute(set(pk for pk in author_ids if pk is not None))
+    existing = set(AuthorStats.objects.filter(author_id__in=counts.keys()).values_list("author_id", flat=True))
+    for pk in existing:
+        AuthorStats.objects.filter(author_id=pk).update(timestamp=now(), **counts.pop(pk))
+    create(counts)
+
+
+def get(author_id: int) -> AuthorStats:
+    stats = AuthorStats.objects.filter(author_id=author_id).first()
+    if stats is None:
+        create(compute([author_id]))
+        stats = AuthorStats.objects.get(author_id=author_id)
+    return stats
+
+
+def reconcile(batch_size: int, dry_run: bool = False) -> Dict[str, int]:
+    '''
+    按用户 id 分批重新统计并改正有偏差的行; 统计和写入之间发生的变化会被覆盖, 下一次校正时改正
+    '''
+    result = {"authors": 0, "created": 0, "fixed": 0}
+    last_pk = 0
+    while True:
+        author_ids = list(Author.objects.filter(pk__gt=last_pk).order_by("pk").values_list("pk", flat=True)[:batch_size])
+        if len(author_ids) == 0:
+            return result
+        last_pk = author_ids[-1]
+        result["authors"] += len(author_ids)
+        counts = compute(author_ids)
+        existing = {row["author_id"]: row for row in AuthorStats.objects.filter(author_id__in=author_ids).values("author_id", *FIELDS)}
+        for pk, values in counts.items():
+            row = existing.get(pk, None)
+            if row is None:
+                result["created"] += 1
+                if not dry_run:
+                    create({pk: values})
+            elif any(row[field] != values[field] for field in FIELDS):
+                result["fixed"] += 1
+                if not dry_run:
+                    AuthorStats.objects.filter(author_id=pk).update(timestamp=now(), **values)
@@ -0,0 +1,31 @@
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from django.db import close_old_connections
+from doc_server import settings
+
+logger = logging.getLogger(__name__)
+
+executor = ThreadPoolExecutor(max_workers=settings.IO_THREADS, thread_name_prefix="doc-io")
+
+
+def _run(func, *args, **kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def _report(future: Future) -> None:
+    error = future.exception()
+    if error is not None:
+        logger.error("background task failed", exc_info=error)
+
+
+def submit(func, *args, **kwargs) -> Future:
+    '''
+    把邮件、中间层通知、Mongo 等阻塞 I/O 交给后台线程池, 不占用处理请求的线程
+    '''
+    future = executor.submit(_run, func, *args, **kwargs)
+    future.add_done_callback(_report)
+    return future
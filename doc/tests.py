@@ -1,3 +1,1113 @@
-from django.test import TestCase
+import os
+import json
+import time
+import socket
+import shutil
+import tempfile
+import requests
+from io import StringIO
+from smtplib import SMTPException
+from unittest import mock
+from django.core import mail
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from doc import activity, archive, biz, bus, feed, hashing, idempotency, profiling, reprcache, sqlstats, stats, throttle, tokens, workspace
+from doc.exceptions import BizException
+from doc.serializers import AuthorSerializer, DocSerializer
+from doc.utils import apply_delta, make_delta, now
+from doc_server import settings
+from doc.models import Access, Activity, Author, AuthorStats, Chat, CollaborateToken, Doc, DocTree, DocVersion, FeedEvent, GroupChat, GroupMember, IdempotencyRecord, Message, QueryStat, ReadToken, Token
 
-# Create your tests here.
+
+class ApiTestCase(TestCase):
+
+    def author(self, email: str) -> Author:
+        author = Author.objects.create(email=email, nickname=email.split("@")[0], active=True)
+        author.token = Token.objects.create(author=author).content
+        return author
+
+    def call(self, method: str, path: str, author: Author = None, data=None, content_type="application/json", **extra):
+        if author is not None:
+            path += ("&" if "?" in path else "?") + "token=" + author.token
+        if data is not None and content_type == "application/json":
+            data = json.dumps(data)
+        return getattr(self.client, method)(path, data=data, content_type=content_type, **extra)
+
+
+class WorkspaceImportTest(ApiTestCase):
+
+    def setUp(self):
+        self.a = self.author("a@x.com")
+        self.b = self.author("b@x.com")
+        self.c = self.author("c@x.com")
+
+    def post(self, *records, raw: bytes = b""):
+        body = b"".join(json.dumps(record).encode("utf-8") + b"\n" for record in records) + raw
+        return self.call("post", "/workspace/{}".format(self.a.pk), self.a, body, content_type="application/x-ndjson")
+
+    def test_rejects_chat_between_other_authors(self):
+        chat = Chat.objects.create(initiator=self.b, recipient=self.c)
+        response = self.post(
+            {"type": "author", "email": "a@x.com"},
+            {"type": "chat", "id": 1, "initiator": "b@x.com", "recipient": "c@x.com", "time": 0},
+            {"type": "message", "chat": 1, "sender": "b@x.com", "receiver": "c@x.com", "msg": "forged", "time": 0})
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Message.objects.filter(chat=chat).exists())
+
+    def test_rejects_message_from_outside_the_chat(self):
+        response = self.post(
+            {"type": "author", "email": "a@x.com"},
+            {"type": "chat", "id": 1, "initiator": "a@x.com", "recipient": "b@x.com", "time": 0},
+            {"type": "message", "chat": 1, "sender": "c@x.com", "receiver": "b@x.com", "msg": "forged", "time": 0})
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(Chat.objects.exists())
+        self.assertFalse(Message.objects.exists())
+
+    def test_imports_own_chat(self):
+        response = self.post(
+            {"type": "author", "email": "a@x.com"},
+            {"type": "chat", "id": 1, "initiator": "a@x.com", "recipient": "b@x.com", "time": 0},
+            {"type": "message", "chat": 1, "sender": "b@x.com", "receiver": "a@x.com", "msg": "hi", "time": 0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Message.objects.get().sender_id, self.b.pk)
+
+    def test_malformed_line_is_bad_request(self):
+        doc = {"type": "doc", "id": 1, "label": "d", "doc_type": "0", "recycled": False, "recycle_time": 0,
+            "full_text": "", "create_time": 0, "mod_time": 0}
+        response = self.post({"type": "author", "email": "a@x.com"}, doc, raw=b"{not json\n")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Doc.objects.exists())
+
+    def test_missing_key_is_bad_request(self):
+        response = self.post({"type": "author", "email": "a@x.com"}, {"id": 1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_imported_docs_get_their_own_ids(self):
+        Doc.objects.create(label="existing", type="0")
+        docs = [{"type": "doc", "id": 10 + i, "label": "d{}".format(i), "doc_type": "0", "recycled": False, "recycle_time": 0,
+            "full_text": "", "create_time": 0, "mod_time": 0} for i in range(3)]
+        accesses = [{"type": "access", "doc": 10 + i, "author": "a@x.com", "role": 2} for i in range(3)]
+        tree = {"type": "doctree", "content": json.dumps({"children": {"k": {"id": 11}}}), "timestamp": 0}
+        response = self.post({"type": "author", "email": "a@x.com"}, *docs, *accesses, tree)
+        self.assertEqual(response.status_code, 200)
+        labels = dict(Access.objects.filter(author=self.a).values_list("doc_id", "doc__label"))
+        self.assertEqual(sorted(labels.values()), ["d0", "d1", "d2"])
+        ids = {label: pk for pk, label in labels.items()}
+        self.assertEqual(json.loads(DocTree.objects.get(author=self.a).content), {"children": {"k": {"id": ids["d1"]}}})
+
+    def test_archived_messages_round_trip(self):
+        chat = Chat.objects.create(initiator=self.a, recipient=self.b)
+        for i in range(6):
+            Message.objects.create(chat=chat, sender=self.a, receiver=self.b, msg=str(i), time=i if i < 4 else now())
+        with mock.patch.object(settings, "MESSAGE_ARCHIVE_SEGMENT", 3):
+            archive.archive_messages(age=now() - 1000)
+        self.assertEqual(Message.objects.count(), 2)
+        records = list(workspace.export_records(self.a))
+        self.assertEqual([record["msg"] for record in records if record["type"] == "message"], [str(i) for i in range(6)])
+        chat.delete()
+        self.assertEqual(self.post(*records).status_code, 200)
+        self.assertEqual(list(Message.objects.order_by("pk").values_list("msg", flat=True)), [str(i) for i in range(6)])
+
+    def test_duplicate_access_rolls_back(self):
+        doc = {"type": "doc", "id": 1, "label": "d", "doc_type": "0", "recycled": False, "recycle_time": 0,
+            "full_text": "", "create_time": 0, "mod_time": 0}
+        access = {"type": "access", "doc": 1, "author": "a@x.com", "role": 2}
+        response = self.post({"type": "author", "email": "a@x.com"}, doc, access, access)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Doc.objects.exists())
+        self.assertFalse(Access.objects.exists())
+
+
+class FeedTest(ApiTestCase):
+
+    def setUp(self):
+        self.a = self.author("a@x.com")
+
+    def test_bad_cursor_is_bad_request(self):
+        self.assertEqual(self.call("get", "/feed/?cursor=abc", self.a).status_code, 400)
+        self.assertEqual(self.call("get", "/feed/", self.a, HTTP_LAST_EVENT_ID="abc").status_code, 400)
+
+    def test_bad_timeout_is_bad_request(self):
+        self.assertEqual(self.call("get", "/feed/?timeout=abc", self.a).status_code, 400)
+        self.assertEqual(self.call("get", "/feed/?timeout=nan", self.a).status_code, 400)
+
+    def test_pending_events_return_immediately(self):
+        event = FeedEvent.objects.create(author=self.a, kind="x", payload="{}")
+        response = self.call("get", "/feed/?cursor=0&timeout=-1", self.a)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["data"]["cursor"], event.pk)
+
+    def test_long_poll_times_out_empty(self):
+        response = self.call("get", "/feed/?cursor=0&timeout=0.1", self.a)
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(body["data"], {"cursor": 0, "events": []})
+
+
+class FeedPublishTest(TransactionTestCase):
+
+    def test_notify_after_commit(self):
+        author = Author.objects.create(email="a@x.com", nickname="a", active=True)
+        with mock.patch.object(feed.hub, "notify") as notify:
+            with transaction.atomic():
+                feed.publish([author.pk], "x", {})
+                notify.assert_not_called()
+            notify.assert_called_once_with([author.pk])
+
+
+class DocTreeTest(ApiTestCase):
+
+    def setUp(self):
+        self.a = self.author("a@x.com")
+        self.doc = Doc.objects.create(label="d", type="0")
+        Access.objects.create(author=self.a, doc=self.doc, role=2)
+
+    def test_legacy_string_ids(self):
+        content = json.dumps({"children": {"k": {"id": str(self.doc.pk)}}})
+        DocTree.objects.create(author=self.a, content=content)
+        response = self.call("get", "/doctree/{}".format(self.a.pk), self.a)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(DocTree.objects.get(author=self.a).content, content)
+
+    def test_malformed_tree_is_returned_unchanged(self):
+        DocTree.objects.create(author=self.a, content=json.dumps({"children": {"k": {"id": "x"}}}))
+        response = self.call("get", "/doctree/{}".format(self.a.pk), self.a)
+        self.assertEqual(response.status_code, 200)
+
+
+class InlineAccessLimitTest(TestCase):
+
+    def setUp(self):
+        self.authors = [Author.objects.create(email="{}@x.com".format(i), nickname=str(i)) for i in range(5)]
+        self.docs = [Doc.objects.create(label=str(i), type="0") for i in range(2)]
+        for doc in self.docs:
+            for author in reversed(self.authors):
+                Access.objects.create(author=author, doc=doc, role=0)
+
+    def test_limit_applied_per_doc_in_query(self):
+        with mock.patch.object(settings, "ACCESS_INLINE_LIMIT", 3):
+            docs = list(DocSerializer.prepare(Doc.objects.order_by("id"), True, {"expand": set()}))
+            for doc in docs:
+                loaded = doc._prefetched_objects_cache["doc_accessible"]
+                expected = list(Access.objects.filter(doc=doc).order_by("id").values_list("id", flat=True)[:3])
+                self.assertEqual([access.pk for access in loaded], expected)
+            data = DocSerializer(docs, many=True, context={"expand": set()}).data
+        self.assertEqual([len(item["doc_accessible"]) for item in data], [3, 3])
+        self.assertEqual([item["doc_accessible_count"] for item in data], [5, 5])
+
+    def test_nested_author_lists_are_limited(self):
+        with mock.patch.object(settings, "ACCESS_INLINE_LIMIT", 1):
+            data = DocSerializer.represent(self.docs, True, {"expand": {"doc_accessible.author", "doc_accessible.author.author_accessible"}})
+        self.assertEqual(len(data[0]["doc_accessible"]), 1)
+        author = data[0]["doc_accessible"][0]["author"]
+        self.assertEqual(len(author["author_accessible"]), 1)
+        self.assertEqual(author["author_accessible_count"], 2)
+
+    def test_unprefetched_list_is_limited(self):
+        with mock.patch.object(settings, "ACCESS_INLINE_LIMIT", 2):
+            data = AuthorSerializer(self.authors[0], context={"expand": set()}).data
+        self.assertEqual(len(data["author_accessible"]), 2)
+        self.assertEqual(data["author_accessible_count"], 2)
+
+
+class IdempotencyTest(ApiTestCase):
+
+    def setUp(self):
+        self.a = self.author("a@x.com")
+
+    def create_doc(self, label: str, key: str = "k"):
+        return self.call("post", "/doc/2/{}".format(self.a.pk), self.a, {"label": label, "type": "doc"}, HTTP_IDEMPOTENCY_KEY=key)
+
+    def take_over(self):
+        # 原请求超过 IDEMPOTENCY_LOCK_TIMEOUT 仍未完成, 重试接管了记录
+        IdempotencyRecord.objects.update(timestamp=F("timestamp") - settings.IDEMPOTENCY_LOCK_TIMEOUT - 1)
+        record = IdempotencyRecord.objects.get()
+        self.assertEqual(idempotency.claim(self.a, "k", record.endpoint, record.fingerprint), (None, mock.ANY))
+        return IdempotencyRecord.objects.get()
+
+    def test_slow_success_does_not_overwrite_new_owner(self):
+        create_doc = biz.create_doc
+        def slow(*args):
+            self.owner = self.take_over()
+            return create_doc(*args)
+        with mock.patch.object(biz, "create_doc", slow):
+            self.assertEqual(self.create_doc("d").status_code, 200)
+        record = IdempotencyRecord.objects.get()
+        self.assertIsNone(record.status)
+        self.assertEqual(record.timestamp, self.owner.timestamp)
+
+    def test_slow_failure_does_not_delete_new_owner(self):
+        def slow(*args):
+            self.owner = self.take_over()
+            raise BizException("common.bad_request")
+        with mock.patch.object(biz, "create_doc", slow):
+            self.assertEqual(self.create_doc("d").status_code, 400)
+        self.assertEqual(IdempotencyRecord.objects.get().timestamp, self.owner.timestamp)
+
+    def test_replay(self):
+        first = self.create_doc("d")
+        second = self.create_doc("d")
+        self.assertEqual(first.json(), second.json())
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(Doc.objects.count(), 1)
+
+    def test_batch_does_not_forward_key(self):
+        items = [{"method": "POST", "path": "/doc/2/{}".format(self.a.pk), "body": {"label": label, "type": "doc"}}
+            for label in ("d1", "d2")]
+        response = self.call("post", "/batch/", self.a, items, HTTP_IDEMPOTENCY_KEY="k")
+        self.assertEqual([item["status"] for item in response.json()["data"]], [200, 200])
+        self.assertEqual(Doc.objects.count(), 2)
+        self.assertFalse(IdempotencyRecord.objects.exists())
+
+
+class PurgeTest(TestCase):
+
+    def setUp(self):
+        self.a = Author.objects.create(email="a@x.com", nickname="a")
+        self.b = Author.objects.create(email="b@x.com", nickname="b")
+        self.docs = [Doc.objects.create(label=str(i), type="0", recycled=i > 0) for i in range(3)]
+        for doc in self.docs:
+            Access.objects.create(author=self.a, doc=doc, role=2)
+            Access.objects.create(author=self.b, doc=doc, role=0)
+        group = GroupChat.objects.create(doc=self.docs[1])
+        GroupMember.objects.create(group=group, author=self.b, read_cursor=0)
+
+    def test_purge_removes_recycled_docs_only(self):
+        owned = stats.get(self.a.pk).owned_docs
+        with mock.patch.object(biz, "db"):
+            self.assertEqual(biz.purge_docs([doc.pk for doc in self.docs], chunk_size=1), 2)
+        self.assertEqual(list(Doc.objects.values_list("pk", flat=True)), [self.docs[0].pk])
+        self.assertEqual(Access.objects.count(), 2)
+        self.assertFalse(GroupMember.objects.exists())
+        self.assertEqual(stats.get(self.a.pk).owned_docs, owned)
+        self.assertEqual(stats.compute([self.a.pk])[self.a.pk]["owned_docs"], owned)
+
+
+class DocVersionTest(ApiTestCase):
+
+    TEXTS = ["", "a\nb\nc", "a\nb\nc\n", "x\na\nc\n", "x\na\nc\nd", "\r\nx\r\n", "x\n\n\n", "完成\n", "", "a\n"]
+
+    def test_delta_round_trip(self):
+        for old in self.TEXTS:
+            for new in self.TEXTS:
+                self.assertEqual(apply_delta(old, make_delta(old, new)), new)
+
+    def test_versions_across_keyframes(self):
+        doc = Doc.objects.create(label="d", type="0")
+        with mock.patch.object(settings, "VERSION_KEYFRAME_INTERVAL", 3):
+            for text in self.TEXTS:
+                doc.full_text = text
+                biz.snapshot_doc(doc)
+        versions = list(DocVersion.objects.filter(doc=doc).order_by("pk"))
+        # 内容没有变化时不生成版本
+        texts = [text for i, text in enumerate(self.TEXTS) if i == 0 or text != self.TEXTS[i - 1]]
+        self.assertEqual([version.load() for version in versions], texts)
+        self.assertEqual([version.keyframe for version in versions], [i % 3 == 0 for i in range(len(versions))])
+
+    def test_restore_loads_text_with_doc(self):
+        a = self.author("a@x.com")
+        doc = Doc.objects.create(label="d", type="0", full_text="old")
+        Access.objects.create(author=a, doc=doc, role=2)
+        version = biz.snapshot_doc(Doc.objects.defer(None).get(pk=doc.pk))
+        Doc.objects.filter(pk=doc.pk).update(full_text="new")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.call("post", "/doc/{}/versions/{}".format(doc.pk, version.pk), a)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Doc.objects.defer(None).get(pk=doc.pk).full_text, "old")
+        self.assertEqual([version.load() for version in DocVersion.objects.filter(doc=doc).order_by("pk")], ["old", "new", "old"])
+        # full_text 不再在访问时单独补查
+        reloads = [query for query in queries.captured_queries if query["sql"].startswith('SELECT "doc_doc"."id", "doc_doc"."full_text" FROM')]
+        self.assertEqual(reloads, [])
+
+
+class RegisterTest(ApiTestCase):
+
+    DATA = {"email": "a@x.com", "password": "secret", "nickname": "a"}
+
+    def test_mail_failure_is_reported_and_retry_resends(self):
+        with mock.patch.object(biz, "send_mail", side_effect=SMTPException("down")), self.assertLogs("doc.biz", "ERROR"):
+            response = self.call("post", "/author/", data=self.DATA)
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(Author.objects.get(email="a@x.com").active)
+        response = self.call("post", "/author/", data=self.DATA)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ["a@x.com"])
+
+
+class NotifyMidTest(TestCase):
+
+    def response(self, status):
+        response = requests.Response()
+        response.status_code = status
+        return response
+
+    def test_retries_then_succeeds(self):
+        replies = [requests.ConnectionError("down"), self.response(502), self.response(200)]
+        with mock.patch.object(settings, "MID_NOTIFY_BACKOFF", 0), \
+                mock.patch.object(requests, "post", side_effect=replies) as post:
+            self.assertTrue(biz.post_mid("access_change", {}))
+        self.assertEqual(post.call_count, 3)
+
+    def test_gives_up_and_logs(self):
+        with mock.patch.object(settings, "MID_NOTIFY_BACKOFF", 0), \
+                mock.patch.object(requests, "post", side_effect=requests.ConnectionError("down")) as post, \
+                self.assertLogs("doc.biz", "ERROR"):
+            self.assertFalse(biz.post_mid("access_change", {}))
+        self.assertEqual(post.call_count, settings.MID_NOTIFY_RETRIES + 1)
+
+
+class BatchTest(ApiTestCase):
+
+    def setUp(self):
+        self.a = self.author("a@x.com")
+
+    def test_nested_batch_is_rejected(self):
+        inner = [{"path": "/author/{}".format(self.a.pk)}]
+        items = [{"path": "/batch/", "method": "POST", "body": inner}, inner[0]]
+        response = self.call("post", "/batch/", self.a, {"requests": items, "parallel": True})
+        self.assertEqual([item["status"] for item in response.json()["data"]], [400, 200])
+        # 部署在子路径下时 request.path 与子请求的路径不同
+        response = self.call("post", "/batch/", self.a, items, SCRIPT_NAME="/api")
+        self.assertEqual([item["status"] for item in response.json()["data"]], [400, 200])
+
+    def test_sub_requests_are_charged_individually(self):
+        items = [{"path": "/author/{}".format(self.a.pk)}, {"path": "/message/query", "query": {"keywords": "x"}}]
+        with mock.patch.object(settings, "THROTTLE_ENABLED", True), mock.patch.object(throttle, "check") as check:
+            response = self.call("post", "/batch/", self.a, items)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([call[0][1] for call in check.call_args_list], ["read", "search"])
+
+
+class SqlStatsTest(TestCase):
+
+    def setUp(self):
+        sqlstats._pending.clear()
+        sqlstats._seen.clear()
+
+    def run_queries(self, times: int):
+        with mock.patch.object(settings, "SLOW_QUERY_THRESHOLD", 0), self.assertLogs("doc.sqlstats", "WARNING"):
+            with connection.execute_wrapper(sqlstats.record):
+                for i in range(times):
+                    list(Author.objects.filter(id=i + 1))
+        key, = [key for key, stat in sqlstats._pending.items() if "doc_author" in stat["shape"]]
+        return key
+
+    def test_fingerprint_ignores_literals(self):
+        key, shape = sqlstats.fingerprint("SELECT * FROM doc_doc WHERE id IN (1, 2, 3) AND title = 'a'")
+        self.assertEqual(shape, "SELECT * FROM doc_doc WHERE id IN (...) AND title = ?")
+        self.assertEqual(key, sqlstats.fingerprint("SELECT *  FROM doc_doc\nWHERE id IN (%s, %s) AND title = 'it''s'")[0])
+        self.assertNotEqual(key, sqlstats.fingerprint("SELECT * FROM doc_chat WHERE id IN (1) AND title = 'a'")[0])
+
+    def test_record_and_flush(self):
+        key = self.run_queries(3)
+        pending = sqlstats._pending[key]
+        self.assertEqual((pending["count"], pending["slow_count"], pending["alias"]), (3, 3, "default"))
+        self.assertIn("tests.py", pending["site"])
+        sqlstats.flush()
+        self.assertEqual(sqlstats._pending, {})
+        stat = QueryStat.objects.get(fingerprint=key)
+        self.assertEqual((stat.count, stat.slow_count), (3, 3))
+        self.assertTrue(stat.explain)
+        self.assertNotIn("explain failed", stat.explain)
+        # 再次出现的形状累加到已有的行上
+        self.run_queries(2)
+        sqlstats.flush()
+        stat.refresh_from_db()
+        self.assertEqual((stat.count, stat.slow_count), (5, 5))
+
+    def test_explain_skips_writes(self):
+        self.assertEqual(sqlstats.explain(connection, "UPDATE doc_author SET nickname = %s", ["x"]), "")
+
+    def test_query_report(self):
+        out = StringIO()
+        call_command("query_report", stdout=out)
+        self.assertIn("no matching queries recorded", out.getvalue())
+        key = self.run_queries(1)
+        out = StringIO()
+        call_command("query_report", "--explain", stdout=out)
+        self.assertIn(key[:8], out.getvalue())
+        self.assertIn("doc_author", out.getvalue())
+        self.assertIn(QueryStat.objects.get(fingerprint=key).explain.splitlines()[0], out.getvalue())
+
+
+class ThrottleTest(TestCase):
+
+    def request(self, token: str):
+        return mock.Mock(META={"REMOTE_ADDR": "10.0.0.1"}, GET={"token": token}, query_params=None)
+
+    def test_memory_buckets(self):
+        buckets = throttle.MemoryBuckets()
+        spec = [("token:a", 1, 3)]
+        self.assertEqual([buckets.take(spec, 1) for _ in range(3)], [0, 0, 0])
+        self.assertGreater(buckets.take(spec, 1), 0)
+        # 被拒绝的请求不扣除令牌, 其他桶不受影响
+        self.assertEqual(buckets.take([("token:b", 1, 3)], 3), 0)
+
+    def test_sqlite_buckets(self):
+        path = os.path.join(tempfile.mkdtemp(), "throttle.sqlite3")
+        buckets = throttle.SQLiteBuckets(path)
+        spec = [("token:a", 1, 20), ("ip:x", 1, 10)]
+        self.assertEqual(buckets.take(spec, 10), 0)
+        self.assertGreater(buckets.take(spec, 10), 0)
+        self.assertEqual(buckets.connect().execute("PRAGMA synchronous").fetchone()[0], 1)
+
+    def test_cheap_costs_stay_in_process(self):
+        with mock.patch.object(throttle.backend, "take", return_value=0) as shared, \
+                mock.patch.object(throttle, "local_backend", throttle.MemoryBuckets()):
+            for _ in range(settings.THROTTLE_AUTHOR_BURST):
+                throttle.check(self.request("t1"), "read")
+            with self.assertRaises(BizException):
+                throttle.check(self.request("t1"), "read")
+            self.assertFalse(shared.called)
+            throttle.check(self.request("t1"), "search")
+            self.assertEqual(shared.call_count, 1)
+
+
+class ArchiveTest(ApiTestCase):
+
+    def setUp(self):
+        self.a = self.author("a@x.com")
+        self.b = self.author("b@x.com")
+        self.chat = Chat.objects.create(initiator=self.a, recipient=self.b)
+        # 0-5 归档为两段, 6-7 留在热表
+        for i in range(8):
+            Message.objects.create(chat=self.chat, sender=self.a, receiver=self.b, msg="m{}".format(i),
+                time=now() - 10000 + i if i < 6 else now())
+        with mock.patch.object(settings, "MESSAGE_ARCHIVE_SEGMENT", 3):
+            archive.archive_messages(age=1000)
+
+    def test_page_counts_hot_messages_only_at_the_boundary(self):
+        msgs = lambda start, end: [message.msg for message in archive.page(self.chat, start, end)]
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(msgs(0, 2), ["m7", "m6"])
+        self.assertFalse([query for query in queries if "COUNT(" in query["sql"]])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(msgs(1, 5), ["m6", "m5", "m4", "m3"])
+        self.assertFalse([query for query in queries if "COUNT(" in query["sql"]])
+        self.assertEqual(msgs(4, 8), ["m3", "m2", "m1", "m0"])
+        self.assertEqual(msgs(8, 10), [])
+
+    def test_search_pages_through_segments(self):
+        found, cursor = archive.search(self.a, "M", max_segments=1)
+        self.assertEqual([message.msg for message in found], ["m3", "m4", "m5"])
+        found, cursor = archive.search(self.a, "m", before=cursor, max_segments=1)
+        self.assertEqual([message.msg for message in found], ["m0", "m1", "m2"])
+        self.assertIsNone(cursor)
+
+    def test_search_returns_cursor_header(self):
+        with mock.patch.object(archive, "search", return_value=([], 42)) as search:
+            response = self.call("get", "/message/query?keywords=m", self.a)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()["data"]), 2)
+            self.assertEqual(response["X-Search-Before"], "42")
+            response = self.call("get", "/message/query?keywords=m&before=42", self.a)
+            self.assertEqual(response.json()["data"], [])
+            self.assertEqual(search.call_args[0][2], 42)
+        response = self.call("get", "/message/query?keywords=m", self.a)
+        self.assertEqual(len(response.json()["data"]), 8)
+        self.assertNotIn("X-Search-Before", response)
+
+
+class GroupSyncTest(TestCase):
+
+    def setUp(self):
+        self.authors = [Author.objects.create(email="{}@x.com".format(i), nickname=str(i)) for i in range(3)]
+        doc = Doc.objects.create(label="d", type="0")
+        self.group = GroupChat.objects.create(doc=doc)
+        for author in self.authors:
+            Access.objects.create(author=author, doc=doc, role=2)
+        GroupMember.objects.all().delete()
+
+    def test_conflict_recomputes_members(self):
+        bulk_create = GroupMember.objects.bulk_create
+        calls = []
+
+        def racing(members, **kwargs):
+            # 第一次写入与并发的同步冲突
+            calls.append(len(members))
+            if len(calls) == 1:
+                raise IntegrityError()
+            return bulk_create(members, **kwargs)
+
+        with mock.patch.object(GroupMember.objects, "bulk_create", side_effect=racing), self.assertLogs("doc.biz", "INFO"):
+            self.assertEqual(biz.sync_group_members(self.group), (3, 0))
+        self.assertEqual(calls, [3, 3])
+        self.assertEqual(GroupMember.objects.filter(group=self.group).count(), 3)
+
+    def test_persistent_conflict_gives_up(self):
+        with mock.patch.object(settings, "GROUP_SYNC_RETRIES", 2), \
+                mock.patch.object(GroupMember.objects, "bulk_create", side_effect=IntegrityError()) as patched, \
+                self.assertLogs("doc.biz", "INFO"):
+            with self.assertRaises(BizException) as raised:
+                biz.sync_group_members(self.group)
+        self.assertEqual(raised.exception.args[0], "common.busy")
+        self.assertEqual(patched.call_count, 2)
+
+
+class AccessSignalTest(TestCase):
+
+    def setUp(self):
+        self.a = Author.objects.create(email="a@x.com", nickname="a", active=True)
+        self.b = Author.objects.create(email="b@x.com", nickname="b", active=True)
+        self.docs = [Doc.objects.create(label=str(i), type="0") for i in range(2)]
+        for doc in self.docs:
+            Access.objects.create(author=self.a, doc=doc, role=2)
+
+    def assertNoRecycledLookup(self, queries):
+        self.assertFalse([query for query in queries if query["sql"].startswith('SELECT (1) AS "a" FROM "doc_doc"')])
+
+    def test_grant_and_cancel_reuse_the_doc(self):
+        with mock.patch.object(biz, "notify_mid"), CaptureQueriesContext(connection) as queries:
+            biz.grant_doc_to_author(self.docs[0].pk, self.b.pk, 1, self.a)
+            biz.grant_doc_to_author(self.docs[0].pk, self.b.pk, 0, self.a)
+            biz.cancel_access_to_doc(self.docs[0].pk, self.b.pk, self.a)
+        self.assertNoRecycledLookup(queries)
+        self.assertFalse(Access.objects.filter(author=self.b).exists())
+
+    def test_concurrent_grant_becomes_an_update(self):
+        # 另一个请求在加锁查询之后插入了同一条权限
+        Access.objects.create(author=self.b, doc=self.docs[0], role=0)
+        with mock.patch.object(biz, "notify_mid"), \
+                mock.patch.object(Access.objects, "select_for_update", return_value=Access.objects.none()):
+            biz.grant_doc_to_author(self.docs[0].pk, self.b.pk, 1, self.a)
+        self.assertEqual(list(Access.objects.filter(author=self.b).values_list("role", flat=True)), [1])
+        self.assertEqual(stats.get(self.b.pk).collaborating_docs, 1)
+        self.assertEqual(stats.get(self.b.pk).reading_docs, 0)
+
+    def test_unlink_batch_reuses_the_docs(self):
+        for doc in self.docs:
+            Access.objects.create(author=self.b, doc=doc, role=1)
+        with CaptureQueriesContext(connection) as queries:
+            biz.del_doc_batch([doc.pk for doc in self.docs], [], self.b)
+        self.assertNoRecycledLookup(queries)
+        self.assertEqual(stats.get(self.b.pk).collaborating_docs, 0)
+        self.assertEqual(stats.compute([self.b.pk])[self.b.pk]["collaborating_docs"], 0)
+
+
+@override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"])
+class TokenExpiryTest(TestCase):
+
+    def setUp(self):
+        self.a = Author.objects.create(email="a@x.com", nickname="a", active=True)
+        self.b = Author.objects.create(email="b@x.com", nickname="b", active=True)
+        self.token = Token.objects.create(author=self.a)
+        self.doc = Doc.objects.create(label="d", type="0")
+        Access.objects.create(author=self.a, doc=self.doc, role=2)
+
+    def age(self, model, pk, ms: int):
+        model.objects.filter(pk=pk).update(timestamp=now() - ms)
+
+    def test_valid_rejects_expired_and_renews(self):
+        self.age(Token, self.token.pk, settings.TOKEN_TTL + 1000)
+        self.assertIsNone(Token.valid(self.token.content))
+        self.age(Token, self.token.pk, settings.TOKEN_RENEW_INTERVAL + 1000)
+        self.assertEqual(Token.valid(self.token.content), self.a)
+        self.assertGreater(Token.objects.get(pk=self.token.pk).timestamp, now() - 1000)
+        # 续期间隔之内只有一次查询, 不写回
+        with self.assertNumQueries(1):
+            self.assertEqual(Token.valid(self.token.content), self.a)
+
+    def test_login_rotates_expired_token(self):
+        with mock.patch.object(settings, "HASH_PROCESSES", 0):
+            self.a.set_password("secret")
+            self.a.save()
+            self.assertEqual(biz.login("a@x.com", "secret"), self.token.content)
+            self.age(Token, self.token.pk, settings.TOKEN_TTL + 1000)
+            rotated = biz.login("a@x.com", "secret")
+        self.assertNotEqual(rotated, self.token.content)
+        self.assertEqual(Token.valid(rotated), self.a)
+        self.assertIsNone(Token.valid(self.token.content))
+
+    def test_expired_invite_is_not_redeemed_and_is_rotated(self):
+        link = biz.get_invite_link(self.doc.pk, "read", self.a)
+        invite = ReadToken.objects.get(doc=self.doc)
+        self.assertTrue(link.endswith("/" + invite.content))
+        self.age(ReadToken, invite.pk, settings.INVITE_TOKEN_TTL + 1000)
+        with self.assertRaises(BizException):
+            biz.get_doc(self.doc.pk, self.b, invite.content)
+        self.assertFalse(Access.objects.filter(author=self.b).exists())
+        link = biz.get_invite_link(self.doc.pk, "read", self.a)
+        self.assertFalse(link.endswith("/" + invite.content))
+        fresh = ReadToken.objects.get(doc=self.doc).content
+        with mock.patch.object(biz, "notify_mid"):
+            biz.get_doc(self.doc.pk, self.b, fresh)
+        self.assertEqual(Access.objects.get(author=self.b).role, 0)
+
+    def test_sweep_deletes_expired_rows_only(self):
+        stale = Token.objects.create(author=self.b)
+        self.age(Token, stale.pk, settings.TOKEN_TTL + 1000)
+        invite = CollaborateToken.objects.create(doc=self.doc)
+        self.age(CollaborateToken, invite.pk, settings.INVITE_TOKEN_TTL + 1000)
+        ReadToken.objects.create(doc=self.doc)
+        swept = biz.sweep_expired_tokens(chunk_size=1)
+        self.assertEqual(swept, {"Token": 1, "ReadToken": 0, "CollaborateToken": 1, "IdempotencyRecord": 0})
+        self.assertEqual(list(Token.objects.values_list("pk", flat=True)), [self.token.pk])
+        self.assertTrue(ReadToken.objects.exists())
+
+
+class SparseFieldsTest(ApiTestCase):
+
+    def setUp(self):
+        self.a = self.author("a@x.com")
+        self.b = self.author("b@x.com")
+
+    def add_docs(self, n: int):
+        for i in range(n):
+            doc = Doc.objects.create(label="d{}".format(i), type="0")
+            Access.objects.create(author=self.a, doc=doc, role=2)
+            Access.objects.create(author=self.b, doc=doc, role=1)
+
+    def docs(self, query: str = ""):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.call("get", "/doc/2/{}{}".format(self.a.pk, query), self.a)
+        self.assertEqual(response.status_code, 200)
+        return response.json()["data"], queries
+
+    def test_fields_keeps_listed_columns(self):
+        self.add_docs(2)
+        data, queries = self.docs("?fields=id,label")
+        self.assertEqual([sorted(item.keys()) for item in data], [["id", "label"]] * 2)
+        selects = [query["sql"] for query in queries if query["sql"].startswith("SELECT") and 'FROM "doc_doc"' in query["sql"]]
+        self.assertTrue(selects)
+        self.assertFalse([sql for sql in selects if '"doc_doc"."type"' in sql])
+        # 没有请求权限列表时不预取
+        prefetch = lambda queries: [query for query in queries if '"doc_access"."doc_id" IN' in query["sql"]]
+        self.assertFalse(prefetch(queries))
+        self.assertTrue(prefetch(self.docs("?fields=id,doc_accessible")[1]))
+
+    def test_expand_controls_nested_authors(self):
+        self.add_docs(1)
+        data, _ = self.docs("?expand=")
+        self.assertEqual(sorted(access["author"] for access in data[0]["doc_accessible"]), [self.a.pk, self.b.pk])
+        data, _ = self.docs("?expand=doc_accessible.author")
+        author = data[0]["doc_accessible"][0]["author"]
+        self.assertEqual(author["email"], "a@x.com")
+        self.assertNotIn("author_accessible", author)
+        data, _ = self.docs("?expand=doc_accessible.author,doc_accessible.author.author_accessible")
+        self.assertEqual(data[0]["doc_accessible"][0]["author"]["author_accessible_count"], 1)
+
+    def test_query_count_does_not_grow_with_rows(self):
+        self.add_docs(1)
+        query = "?expand=doc_accessible.author,doc_accessible.author.author_accessible"
+        _, few = self.docs(query)
+        self.add_docs(4)
+        data, many = self.docs(query)
+        self.assertEqual(len(data), 5)
+        self.assertEqual(len(many), len(few))
+
+
+class ProfilingTest(ApiTestCase):
+
+    def setUp(self):
+        self.a = self.author("a@x.com")
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        patcher = mock.patch.object(settings, "PROFILE_DIR", directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, header: str = None):
+        extra = {} if header is None else {settings.PROFILE_HEADER: header}
+        return self.call("get", "/doc/2/{}".format(self.a.pk), self.a, **extra)
+
+    def test_signed_header_captures_a_trace(self):
+        response = self.get(profiling.sign_header())
+        self.assertEqual(response.status_code, 200)
+        trace_id = response["X-Doc-Profile-Trace"]
+        with open(os.path.join(settings.PROFILE_DIR, trace_id + ".json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.assertEqual(meta["name"], "DocList.get")
+        self.assertTrue(meta["queries"])
+        self.assertTrue(os.path.exists(os.path.join(settings.PROFILE_DIR, trace_id + ".prof")))
+        out = StringIO()
+        call_command("profile_summary", stdout=out)
+        self.assertIn("DocList.get", out.getvalue())
+
+    def test_unsigned_requests_are_not_profiled(self):
+        self.assertNotIn("X-Doc-Profile-Trace", self.get())
+        self.assertNotIn("X-Doc-Profile-Trace", self.get(profiling.sign_header() + "x"))
+        self.assertEqual(os.listdir(settings.PROFILE_DIR), [])
+
+    def test_old_traces_are_rotated(self):
+        # 每条记录的时间戳不同, 按名字排序即按时间排序
+        with mock.patch.object(settings, "PROFILE_MAX_TRACES", 2), mock.patch.object(profiling, "time", side_effect=[1.0, 2.0, 3.0]):
+            for _ in range(3):
+                self.get(profiling.sign_header())
+        names = sorted(os.listdir(settings.PROFILE_DIR))
+        self.assertEqual([name.split("-")[0] for name in names], ["2000", "2000", "3000", "3000"])
+
+
+class ReprCacheTest(TransactionTestCase):
+
+    def setUp(self):
+        reprcache.cache().clear()
+        self.a = Author.objects.create(email="a@x.com", nickname="a", active=True)
+        self.doc = Doc.objects.create(label="d", type="0")
+        Access.objects.create(author=self.a, doc=self.doc, role=2)
+
+    def represent(self) -> dict:
+        return DocSerializer.represent(Doc.objects.filter(pk=self.doc.pk), True, {})[0]
+
+    def test_fetch_loads_only_missing(self):
+        load = mock.Mock(side_effect=lambda missing: {pk: {"id": pk} for pk in missing})
+        reprcache.fetch("doc", [1, 2], load)
+        self.assertEqual(reprcache.fetch("doc", [1, 2, 3], load), {1: {"id": 1}, 2: {"id": 2}, 3: {"id": 3}})
+        self.assertEqual([call[0][0] for call in load.call_args_list], [[1, 2], [3]])
+
+    def test_cached_representation_is_reused(self):
+        first = self.represent()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.represent(), first)
+        # 命中时只查询主键列表
+        self.assertEqual(len(queries), 1)
+        # fields= 和 expand= 不使用缓存
+        self.assertEqual(DocSerializer.represent(Doc.objects.filter(pk=self.doc.pk), True, {"fields": {"id"}}), [{"id": self.doc.pk}])
+
+    def test_writes_invalidate_dependent_representations(self):
+        self.represent()
+        self.doc.label = "e"
+        self.doc.save()
+        self.assertEqual(self.represent()["label"], "e")
+        # 文档中嵌入的用户单独缓存
+        self.a.nickname = "b"
+        self.a.save()
+        self.assertEqual(self.represent()["doc_accessible"][0]["author"]["nickname"], "b")
+        Access.objects.create(author=Author.objects.create(email="c@x.com", nickname="c"), doc=self.doc, role=0)
+        self.assertEqual(self.represent()["doc_accessible_count"], 2)
+
+    def test_content_saves_keep_the_version(self):
+        stamp = reprcache.versions("doc", [self.doc.pk])
+        self.doc.full_text = "text"
+        self.doc.save(update_fields=["full_text", "mod_time"])
+        self.assertEqual(reprcache.versions("doc", [self.doc.pk]), stamp)
+        self.doc.save()
+        self.assertNotEqual(reprcache.versions("doc", [self.doc.pk]), stamp)
+
+    def test_rollback_keeps_the_version(self):
+        stamp = reprcache.versions("doc", [self.doc.pk])
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.doc.save()
+            raise RuntimeError()
+        self.assertEqual(reprcache.versions("doc", [self.doc.pk]), stamp)
+
+
+class SignedTokenTest(TransactionTestCase):
+
+    def setUp(self):
+        tokens.cache().clear()
+        self.a = Author.objects.create(email="a@x.com", nickname="a", active=True)
+
+    def test_verify_round_trip(self):
+        token = tokens.sign(self.a)
+        self.assertTrue(tokens.is_signed(token))
+        with self.assertNumQueries(1):
+            self.assertEqual(tokens.author_of(token).pk, self.a.pk)
+        # 吊销代数已经缓存, 之后的校验不查询数据库
+        with self.assertNumQueries(0):
+            self.assertEqual(tokens.author_of(token).pk, self.a.pk)
+
+    def test_tampered_tokens_are_rejected(self):
+        token = tokens.sign(self.a)
+        payload, _, signature = token.rpartition(".")
+        other = Author.objects.create(email="b@x.com", nickname="b")
+        forged = payload.replace(payload.split(".")[1], tokens._b36(other.pk), 1)
+        self.assertIsNone(tokens.verify(forged + "." + signature))
+        self.assertIsNone(tokens.verify(payload + "." + signature[:-1] + ("A" if signature[-1] != "A" else "B")))
+        self.assertIsNone(tokens.verify(payload))
+        self.assertIsNone(tokens.verify("s.garbage"))
+
+    def test_expired_tokens_are_rejected(self):
+        with mock.patch.object(tokens, "now", return_value=now() - settings.TOKEN_TTL - 1000):
+            token = tokens.sign(self.a)
+        self.assertIsNone(tokens.verify(token))
+
+    def test_revoke_and_password_change_bump_the_generation(self):
+        token = tokens.sign(self.a)
+        self.assertIsNotNone(tokens.verify(token))
+        tokens.revoke(self.a)
+        self.assertIsNone(tokens.verify(token))
+        author = Author.objects.get(pk=self.a.pk)
+        token = tokens.sign(author)
+        self.assertIsNotNone(tokens.verify(token))
+        with mock.patch.object(settings, "HASH_PROCESSES", 0), \
+                override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"]):
+            author.set_password("new")
+            author.save()
+        self.assertIsNone(tokens.verify(token))
+
+    def test_login_issues_signed_tokens(self):
+        with mock.patch.object(settings, "HASH_PROCESSES", 0), mock.patch.object(settings, "SIGNED_TOKENS", True), \
+                override_settings(PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"]):
+            self.a.set_password("secret")
+            self.a.save()
+            token = biz.login("a@x.com", "secret")
+        self.assertTrue(tokens.is_signed(token))
+        self.assertEqual(tokens.author_of(token).pk, self.a.pk)
+        self.assertFalse(Token.objects.exists())
+
+
+class OneIterationHasher(PBKDF2PasswordHasher):
+    iterations = 1
+
+
+class TwoIterationHasher(PBKDF2PasswordHasher):
+    iterations = 2
+
+
+def hashers(*names: str):
+    return override_settings(PASSWORD_HASHERS=["doc.tests." + name if "." not in name else name for name in names])
+
+
+MD5 = "django.contrib.auth.hashers.MD5PasswordHasher"
+
+
+@mock.patch.object(settings, "HASH_PROCESSES", 0)
+class PasswordHashTest(TestCase):
+
+    def author(self, password: str) -> Author:
+        author = Author.objects.create(email="a@x.com", nickname="a")
+        author.set_password(password)
+        author.save()
+        return author
+
+    def stored(self, author: Author) -> str:
+        return Author.objects.get(pk=author.pk).password
+
+    def test_wrong_password_is_not_rehashed(self):
+        with hashers(MD5):
+            author = self.author("secret")
+        with hashers("OneIterationHasher", MD5):
+            self.assertFalse(author.check_password("wrong"))
+        self.assertTrue(self.stored(author).startswith("md5$"))
+
+    def test_outdated_algorithm_is_rehashed_on_login(self):
+        with hashers(MD5):
+            author = self.author("secret")
+        with hashers("OneIterationHasher", MD5):
+            self.assertTrue(author.check_password("secret"))
+            self.assertTrue(self.stored(author).startswith("pbkdf2_sha256$1$"))
+            # 重新哈希不影响已签发的令牌
+            self.assertEqual(Author.objects.get(pk=author.pk).token_generation, 1)
+            self.assertTrue(Author.objects.get(pk=author.pk).check_password("secret"))
+
+    def test_raised_iterations_are_rehashed(self):
+        with hashers("OneIterationHasher"):
+            author = self.author("secret")
+        with hashers("TwoIterationHasher"):
+            self.assertEqual(hashing.check_password("secret", self.stored(author)), (True, True))
+            self.assertTrue(author.check_password("secret"))
+            self.assertEqual(hashing.check_password("secret", self.stored(author)), (True, False))
+
+    def test_full_queue_is_rejected(self):
+        with mock.patch.object(settings, "HASH_PROCESSES", 1), mock.patch.object(settings, "HASH_QUEUE_MAX", 0), \
+                mock.patch.object(hashing.pool, "get_executor") as executor:
+            with self.assertRaises(BizException) as raised:
+                hashing.make_password("secret")
+        self.assertEqual(raised.exception.args[0], "common.busy")
+        self.assertFalse(executor.return_value.submit.called)
+
+    def test_pool_hashes_in_another_process(self):
+        pool = hashing.HashPool()
+        self.addCleanup(lambda: pool.executor.shutdown())
+        with mock.patch.object(settings, "HASH_PROCESSES", 1), mock.patch.object(hashing, "pool", pool):
+            encoded = hashing.make_password("secret")
+            self.assertEqual(hashing.check_password("secret", encoded)[0], True)
+            self.assertEqual(hashing.check_password("wrong", encoded), (False, False))
+        self.assertEqual(pool.stats()["completed"], 3)
+        self.assertEqual(pool.stats()["pending"], 0)
+
+
+class BusTest(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name, value in (("BUS_TRANSPORT", "socket"), ("BUS_DIR", directory)):
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        # 使用 signals.connect 注册的处理函数, 但不影响全局的监听线程
+        self.bus = bus.Bus()
+        self.bus.handlers = bus.bus.handlers
+        self.bus.resets = bus.bus.resets
+        self.assertTrue(self.bus.start())
+        self.addCleanup(self.bus.stop)
+
+    def send(self, seq: int, events, sender: str = "other"):
+        out = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        out.sendto(json.dumps({"s": sender, "n": seq, "t": time.time(), "e": events}).encode("utf-8"), self.bus.transport.path)
+        out.close()
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_remote_events_update_local_caches(self):
+        reprcache.cache().set("token:gen:7", 3)
+        self.send(1, [["doc", 5, "v1"], ["token", 7, None]])
+        self.wait_for(lambda: self.bus.stats()["received"] == 2)
+        self.assertEqual(reprcache.versions("doc", [5]), {5: "v1"})
+        self.assertIsNone(reprcache.cache().get("token:gen:7"))
+
+    def test_lost_messages_reset_local_caches(self):
+        with self.assertLogs("doc.bus", "WARNING"):
+            self.send(1, [["doc", 5, "v1"]])
+            self.send(1, [["doc", 5, "stale"]])
+            self.send(2, [["doc", 5, "v2"]], sender=self.bus.sender)
+            self.send(3, [["doc", 6, "v3"]])
+            self.wait_for(lambda: self.bus.stats()["resets"] == 1)
+        stats = self.bus.stats()
+        self.assertEqual((stats["received"], stats["dropped"]), (2, 1))
+        # 清空之后只剩下最后一条消息带来的版本戳
+        self.assertIsNone(reprcache.cache().get("repr:v:doc:5"))
+        self.assertEqual(reprcache.versions("doc", [6]), {6: "v3"})
+
+    def test_publish_reaches_other_processes(self):
+        inbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        inbox.bind(os.path.join(settings.BUS_DIR, "other.sock"))
+        self.addCleanup(inbox.close)
+        self.bus.publish("doc", {1: "a", 2: "b"})
+        message = json.loads(inbox.recv(1 << 16).decode("utf-8"))
+        self.assertEqual((message["s"], message["n"]), (self.bus.sender, 1))
+        self.assertEqual(message["e"], [["doc", 1, "a"], ["doc", 2, "b"]])
+
+
+class LoginWarmupTest(TransactionTestCase):
+
+    def setUp(self):
+        reprcache.cache().clear()
+        self.a = Author.objects.create(email="a@x.com", nickname="a", active=True)
+        self.docs = [Doc.objects.create(label=str(i), type="0") for i in range(3)]
+        for doc in self.docs:
+            Access.objects.create(author=self.a, doc=doc, role=2)
+
+    def test_repeated_logins_warm_up_once(self):
+        with mock.patch.object(settings, "LOGIN_WARMUP", True), mock.patch.object(biz.tasks, "submit") as submit:
+            biz.warm_up_after_login(self.a)
+            biz.warm_up_after_login(self.a)
+        submit.assert_called_once_with(biz.warm_up_workspace, self.a.pk)
+        with mock.patch.object(biz.tasks, "submit") as submit:
+            biz.warm_up_after_login(self.a)
+        self.assertFalse(submit.called)
+
+    def test_warm_up_fills_tree_roles_and_docs(self):
+        biz.warm_up_workspace(self.a.pk)
+        self.assertTrue(DocTree.objects.filter(author=self.a).exists())
+        with self.assertNumQueries(0):
+            self.assertEqual(Access.roles_of(self.a.pk), {doc.pk: 2 for doc in self.docs})
+        # 文档的表示已经缓存, 只查询主键列表
+        with self.assertNumQueries(1):
+            DocSerializer.represent(Doc.objects.filter(pk__in=[doc.pk for doc in self.docs]), True, {})
+
+    def test_role_map_follows_access_changes(self):
+        other = Doc.objects.create(label="o", type="0")
+        self.assertFalse(Access.can_read(self.a, other))
+        with transaction.atomic():
+            Access.objects.create(author=self.a, doc=other, role=0)
+            # 事务中直接查询数据库, 能看到尚未提交的权限
+            self.assertTrue(Access.can_read(self.a, other))
+        with self.assertNumQueries(1):
+            self.assertTrue(Access.can_read(self.a, other))
+        with self.assertNumQueries(0):
+            self.assertTrue(Access.can_read(self.a, other))
+
+
+class StatsReconcileTest(TestCase):
+
+    def setUp(self):
+        self.a = Author.objects.create(email="a@x.com", nickname="a", active=True)
+        self.b = Author.objects.create(email="b@x.com", nickname="b", active=True)
+        self.doc = Doc.objects.create(label="d", type="0")
+        Access.objects.create(author=self.a, doc=self.doc, role=2)
+
+    def assertInStep(self):
+        counts = stats.compute([self.a.pk, self.b.pk])
+        for author in (self.a, self.b):
+            row = stats.get(author.pk)
+            self.assertEqual({field: getattr(row, field) for field in stats.FIELDS}, counts[author.pk])
+
+    def test_counters_follow_writes(self):
+        self.assertInStep()
+        with mock.patch.object(biz, "notify_mid"):
+            biz.grant_doc_to_author(self.doc.pk, self.b.pk, 0, self.a)
+            self.assertInStep()
+            biz.grant_doc_to_author(self.doc.pk, self.b.pk, 1, self.a)
+            self.assertEqual(stats.get(self.b.pk).collaborating_docs, 1)
+            self.assertInStep()
+            biz.delete_doc(self.doc.pk, self.a)
+            self.assertEqual(stats.get(self.b.pk).collaborating_docs, 0)
+            self.assertInStep()
+            biz.restore_doc(self.doc.pk, self.a)
+            self.assertInStep()
+        with mock.patch.object(biz.feed, "publish"):
+            biz.send_message(self.a.pk, self.b.pk, "hi", self.a)
+        self.assertEqual(stats.get(self.b.pk).unread_chats, 1)
+        self.assertInStep()
+        biz.get_records(Chat.objects.get().pk, 0, 10, self.b)
+        self.assertEqual(stats.get(self.b.pk).unread_chats, 0)
+        self.assertInStep()
+
+    def test_reconcile_fixes_drift(self):
+        stats.get(self.a.pk)
+        AuthorStats.objects.filter(author=self.a).update(owned_docs=5, messages=3)
+        self.assertEqual(stats.reconcile(1, dry_run=True), {"authors": 2, "created": 1, "fixed": 1})
+        self.assertEqual(stats.get(self.a.pk).owned_docs, 5)
+        self.assertEqual(stats.reconcile(1), {"authors": 2, "created": 1, "fixed": 1})
+        self.assertInStep()
+        out = StringIO()
+        call_command("reconcile_stats", stdout=out)
+        self.assertIn("checked 2 authors, 0 missing, 0 drifted", out.getvalue())
+
+
+class ActivityBufferTest(TransactionTestCase):
+
+    def setUp(self):
+        self.a = Author.objects.create(email="a@x.com", nickname="a")
+        # 预先设置 pid, 测试中不启动定时写入的线程
+        self.buffer = activity.Buffer()
+        self.buffer.pid = os.getpid()
+        patcher = mock.patch.object(activity, "buffer", self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_only_committed_records_are_written(self):
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            activity.record("doc.create", self.a.pk, 1)
+            raise RuntimeError()
+        with transaction.atomic():
+            activity.record("doc.delete", self.a.pk, 1, label="d")
+            self.assertEqual(self.buffer.rows, [])
+        self.assertEqual(len(self.buffer.rows), 1)
+        self.assertFalse(Activity.objects.exists())
+        self.assertEqual(self.buffer.flush(), 1)
+        row = Activity.objects.get()
+        self.assertEqual((row.kind, row.author_id, row.doc_id, json.loads(row.payload)), ("doc.delete", self.a.pk, 1, {"label": "d"}))
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_full_buffer_schedules_one_flush(self):
+        with mock.patch.object(settings, "ACTIVITY_BATCH", 2), mock.patch.object(activity.tasks, "submit") as submit:
+            for i in range(3):
+                activity.record("doc.create", self.a.pk, i)
+            submit.assert_called_once_with(self.buffer.flush)
+            self.assertEqual(self.buffer.flush(), 3)
+            activity.record("doc.create", self.a.pk, 3)
+            activity.record("doc.create", self.a.pk, 4)
+            self.assertEqual(submit.call_count, 2)
+
+    def test_failed_flush_keeps_the_newest_records(self):
+        for i in range(3):
+            activity.record("doc.create", self.a.pk, i)
+        with mock.patch.object(settings, "ACTIVITY_BUFFER_MAX", 2), self.assertLogs("doc.activity", "WARNING"), \
+                mock.patch.object(Activity.objects, "bulk_create", side_effect=DatabaseError()):
+            self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual([row.doc_id for row in self.buffer.rows], [1, 2])
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(sorted(Activity.objects.values_list("doc_id", flat=True)), [1, 2])
@@ -0,0 +1,146 @@
+import os
+import math
+import sqlite3
+import logging
+import threading
+from time import time
+from typing import List, Tuple
+from doc_server import settings
+from doc.exceptions import BizException
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteBuckets:
+    '''
+    令牌桶状态保存在本机的 SQLite 文件中, BEGIN IMMEDIATE 保证多个 worker 进程之间的读改写是原子的
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        self.last_sweep = time()
+
+    def connect(self) -> sqlite3.Connection:
+        pid, conn = getattr(self.local, "conn", (None, None))
+        if pid != os.getpid():
+            # fork 出来的进程不能复用父进程的连接
+            conn = sqlite3.connect(self.path, timeout=settings.THROTTLE_LOCK_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # WAL 下 NORMAL 在崩溃时只会丢掉最后几次扣减, 不会损坏文件
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+            self.local.conn = (os.getpid(), conn)
+        return conn
+
+    def take(self, buckets: List[Tuple[str, float, float]], cost: float) -> float:
+        '''
+        所有桶都有足够的令牌时一起扣除并返回 0, 否则不扣除并返回需要等待的秒数
+        '''
+        conn = self.connect()
+        current = time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            states = []
+            wait = 0.0
+            for key, rate, burst in buckets:
+                row = conn.execute("SELECT tokens, updated FROM bucket WHERE key = ?", (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (current - row[1]) * rate)
+                need = min(cost, burst)
+                if tokens < need:
+                    wait = max(wait, (need - tokens) / rate)
+                states.append((key, tokens - need, current))
+            if wait == 0:
+                conn.executemany("INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)", states)
+            if current - self.last_sweep > settings.THROTTLE_IDLE:
+                # 空闲足够久的桶已经回满, 与不存在等价
+                self.last_sweep = current
+                conn.execute("DELETE FROM bucket WHERE updated < ?", (current - settings.THROTTLE_IDLE,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class MemoryBuckets:
+    '''
+    令牌桶状态保存在进程内存中, 每个 worker 进程单独计数, 没有跨进程的锁
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.last_sweep = time()
+
+    def take(self, buckets: List[Tuple[str, float, float]], cost: float) -> float:
+        current = time()
+        with self.lock:
+            states = []
+            wait = 0.0
+            for key, rate, burst in buckets:
+                row = self.states.get(key, None)
+                tokens = burst if row is None else min(burst, row[0] + (current - row[1]) * rate)
+                need = min(cost, burst)
+                if tokens < need:
+                    wait = max(wait, (need - tokens) / rate)
+                states.append((key, tokens - need, current))
+            if wait == 0:
+                for key, tokens, updated in states:
+                    self.states[key] = (tokens, updated)
+            if current - self.last_sweep > settings.THROTTLE_IDLE:
+                self.last_sweep = current
+                self.states = {key: row for key, row in self.states.items() if row[1] >= current - settings.THROTTLE_IDLE}
+        return wait
+
+
+backend = SQLiteBuckets(settings.THROTTLE_DB)
+local_backend = MemoryBuckets()
+
+
+def client_ip(request) -> str:
+    meta = request.META
+    if settings.THROTTLE_TRUST_FORWARDED and meta.get("HTTP_X_FORWARDED_FOR", None):
+        return meta["HTTP_X_FORWARDED_FOR"].split(",")[0].strip()
+    return meta.get("REMOTE_ADDR", "")
+
+
+def buckets_of(request) -> List[Tuple[str, float, float]]:
+    '''
+    按令牌和 IP 分别限流, 直接使用请求中的令牌而不查询用户
+    '''
+    buckets = [("ip:" + client_ip(request), settings.THROTTLE_IP_RATE, settings.THROTTLE_IP_BURST)]
+    params = getattr(request, "query_params", None) or request.GET
+    token = params.get("token", None)
+    if token:
+        buckets.append(("token:" + token, settings.THROTTLE_AUTHOR_RATE, settings.THROTTLE_AUTHOR_BURST))
+    return buckets
+
+
+def check(request, cost: str) -> None:
+    weight = settings.THROTTLE_COSTS.get(cost, 1)
+    # 廉价的调用只在本进程内计数, 避免每次读请求都抢共享文件的写锁
+    store = backend if weight >= settings.THROTTLE_SHARED_COST else local_backend
+    try:
+        wait = store.take(buckets_of(request), weight)
+    except sqlite3.Error as e:
+        # 限流存储不可用时放行, 不影响正常请求
+        logger.warning("throttle backend unavailable: %s", e)
+        return
+    if wait > 0:
+        raise BizException("common.throttled", { "retry_after": math.ceil(wait) })
+
+
+def limited(cost: str = None):
+    '''
+    cost 为 THROTTLE_COSTS 中的名称, 没有指定时不限流也没有任何额外开销
+    '''
+    def foo(func):
+        if cost is None:
+            return func
+        def bar(*args, **kwargs):
+            if settings.THROTTLE_ENABLED and len(args) > 1:
+                check(args[1], cost)
+            return func(*args, **kwargs)
+        return bar
+    return foo
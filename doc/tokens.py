@@ -0,0 +1,114 @@
+import base64
+from typing import Iterable, Optional
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import F
+from django.utils.crypto import constant_time_compare, salted_hmac
+from doc_server import settings
+from doc import bus
+from doc.models import Author, Token
+from doc.utils import now
+
+PREFIX = "s."
+SALT = "doc.tokens"
+
+
+def cache():
+    return caches[settings.REPR_CACHE]
+
+
+def _generation_key(author_id: int) -> str:
+    return "token:gen:{}".format(author_id)
+
+
+def _signature(payload: str) -> str:
+    digest = salted_hmac(SALT, payload).digest()
+    return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+
+def _b36(n: int) -> str:
+    chars = "0123456789abcdefghijklmnopqrstuvwxyz"
+    s = ""
+    while True:
+        n, r = divmod(n, 36)
+        s = chars[r] + s
+        if n == 0:
+            return s
+
+
+def generation(author_id: int) -> Optional[int]:
+    '''
+    用户当前的吊销代数, 先读缓存, 用户不存在时返回 None
+    '''
+    key = _generation_key(author_id)
+    value = cache().get(key)
+    if value is None:
+        value = Author.objects.filter(pk=author_id).values_list("token_generation", flat=True).first()
+        if value is None:
+            return None
+        cache().set(key, value, settings.TOKEN_GENERATION_TTL)
+    return value
+
+
+def evict(author_ids: Iterable[int]) -> None:
+    cache().delete_many([_generation_key(author_id) for author_id in author_ids])
+
+
+def forget(author_id: int) -> None:
+    def commit():
+        evict([author_id])
+        bus.publish("token", {author_id: None})
+
+    transaction.on_commit(commit)
+
+
+def sign(author: Author) -> str:
+    '''
+    签名令牌: 用户 id、签发时间和吊销代数, 校验时不需要查询数据库
+    '''
+    payload = PREFIX + ".".join([_b36(author.pk), _b36(now()), _b36(author.token_generation)])
+    return payload + "." + _signature(payload)
+
+
+def verify(s: str) -> Optional[Author]:
+    payload, _, signature = s.rpartition(".")
+    if not constant_time_compare(signature, _signature(payload)):
+        return None
+    try:
+        author_id, issued, gen = [int(part, 36) for part in payload[len(PREFIX):].split(".")]
+    except ValueError:
+        return None
+    if now() - issued > settings.TOKEN_TTL or generation(author_id) != gen:
+        return None
+    # 只有主键的延迟实例, 其他字段在第一次访问时才查询
+    return Author.from_db("default", ["id"], [author_id])
+
+
+def is_signed(s: str) -> bool:
+    return s is not None and s.startswith(PREFIX)
+
+
+def author_of(s: str) -> Optional[Author]:
+    '''
+    同时支持签名令牌和保存在 Token 表中的旧令牌
+    '''
+    if is_signed(s):
+        return verify(s)
+    return Token.valid(s)
+
+
+def revoke(author: Author) -> None:
+    '''
+    吊销该用户已签发的所有签名令牌, 旧令牌同时轮换
+    '''
+    Author.objects.filter(pk=author.pk).update(token_generation=F("token_generation") + 1)
+    Token.objects.filter(author_id=author.pk).update(content=Token.generate(), timestamp=now())
+    forget(author.pk)
+
+
+def request_author(request) -> Optional[Author]:
+    # 同一请求内只解析一次令牌, 批量请求的子请求会预先带上已认证的用户
+    http_request = request._request
+    if not hasattr(http_request, "doc_author"):
+        http_request.doc_author = author_of(request.query_params.get("token", None))
+    return http_request.doc_author
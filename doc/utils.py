@@ -2,12 +2,14 @@ import re
 import base64
 import zlib
 import json
+import difflib
 from doc.responses import resp
 from doc.exceptions import BizException
+from doc import profiling, throttle
 import random
 from hashlib import md5
-from time import time
-from typing import Dict, List, Set, Type
+from time import time, perf_counter
+from typing import Dict, List, NamedTuple, Optional, Set, Type
 
 from rest_framework.serializers import Serializer
 
@@ -45,12 +47,39 @@ def success_response(name: str):
         return bar
     return foo
 
+def parse_fields(value: str) -> Set[str]:
+    if value is None:
+        return None
+    return set([item.strip() for item in value.split(",") if item.strip()])
+
+def sparse_context(args) -> Dict:
+    '''
+    从视图参数中的请求读取 fields= 和 expand=
+    '''
+    context = {}
+    params = getattr(args[1], "query_params", None) if len(args) > 1 else None
+    if params is not None:
+        for key in ("fields", "expand"):
+            value = parse_fields(params.get(key, None))
+            if value is not None:
+                context[key] = value
+    return context
+
 def serialized(serializer: Type[Serializer], many=False):
     def foo(func):
         def bar(*args, **kwargs):
             data = func(*args, **kwargs)
             if data is not None:
-                return serializer(data, many=many).data
+                trace = profiling.current()
+                started = perf_counter()
+                context = sparse_context(args)
+                if hasattr(serializer, "represent"):
+                    data = serializer.represent(data, many, context)
+                else:
+                    data = serializer(data, many=many, context=context).data
+                if trace is not None:
+                    trace.serialize_time += perf_counter() - started
+                return data
             return None
         return bar
     return foo
@@ -63,45 +92,106 @@ def catch_biz_exception(func):
             return resp(*e.args)
     return wrapper
 
-def api(serializer=None, many=False, success_resp_name="common.success"):
+def api(serializer=None, many=False, success_resp_name="common.success", cost=None):
     def foo(func):
         if serializer is None:
             @catch_biz_exception
+            @throttle.limited(cost)
             @success_response(success_resp_name)
             def bar(*args, **kwargs):
                 return func(*args, **kwargs)
         else:
             @catch_biz_exception
+            @throttle.limited(cost)
             @success_response(success_resp_name)
             @serialized(serializer, many)
             def bar(*args, **kwargs):
                 return func(*args, **kwargs)
-        return bar
+        return profiling.profiled(func.__qualname__)(bar)
     return foo
 
 def default_doc_tree():
     return json.dumps({"children": {}})
 
-def trim_doc_tree(content: str) -> str:
-    def trim(root: dict) -> None:
-        if "children" not in root:
-            id = root["id"]
-            original = root.get("original", False)
-            root.clear()
-            root["id"] = id
-            root["original"] = original
+
+def compress_text(s: str) -> bytes:
+    return zlib.compress(s.encode("utf-8"))
+
+def decompress_text(b: bytes) -> str:
+    return zlib.decompress(bytes(b)).decode("utf-8")
+
+def make_delta(old: str, new: str) -> bytes:
+    '''
+    按行计算 old 到 new 的差量: ["=", i, j] 复制 old 的第 i 到 j 行, ["+", text] 插入新内容
+    '''
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(["=", i1, i2])
+        elif j2 > j1:
+            ops.append(["+", "".join(new_lines[j1:j2])])
+    return compress_text(json.dumps(ops, ensure_ascii=False))
+
+def apply_delta(old: str, delta: bytes) -> str:
+    old_lines = old.splitlines(keepends=True)
+    parts = []
+    for op in json.loads(decompress_text(delta)):
+        if op[0] == "=":
+            parts.extend(old_lines[op[1]:op[2]])
         else:
-            for key in root["children"]:
-                trim(root["children"][key])
-    root = json.loads(content)
-    trim(root)
-    return json.dumps(root, ensure_ascii=False)
-
-def extract_doc_from_root(root: dict) -> Set[int]:
-    if "children" not in root:
-        return set([root["id"]])
-    results = set([])
-    for key in root["children"]:
-        for res in extract_doc_from_root(root['children'][key]):
-            results.add(res)
-    return results
+            parts.append(op[1])
+    return "".join(parts)
+
+class Page(NamedTuple):
+    results: List
+    total: int
+    next: Optional[int]
+
+
+def keyset_page(queryset, after: int, limit: int, descending: bool = False) -> Page:
+    '''
+    按主键分页, after 为上一页最后一项的主键; 不使用 OFFSET, 翻到多深都只读取一页;
+    descending 时从新到旧
+    '''
+    total = queryset.count()
+    if after is not None:
+        queryset = queryset.filter(pk__lt=after) if descending else queryset.filter(pk__gt=after)
+    results = list(queryset.order_by("-pk" if descending else "pk")[:limit + 1])
+    if len(results) > limit:
+        return Page(results[:limit], total, results[limit - 1].pk)
+    return Page(results, total, None)
+
+
+def merge_duplicate_access(model, batch_size: int = 500, dry_run: bool = False) -> int:
+    '''
+    合并同一用户对同一文档的重复权限, 保留角色最高的一条 (角色相同时保留最早的一条);
+    model 可以是迁移中的历史模型, 返回合并的组数
+    '''
+    from django.db import transaction
+    from django.db.models import Count
+    duplicates = model.objects.values("author_id", "doc_id").annotate(n=Count("id")).filter(n__gt=1)
+    if dry_run:
+        return duplicates.count()
+    merged = 0
+    while True:
+        groups = list(duplicates.order_by("author_id", "doc_id")[:batch_size])
+        if len(groups) == 0:
+            return merged
+        pairs = set((group["author_id"], group["doc_id"]) for group in groups)
+        with transaction.atomic():
+            rows = model.objects.filter(author_id__in=set(pk for pk, _ in pairs), doc_id__in=set(pk for _, pk in pairs))
+            kept = {}
+            stale = []
+            for row in rows.order_by("-role", "pk").values("id", "author_id", "doc_id"):
+                key = (row["author_id"], row["doc_id"])
+                if key not in pairs:
+                    continue
+                if key in kept:
+                    stale.append(row["id"])
+                else:
+                    kept[key] = row["id"]
+            model.objects.filter(pk__in=stale).delete()
+        merged += len(pairs)
@@ -1,18 +1,23 @@
-from doc.models import Author, Token
-from doc.serializers import AuthorSerializer, ChatSerializer, DocAccessSerializer, DocSerializer, DocTreeSerializer, MessageSerializer
+from doc.models import Author
+from doc.serializers import (AccessPageSerializer, ActivityPageSerializer, AuthorSerializer, AuthorStatsSerializer, ChatSerializer, CollaboratorPageSerializer, DocAccessSerializer,
+    DocSerializer, DocTreeSerializer, DocVersionSerializer, GroupChatSerializer, GroupMessageSerializer, MessageSerializer)
+import math
+from django.http import StreamingHttpResponse
 from rest_framework.views import APIView
 from rest_framework.request import Request
-from doc.utils import api
-from doc import biz
+from doc.utils import api, catch_biz_exception
+from doc import batch, biz, feed, tokens
+from doc.idempotency import idempotent
+from doc.responses import resp
+from doc_server import settings
 
 def u(request: Request) -> Author:
-    s = request.query_params.get("token", None)
-    return Token.valid(s)
+    return tokens.request_author(request)
 
 # Create your views here.
 class AuthorList(APIView):
 
-    @api(AuthorSerializer, many=True)
+    @api(AuthorSerializer, many=True, cost="search")
     def get(self, request: Request):
         keyword = request.query_params.get("q", None)
         return biz.get_authors(keyword)
@@ -23,6 +28,13 @@ class AuthorList(APIView):
         return biz.author_register(data)
 
 
+class AuthorStatsView(APIView):
+
+    @api(AuthorStatsSerializer)
+    def get(self, request: Request, pk: int):
+        return biz.get_author_stats(pk, u(request))
+
+
 class AuthorCheck(APIView):
 
     @api(AuthorSerializer)
@@ -40,7 +52,7 @@ class AuthorCheck(APIView):
 
 class AuthorDetail(APIView):
 
-    @api(AuthorSerializer)
+    @api(AuthorSerializer, cost="read")
     def get(self, request: Request, pk):
         return biz.get_author(pk)
     
@@ -64,6 +76,7 @@ class DocList(APIView):
     def get(self, request: Request, role, author_id):
         return biz.get_doc_by_author_with_role(author_id, role, u(request))
 
+    @idempotent
     @api(DocSerializer)
     def post(self, request: Request, role, author_id):
         return biz.create_doc(request.data, author_id, u(request))
@@ -71,7 +84,7 @@ class DocList(APIView):
 
 class DocDetail(APIView):
     
-    @api(DocSerializer)
+    @api(DocSerializer, cost="read")
     def get(self, request: Request, pk):
         code = request.query_params.get("code", None)
         return biz.get_doc(pk, u(request), code)
@@ -85,14 +98,102 @@ class DocDetail(APIView):
         return biz.delete_doc(pk, u(request))
 
 
-class DocQueryBatch(APIView):
+class DocCollaboratorList(APIView):
+
+    @api(CollaboratorPageSerializer, cost="read")
+    def get(self, request: Request, pk: int):
+        params = request.query_params
+        return biz.get_doc_collaborators(pk, params.get("role", None), params.get("after", None), params.get("limit", None), u(request))
+
+
+class AuthorAccessList(APIView):
+
+    @api(AccessPageSerializer, cost="read")
+    def get(self, request: Request, pk: int):
+        params = request.query_params
+        return biz.get_author_accesses(pk, params.get("role", None), params.get("after", None), params.get("limit", None), u(request))
+
+
+class AuthorActivityList(APIView):
+
+    @api(ActivityPageSerializer, cost="read")
+    def get(self, request: Request, pk: int):
+        params = request.query_params
+        return biz.get_author_activities(pk, params.get("after", None), params.get("limit", None), u(request))
+
+
+class DocActivityList(APIView):
+
+    @api(ActivityPageSerializer, cost="read")
+    def get(self, request: Request, pk: int):
+        params = request.query_params
+        return biz.get_doc_activities(pk, params.get("after", None), params.get("limit", None), u(request))
+
+
+class DocVersionList(APIView):
+
+    @api(DocVersionSerializer, many=True)
+    def get(self, request: Request, pk: int):
+        return biz.get_doc_versions(pk, u(request))
+
+
+class DocVersionDetail(APIView):
+
+    @api()
+    def get(self, request: Request, pk: int, version_id: int):
+        return biz.get_doc_version(pk, version_id, u(request))
+
+    @api(DocSerializer)
+    def post(self, request: Request, pk: int, version_id: int):
+        return biz.restore_doc_version(pk, version_id, u(request))
+
+
+class RecycleBinView(APIView):
 
     @api(DocSerializer, many=True)
+    def get(self, request: Request, author_id: int):
+        return biz.get_recycled_docs(author_id, u(request))
+
+    @api()
+    def delete(self, request: Request, author_id: int):
+        return biz.empty_recycle_bin(author_id, u(request))
+
+
+class RecycleRestoreView(APIView):
+
+    @api(DocSerializer)
+    def post(self, request: Request, pk: int):
+        return biz.restore_doc(pk, u(request))
+
+
+class WorkspaceView(APIView):
+
+    @catch_biz_exception
+    def get(self, request: Request, author_id: int):
+        fmt = request.query_params.get("fmt", "ndjson")
+        chunks = biz.export_workspace(author_id, fmt, u(request))
+        content_type = "application/zip" if fmt == "zip" else "application/x-ndjson"
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response["Content-Disposition"] = "attachment; filename=workspace-{}.{}".format(author_id, fmt)
+        return response
+
+    @api()
+    def post(self, request: Request, author_id: int):
+        if request.content_type.startswith("multipart/"):
+            stream = request.FILES.get("file", None)
+        else:
+            stream = request.stream
+        return biz.import_workspace(author_id, stream, u(request))
+
+
+class DocQueryBatch(APIView):
+
+    @api(DocSerializer, many=True, cost="search")
     def get(self, request: Request):
         keywords = request.query_params.get("keywords", None)
         return biz.search_doc(keywords, u(request))
 
-    @api(DocSerializer, many=True)
+    @api(DocSerializer, many=True, cost="batch")
     def post(self, request: Request):
         doc_ids = set(request.data.get("ids", []))
         from_tos = request.data.get("fts", [])
@@ -101,7 +202,7 @@ class DocQueryBatch(APIView):
 
 class DocDeleteBatch(APIView):
 
-    @api()
+    @api(cost="batch")
     def post(self, request: Request):
         doc_ids = set(request.data.get("ids", []))
         from_tos = request.data.get("fts", [])
@@ -116,6 +217,7 @@ class AccessListView(APIView):
         doc_id = request.query_params.get("doc_id", None)
         return biz.query_access(author_id, doc_id, u(request))
 
+    @idempotent
     @api(DocSerializer)
     def post(self, request: Request):
         doc_id = request.data.get("doc_id", None)
@@ -131,6 +233,13 @@ class AccessDetailView(APIView):
         return biz.cancel_access_to_doc(doc_id, author_id, u(request))
 
 
+class LogoutView(APIView):
+
+    @api()
+    def post(self, request: Request):
+        return biz.logout(u(request))
+
+
 class TokenReverseView(APIView):
 
     @api(AuthorSerializer)
@@ -159,6 +268,7 @@ class ChatView(APIView):
         author_id2 = request.query_params.get("a2", None)
         return biz.get_or_create_chat(author_id1, author_id2, u(request))
 
+    @idempotent
     @api(MessageSerializer)
     def post(self, request: Request):
         sender = request.data.get("sender", None)
@@ -173,6 +283,49 @@ class ChatDetailView(APIView):
     def get(self, request: Request, pk: int):
         return biz.get_chat_by_id(pk, u(request))
 
+class GroupListView(APIView):
+
+    @api(GroupChatSerializer, many=True)
+    def get(self, request: Request):
+        return biz.get_groups(u(request))
+
+    @idempotent
+    @api(GroupChatSerializer)
+    def post(self, request: Request):
+        name = request.data.get("name", None)
+        members = request.data.get("members", None)
+        return biz.create_group(name, members, u(request))
+
+
+class DocGroupView(APIView):
+
+    @api(GroupChatSerializer)
+    def get(self, request: Request, doc_id: int):
+        return biz.get_doc_group(doc_id, u(request))
+
+
+class GroupMessageView(APIView):
+
+    @api(GroupMessageSerializer, many=True)
+    def get(self, request: Request, pk: int):
+        params = request.query_params
+        return biz.get_group_messages(pk, params.get("before", None), params.get("after", None), params.get("limit", None), u(request))
+
+    @idempotent
+    @api(GroupMessageSerializer)
+    def post(self, request: Request, pk: int):
+        msg = request.data.get("msg", None)
+        return biz.send_group_message(pk, msg, u(request))
+
+
+class GroupReadView(APIView):
+
+    @api(GroupChatSerializer)
+    def post(self, request: Request, pk: int):
+        message_id = request.data.get("message_id", None)
+        return biz.mark_group_read(pk, message_id, u(request))
+
+
 class GetInviteLink(APIView):
 
     @api()
@@ -193,7 +346,60 @@ class GetRecords(APIView):
 
 class MessageQuery(APIView):
 
-    @api(MessageSerializer, many=True)
     def get(self, request: Request):
-        keywords = request.query_params.get("keywords", None)
-        return biz.search_message(keywords, u(request))
+        cursor = {}
+        response = self.search(request, cursor)
+        if cursor.get("before", None) is not None:
+            # 归档段没有扫描完, 客户端带上 before 继续搜索
+            response["X-Search-Before"] = str(cursor["before"])
+        return response
+
+    @api(MessageSerializer, many=True, cost="search")
+    def search(self, request: Request, cursor: dict):
+        params = request.query_params
+        messages, cursor["before"] = biz.search_message(params.get("keywords", None), params.get("before", None), u(request))
+        return messages
+
+
+
+class FeedView(APIView):
+
+    @catch_biz_exception
+    def get(self, request: Request):
+        author = u(request)
+        if author is None:
+            return resp("common.forbidden")
+        cursor = request.query_params.get("cursor", None) or request.META.get("HTTP_LAST_EVENT_ID", None)
+        try:
+            cursor = feed.latest_cursor(author.pk) if cursor is None else int(cursor)
+            timeout = float(request.query_params.get("timeout", settings.FEED_LONG_POLL_TIMEOUT))
+        except ValueError:
+            return resp("common.bad_request")
+        if math.isnan(timeout):
+            return resp("common.bad_request")
+        if "text/event-stream" in request.META.get("HTTP_ACCEPT", "") or request.query_params.get("stream", None):
+            response = feed.FeedResponse(feed.stream(author.pk, cursor), feed.stream_async(author.pk, cursor),
+                content_type="text/event-stream")
+            response["Cache-Control"] = "no-cache"
+            response["X-Accel-Buffering"] = "no"
+            return response
+        timeout = max(0, min(timeout, settings.FEED_LONG_POLL_TIMEOUT))
+        events = feed.fetch(author.pk, cursor)
+        if len(events) or timeout == 0:
+            if len(events):
+                cursor = events[-1].pk
+            return resp("common.success", { "cursor": cursor, "events": [feed.to_dict(event) for event in events] })
+        # 暂时没有事件时才进入等待, 等待期间不占用请求线程
+        return feed.FeedResponse(feed.poll_body(author.pk, cursor, timeout), feed.poll_body_async(author.pk, cursor, timeout),
+            content_type="application/json")
+
+
+class BatchView(APIView):
+
+    @api()
+    def post(self, request: Request):
+        data = request.data
+        # 旧客户端仍可能带 parallel 参数, 子请求共用一个数据库连接, 总是依次执行
+        items = data if isinstance(data, list) else data.get("requests", None)
+        token = request.query_params.get("token", None)
+        return batch.dispatch(request._request, token, u(request), items)
@@ -0,0 +1,326 @@
+import io
+import json
+import zipfile
+from typing import Dict, Iterable, Iterator, List
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from doc_server import settings
+from doc.models import Author, Doc, Access, DocTree, Chat, Message, MessageArchive
+from doc.exceptions import BizException
+from doc import reprcache, stats
+
+ARCHIVE_ENTRY = "workspace.ndjson"
+
+
+def scan(queryset: QuerySet, fields: List[str], chunk_size: int = settings.WORKSPACE_BATCH) -> Iterator[Dict]:
+    '''
+    按主键分段遍历, 无论数据库是否支持服务端游标, 内存占用都只与 chunk_size 有关
+    '''
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk).order_by("pk").values("pk", *fields)[:chunk_size])
+        if len(rows) == 0:
+            return
+        last_pk = rows[-1]["pk"]
+        for row in rows:
+            yield row
+
+
+def export_records(author: Author) -> Iterator[Dict]:
+    '''
+    导出用户创建的文档、文档的权限、文档树以及用户参与的聊天; 归档的消息和热表中的消息一样按 message 导出
+    '''
+    yield {"type": "author", "email": author.email, "nickname": author.nickname}
+    emails = {}
+
+    def email_of(author_id: int) -> str:
+        if author_id is None:
+            return None
+        if author_id not in emails:
+            emails[author_id] = Author.objects.filter(pk=author_id).values_list("email", flat=True).first()
+        return emails[author_id]
+
+    owned = Access.objects.filter(author=author, role=Access.DOMINATOR).values_list("doc_id")
+    docs = Doc.objects.defer(None).filter(pk__in=owned)
+    for row in scan(docs, ["label", "type", "recycled", "recycle_time", "full_text", "create_time", "mod_time"]):
+        row["doc_type"] = row["type"]
+        row["type"] = "doc"
+        row["id"] = row.pop("pk")
+        yield row
+    accesses = Access.objects.filter(doc_id__in=owned)
+    for row in scan(accesses, ["author_id", "doc_id", "role"]):
+        yield {"type": "access", "doc": row["doc_id"], "author": email_of(row["author_id"]), "role": row["role"]}
+    tree = DocTree.objects.filter(author=author).values("content", "timestamp").first()
+    if tree is not None:
+        yield {"type": "doctree", "content": tree["content"], "timestamp": tree["timestamp"]}
+    chats = Chat.objects.filter(Q(initiator=author) | Q(recipient=author))
+    chat_ids = []
+    for row in scan(chats, ["initiator_id", "recipient_id", "time"]):
+        chat_ids.append(row["pk"])
+        yield {"type": "chat", "id": row["pk"], "initiator": email_of(row["initiator_id"]),
+            "recipient": email_of(row["recipient_id"]), "time": row["time"]}
+    for i in range(0, len(chat_ids), settings.WORKSPACE_BATCH):
+        batch = chat_ids[i:i + settings.WORKSPACE_BATCH]
+        # 同一聊天中归档段早于热表, 段按主键的顺序就是消息的顺序, 导入后保持原来的先后
+        segments = MessageArchive.objects.filter(chat_id__in=batch)
+        for row in scan(segments, ["chat_id", "content"], chunk_size=1):
+            for message in MessageArchive(chat_id=row["chat_id"], content=row["content"]).messages():
+                yield {"type": "message", "chat": message.chat_id, "sender": email_of(message.sender_id),
+                    "receiver": email_of(message.receiver_id), "msg": message.msg, "time": message.time}
+        messages = Message.objects.filter(chat_id__in=batch)
+        for row in scan(messages, ["chat_id", "sender_id", "receiver_id", "msg", "time"]):
+            yield {"type": "message", "chat": row["chat_id"], "sender": email_of(row["sender_id"]),
+                "receiver": email_of(row["receiver_id"]), "msg": row["msg"], "time": row["time"]}
+
+
+def export_ndjson(author: Author) -> Iterator[bytes]:
+    for record in export_records(author):
+        yield (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class _StreamSink(io.RawIOBase):
+    '''
+    不可寻址的写入端, zipfile 写入的数据在每次 drain 时被取走
+    '''
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer.extend(b)
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def export_zip(author: Author) -> Iterator[bytes]:
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(ARCHIVE_ENTRY, mode="w") as entry:
+            for line in export_ndjson(author):
+                entry.write(line)
+                if len(sink.buffer) >= 64 * 1024:
+                    yield sink.drain()
+    yield sink.drain()
+
+
+def read_lines(stream) -> Iterator[bytes]:
+    '''
+    读取 ndjson 或包含 ndjson 的 zip 包
+    '''
+    head = stream.read(4)
+    if head == b"PK\x03\x04":
+        if getattr(stream, "seekable", lambda: False)():
+            stream.seek(0)
+            archive = zipfile.ZipFile(stream)
+        else:
+            archive = zipfile.ZipFile(io.BytesIO(head + stream.read()))
+        with archive.open(ARCHIVE_ENTRY) as entry:
+            for line in entry:
+                yield line
+        return
+    pending = head
+    for chunk in iter(lambda: stream.read(64 * 1024), b""):
+        pending += chunk
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+def _consecutive_ids() -> bool:
+    '''
+    一条多行 INSERT 分配的自增主键是否连续: SQLite 写入是串行的;
+    MySQL 的 innodb_autoinc_lock_mode 为 2 时并发的插入可能交错分配
+    '''
+    if connection.vendor == "sqlite":
+        return True
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT @@innodb_autoinc_lock_mode")
+        return cursor.fetchone()[0] < 2
+
+
+def _insert_docs(docs: List[Doc]) -> None:
+    # 同一条 INSERT 写入, 插入后从连接上读取自增主键: MySQL 返回第一行的, SQLite 返回最后一行的
+    Doc.objects.bulk_create(docs, batch_size=len(docs))
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            cursor.execute("SELECT last_insert_rowid()")
+            first = cursor.fetchone()[0] - len(docs) + 1
+        else:
+            cursor.execute("SELECT LAST_INSERT_ID()")
+            first = cursor.fetchone()[0]
+    for i, doc in enumerate(docs):
+        doc.pk = first + i
+
+
+def _bulk_create_docs(docs: List[Doc]) -> None:
+    '''
+    批量插入文档并回填主键; 不支持 RETURNING 的数据库上, 主键连续时每批一条 INSERT, 否则逐行插入
+    '''
+    if getattr(connection.features, "can_return_ids_from_bulk_insert", False):
+        Doc.objects.bulk_create(docs)
+        return
+    if _consecutive_ids():
+        _insert_docs(docs)
+        return
+    for doc in docs:
+        _insert_docs([doc])
+
+
+def _remap_tree(root: Dict, doc_map: Dict[int, int]) -> Dict:
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if "children" in node:
+            children = node["children"]
+            for key in list(children.keys()):
+                child = children[key]
+                if "children" not in child and child.get("id") not in doc_map:
+                    del children[key]
+                else:
+                    stack.append(child)
+        else:
+            node["id"] = doc_map[node["id"]]
+    return root
+
+
+def import_records(lines: Iterable[bytes], author: Author, batch_size: int = settings.WORKSPACE_BATCH) -> Dict:
+    '''
+    导入 export_records 导出的数据, 文档和聊天会分配新的主键, 其他用户按邮箱对应;
+    整个导入在一个事务中完成, 数据有误时全部回滚
+    '''
+    try:
+        with transaction.atomic():
+            return _import_records(lines, author, batch_size)
+    except (ValueError, KeyError, TypeError, AttributeError, IntegrityError, zipfile.BadZipFile):
+        raise BizException("common.bad_request")
+
+
+def _import_records(lines: Iterable[bytes], author: Author, batch_size: int) -> Dict:
+    source_email = None
+    authors = {}
+    doc_map = {}
+    chat_map = {}
+    pending_docs = []
+    pending_old_ids = []
+    accesses = []
+    messages = []
+    touched = set()
+    tree = None
+    counts = {"doc": 0, "access": 0, "chat": 0, "message": 0, "skipped": 0}
+
+    def author_id_of(email: str) -> int:
+        if email is None:
+            return None
+        if email == source_email:
+            return author.pk
+        if email not in authors:
+            authors[email] = Author.objects.filter(email=email).values_list("pk", flat=True).first()
+        return authors[email]
+
+    def flush_docs():
+        _bulk_create_docs(pending_docs)
+        for old_id, doc in zip(pending_old_ids, pending_docs):
+            doc_map[old_id] = doc.pk
+        counts["doc"] += len(pending_docs)
+        pending_docs.clear()
+        pending_old_ids.clear()
+
+    def flush(rows: List, model) -> None:
+        model.objects.bulk_create(rows)
+        if model is Access:
+            # bulk_create 不发送信号, 手动使相关用户的表示失效
+            reprcache.invalidate("author", [row.author_id for row in rows])
+            reprcache.invalidate("roles", [row.author_id for row in rows])
+            touched.update(row.author_id for row in rows)
+        counts[model.__name__.lower()] += len(rows)
+        rows.clear()
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        kind = record["type"]
+        if kind == "author":
+            source_email = record["email"]
+        elif kind == "doc":
+            pending_old_ids.append(record["id"])
+            pending_docs.append(Doc(label=record["label"], type=record["doc_type"], recycled=record["recycled"],
+                recycle_time=record["recycle_time"], full_text=record["full_text"],
+                create_time=record["create_time"], mod_time=record["mod_time"]))
+            if len(pending_docs) >= batch_size:
+                flush_docs()
+        elif kind == "access":
+            if pending_docs:
+                flush_docs()
+            author_id = author_id_of(record["author"])
+            if record["role"] not in Access.VALID_ROLES:
+                raise ValueError("invalid role")
+            if author_id is None or record["doc"] not in doc_map:
+                counts["skipped"] += 1
+                continue
+            accesses.append(Access(author_id=author_id, doc_id=doc_map[record["doc"]], role=record["role"]))
+            if len(accesses) >= batch_size:
+                flush(accesses, Access)
+        elif kind == "doctree":
+            tree = record
+        elif kind == "chat":
+            initiator_id = author_id_of(record["initiator"])
+            recipient_id = author_id_of(record["recipient"])
+            if initiator_id is None or recipient_id is None:
+                counts["skipped"] += 1
+                continue
+            # 只能导入自己参与的聊天, 否则可以往别人之间的聊天里写入消息
+            if author.pk not in (initiator_id, recipient_id):
+                raise BizException("common.forbidden")
+            chat = Chat.objects.filter(Q(initiator_id=initiator_id) & Q(recipient_id=recipient_id) |
+                Q(initiator_id=recipient_id) & Q(recipient_id=initiator_id)).first()
+            if chat is None:
+                chat = Chat.objects.create(initiator_id=initiator_id, recipient_id=recipient_id, time=record["time"])
+                counts["chat"] += 1
+            chat_map[record["id"]] = (chat.pk, {initiator_id, recipient_id})
+            touched.update([initiator_id, recipient_id])
+        elif kind == "message":
+            if record["chat"] not in chat_map:
+                counts["skipped"] += 1
+                continue
+            chat_id, participants = chat_map[record["chat"]]
+            sender_id = author_id_of(record["sender"])
+            receiver_id = author_id_of(record["receiver"])
+            # 收发双方必须正好是聊天的两个参与者
+            if {sender_id, receiver_id} != participants:
+                raise BizException("common.forbidden")
+            messages.append(Message(chat_id=chat_id, sender_id=sender_id, receiver_id=receiver_id,
+                msg=record["msg"], time=record["time"]))
+            if len(messages) >= batch_size:
+                flush(messages, Message)
+    if source_email is None:
+        raise BizException("common.bad_request")
+    if pending_docs:
+        flush_docs()
+    flush(accesses, Access)
+    flush(messages, Message)
+    # 批量写入不发送信号, 重新统计涉及的用户
+    stats.refresh(touched)
+    if tree is not None:
+        root = _remap_tree(json.loads(tree["content"]), doc_map)
+        existing = DocTree.objects.filter(author=author).first()
+        if existing is None:
+            DocTree.objects.create(author=author, content=json.dumps(root, ensure_ascii=False))
+        else:
+            content = json.loads(existing.content)
+            content["children"].update(root["children"])
+            existing.content = json.dumps(content, ensure_ascii=False)
+            existing.save()
+    return counts
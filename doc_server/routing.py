@@ -0,0 +1,176 @@
+"""
+ASGI config for doc_server project.
+
+Django 2.0 has no native ASGI handler, so each HTTP request is translated to a
+WSGI environ and handled on a bounded thread pool while the event loop keeps
+accepting connections. Blocking external I/O (mail, collaboration server,
+Mongo) is handed to ``doc.tasks`` so it never holds a request thread.
+Responses that carry an ``async_content`` generator (long-poll and SSE feed
+responses) release their pool thread as soon as the view returns and are
+streamed from the event loop instead.
+
+Run with an ASGI server, e.g. ``uvicorn doc_server.routing:application``.
+"""
+
+import asyncio
+import io
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.wsgi import get_wsgi_application
+
+from doc_server import settings
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "doc_server.settings")
+
+wsgi_application = get_wsgi_application()
+
+executor = ThreadPoolExecutor(max_workers=settings.ASGI_THREADS, thread_name_prefix="asgi")
+
+
+def build_environ(scope, body: bytes) -> dict:
+    path = scope["path"]
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode("utf8").decode("latin1"),
+        "PATH_INFO": path.encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope["http_version"]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"] = server[0]
+    environ["SERVER_PORT"] = str(server[1])
+    client = scope.get("client")
+    if client:
+        environ["REMOTE_ADDR"] = client[0]
+        environ["REMOTE_PORT"] = str(client[1])
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1")
+        value = value.decode("latin1")
+        if name == "content-length":
+            key = "CONTENT_LENGTH"
+        elif name == "content-type":
+            key = "CONTENT_TYPE"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+    return environ
+
+
+def handle_wsgi(environ: dict, put) -> None:
+    # The whole WSGI call, including iterating and closing the response,
+    # stays on one pool thread so Django opens and closes its thread-local
+    # database connection on the same thread.
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started["status"] = int(status.split(" ", 1)[0])
+        started["headers"] = [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers]
+
+    response = None
+    try:
+        response = wsgi_application(environ, start_response)
+        put(("start", started["status"], started["headers"]))
+        content = getattr(response, "async_content", None)
+        if content is not None:
+            put(("async", content))
+            return
+        for chunk in response:
+            if chunk:
+                put(("body", chunk))
+    finally:
+        if hasattr(response, "close"):
+            response.close()
+        put(("end",))
+
+
+async def read_body(receive) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+    return body
+
+
+async def send_async(content, receive, send) -> None:
+    # Stop waiting for the next chunk as soon as the client goes away so
+    # the generator's subscriptions are released.
+    disconnect = asyncio.ensure_future(receive())
+    try:
+        while True:
+            chunk = asyncio.ensure_future(content.__anext__())
+            await asyncio.wait([chunk, disconnect], return_when=asyncio.FIRST_COMPLETED)
+            if not chunk.done():
+                chunk.cancel()
+                try:
+                    await chunk
+                except (asyncio.CancelledError, StopAsyncIteration):
+                    pass
+                return
+            try:
+                body = chunk.result()
+            except StopAsyncIteration:
+                return
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+    finally:
+        disconnect.cancel()
+        await content.aclose()
+
+
+async def lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        raise ValueError("unsupported scope type {}".format(scope["type"]))
+    environ = build_environ(scope, await read_body(receive))
+    loop = asyncio.get_event_loop()
+    # Bounded so a streaming response is produced no faster than it is sent.
+    queue = asyncio.Queue(maxsize=8)
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    worker = loop.run_in_executor(executor, handle_wsgi, environ, put)
+    started = False
+    while True:
+        item = await queue.get()
+        if item[0] == "start":
+            started = True
+            await send({"type": "http.response.start", "status": item[1], "headers": item[2]})
+        elif item[0] == "end" and not started:
+            await send({"type": "http.response.start", "status": 500, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+            break
+        elif item[0] == "body":
+            await send({"type": "http.response.body", "body": item[1], "more_body": True})
+        elif item[0] == "async":
+            await send_async(item[1], receive, send)
+        else:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            break
+    await worker
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
 import configparser
+import tempfile
 
 conf = configparser.ConfigParser()
 conf.read("../config.ini")
@@ -191,3 +192,137 @@ MONGO_USER = conf["mongodb"]["user"]
 MONGO_PWD = conf["mongodb"]["pwd"]
 MONGO_DB = conf["mongodb"]["db"]
 MONGO_URL = f'mongodb://{MONGO_USER}:{MONGO_PWD}@{MONGO_HOST}:{MONGO_PORT}/?authSource=admin'
+
+
+# recycle bin
+RECYCLE_EXPIRE = 30 * 24 * 3600 * 1000
+RECYCLE_PURGE_CHUNK = 200
+
+# doc versions
+VERSION_KEYFRAME_INTERVAL = 20
+VERSION_SNAPSHOT_CHUNK = 200
+VERSION_SNAPSHOT_INTERVAL = 600
+
+# workspace export / import
+WORKSPACE_BATCH = 1000
+
+# token lifecycle, in ms
+TOKEN_TTL = 7 * 24 * 3600 * 1000
+TOKEN_RENEW_INTERVAL = 10 * 60 * 1000
+INVITE_TOKEN_TTL = 30 * 24 * 3600 * 1000
+TOKEN_SWEEP_CHUNK = 1000
+
+# asgi / background i/o
+ASGI_THREADS = 32
+IO_THREADS = 8
+# 协同编辑中间层通知失败时的重试次数, 每次等待 MID_NOTIFY_BACKOFF * 2^n 秒
+MID_NOTIFY_RETRIES = 3
+MID_NOTIFY_BACKOFF = 0.5
+MID_NOTIFY_TIMEOUT = 5
+
+# batch endpoint
+BATCH_MAX_REQUESTS = 20
+
+# change feed
+FEED_LONG_POLL_TIMEOUT = 25
+FEED_RECHECK_INTERVAL = 5
+FEED_STREAM_DURATION = 300
+FEED_BATCH = 100
+# 异步等待的长轮询和事件流复查新事件时使用的线程数
+FEED_FETCH_THREADS = 4
+FEED_RETENTION = 7 * 24 * 3600 * 1000
+
+# request profiling
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_HEADER = "HTTP_X_DOC_PROFILE"
+PROFILE_HEADER_MAX_AGE = 3600
+PROFILE_DIR = os.path.join(BASE_DIR, "profiles")
+PROFILE_MAX_TRACES = 200
+
+# slow query log, threshold in ms, flush interval in s
+SLOW_QUERY_LOG = False
+SLOW_QUERY_THRESHOLD = 100
+SLOW_QUERY_FLUSH_INTERVAL = 30
+
+# throttling, token buckets keyed by token and client ip, rates in tokens/s
+# costs below THROTTLE_SHARED_COST are counted in process memory, so each worker allows the full rate for them;
+# costlier calls share one sqlite file between workers and serialize on its write lock (BEGIN IMMEDIATE)
+THROTTLE_ENABLED = True
+THROTTLE_DB = os.path.join(tempfile.gettempdir(), "doc_server_throttle.sqlite3")
+THROTTLE_SHARED_COST = 10
+THROTTLE_LOCK_TIMEOUT = 1
+THROTTLE_IDLE = 3600
+THROTTLE_TRUST_FORWARDED = False
+THROTTLE_AUTHOR_RATE = 5
+THROTTLE_AUTHOR_BURST = 100
+THROTTLE_IP_RATE = 20
+THROTTLE_IP_BURST = 400
+THROTTLE_COSTS = {
+    "read": 1,
+    "search": 10,
+    "batch": 10,
+}
+
+# message archive, age in ms
+MESSAGE_ARCHIVE_AGE = 90 * 24 * 3600 * 1000
+MESSAGE_ARCHIVE_BATCH = 1000
+MESSAGE_ARCHIVE_SEGMENT = 500
+# 搜索聊天记录时只解压最近这么多毫秒内、最多这么多个归档段
+MESSAGE_ARCHIVE_SEARCH_WINDOW = 365 * 24 * 3600 * 1000
+MESSAGE_ARCHIVE_SEARCH_SEGMENTS = 200
+
+# serialized representation cache
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "doc-server",
+        "OPTIONS": {"MAX_ENTRIES": 20000},
+    },
+}
+REPR_CACHE = "default"
+REPR_CACHE_ENABLED = True
+REPR_CACHE_TTL = 300
+
+# signed stateless tokens, issued by login when enabled; tokens in the Token table stay valid
+SIGNED_TOKENS = False
+TOKEN_GENERATION_TTL = 60
+
+# password hashing in a process pool, 0 processes hashes on the request thread
+HASH_PROCESSES = 2
+HASH_START_METHOD = "spawn"
+HASH_QUEUE_WARN = 16
+HASH_QUEUE_MAX = 256
+
+# invalidation bus between worker processes: "socket" (this machine, via BUS_DIR), "redis" or None
+BUS_TRANSPORT = None
+BUS_DIR = os.path.join(BASE_DIR, "bus")
+BUS_REDIS_URL = "redis://localhost:6379/0"
+BUS_CHANNEL = "doc-server-invalidate"
+BUS_STATS_INTERVAL = 10
+
+# idempotency keys for retried writes, ttl and in-flight timeout in ms
+IDEMPOTENCY_TTL = 24 * 3600 * 1000
+IDEMPOTENCY_LOCK_TIMEOUT = 60 * 1000
+
+# warm the doc tree, permission map and doc representations in the background after login, interval in s
+LOGIN_WARMUP = False
+LOGIN_WARMUP_INTERVAL = 60
+
+# embedded access lists are cut to this many entries, None keeps them whole; page sizes for the access endpoints
+ACCESS_INLINE_LIMIT = 100
+ACCESS_PAGE_SIZE = 50
+ACCESS_PAGE_MAX = 200
+
+# group chats, message page sizes, the batch size of membership sync and how often it recomputes after a conflict
+GROUP_PAGE_SIZE = 50
+GROUP_PAGE_MAX = 200
+GROUP_SYNC_BATCH = 500
+GROUP_SYNC_RETRIES = 3
+
+# activity log, buffered per process and written in batches every ACTIVITY_FLUSH_INTERVAL s or at ACTIVITY_BATCH records
+ACTIVITY_ENABLED = True
+ACTIVITY_BATCH = 200
+ACTIVITY_FLUSH_INTERVAL = 2
+ACTIVITY_BUFFER_MAX = 10000
+ACTIVITY_PAGE_SIZE = 50
+ACTIVITY_PAGE_MAX = 200
@@ -21,19 +21,36 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('author/', views.AuthorList.as_view()),
     path('author/<int:pk>', views.AuthorDetail.as_view()),
+    path('author/<int:pk>/accesses', views.AuthorAccessList.as_view()),
+    path('author/<int:pk>/stats', views.AuthorStatsView.as_view()),
+    path('author/<int:pk>/activity', views.AuthorActivityList.as_view()),
     path('reveal/', views.TokenReverseView.as_view()),
+    path('logout/', views.LogoutView.as_view()),
     path('check/author', views.AuthorCheck.as_view()),
     path('auth/', views.AuthView.as_view()),
     path('doc/<str:role>/<int:author_id>', views.DocList.as_view()),
     path('doc/<int:pk>', views.DocDetail.as_view()),
+    path('doc/<int:pk>/collaborators', views.DocCollaboratorList.as_view()),
+    path('doc/<int:pk>/activity', views.DocActivityList.as_view()),
+    path('doc/<int:pk>/versions', views.DocVersionList.as_view()),
+    path('doc/<int:pk>/versions/<int:version_id>', views.DocVersionDetail.as_view()),
     path('invite/', views.AccessListView.as_view()),
     path('kick/<int:doc_id>/<int:author_id>', views.AccessDetailView.as_view()),
     path('doctree/<int:author_id>', views.DocTreeView.as_view()),
+    path('workspace/<int:author_id>', views.WorkspaceView.as_view()),
+    path('recycle/<int:author_id>', views.RecycleBinView.as_view()),
+    path('recycle/restore/<int:pk>', views.RecycleRestoreView.as_view()),
     path('batch/query/doc', views.DocQueryBatch.as_view()),
     path('batch/delete/doc', views.DocDeleteBatch.as_view()),
     path('message/query', views.MessageQuery.as_view()),
     path('chat/', views.ChatView.as_view()),
     path('chat/<int:pk>', views.ChatDetailView.as_view()),
+    path('group/', views.GroupListView.as_view()),
+    path('group/doc/<int:doc_id>', views.DocGroupView.as_view()),
+    path('group/<int:pk>/messages', views.GroupMessageView.as_view()),
+    path('group/<int:pk>/read', views.GroupReadView.as_view()),
     path('get_invite_link/', views.GetInviteLink.as_view()),
     path('get_records/', views.GetRecords.as_view()),
+    path('batch/', views.BatchView.as_view()),
+    path('feed/', views.FeedView.as_view()),
 ]